@@ -0,0 +1,81 @@
+import numpy as np
+
+# Inference-only NumPy versions of the layers in `tcnn`. These take the
+# output of `util.flatten_trees`, which is laid out as batch x nodes x
+# channels (the transpose of what the torch layers use), and are
+# constructed from the trained torch weights.
+
+class BinaryTreeConv:
+    def __init__(self, weight, bias):
+        # weight has the Conv1d layout: out_channels x in_channels x 3
+        out_channels, in_channels, _ = weight.shape
+        self.__in_channels = in_channels
+        self.__out_channels = out_channels
+
+        # a view, not a copy, so that weights loaded from a memory-mapped
+        # file stay shared.
+        self.__weights = weight.reshape(out_channels, 3 * in_channels).T
+        self.__bias = bias
+
+    def __call__(self, flat_data):
+        trees, idxes = flat_data
+        batch_size = trees.shape[0]
+        num_nodes = idxes.shape[1] // 3
+
+        # gather the (parent, left, right) triple of each node, and lay it
+        # out channel-major to match the Conv1d kernel.
+        expanded = trees[np.arange(batch_size)[:, None], idxes[:, :, 0]]
+        expanded = (expanded
+                    .reshape(batch_size, num_nodes, 3, self.__in_channels)
+                    .transpose(0, 1, 3, 2)
+                    .reshape(batch_size, num_nodes, 3 * self.__in_channels))
+        results = expanded @ self.__weights + self.__bias
+
+        # add a zero vector back on
+        zero_vec = np.zeros((batch_size, 1, self.__out_channels),
+                            dtype=results.dtype)
+        results = np.concatenate((zero_vec, results), axis=1)
+        return (results, idxes)
+
+class TreeActivation:
+    def __init__(self, activation):
+        self.activation = activation
+
+    def __call__(self, x):
+        return (self.activation(x[0]), x[1])
+
+class TreeLayerNorm:
+    def __call__(self, x):
+        data, idxes = x
+        mean = np.mean(data, axis=(1, 2), keepdims=True)
+        std = np.std(data, axis=(1, 2), keepdims=True, ddof=1)
+        normd = (data - mean) / (std + 0.00001)
+        return (normd, idxes)
+
+class DynamicPooling:
+    def __call__(self, x):
+        return np.max(x[0], axis=1)
+
+class Linear:
+    def __init__(self, weight, bias):
+        self.__weights = weight.T
+        self.__bias = bias
+
+    def __call__(self, x):
+        return x @ self.__weights + self.__bias
+
+class LeakyReLU:
+    def __init__(self, negative_slope=0.01):
+        self.__negative_slope = negative_slope
+
+    def __call__(self, x):
+        return np.where(x >= 0, x, x * self.__negative_slope)
+
+class Sequential:
+    def __init__(self, *layers):
+        self.__layers = layers
+
+    def __call__(self, x):
+        for layer in self.__layers:
+            x = layer(x)
+        return x
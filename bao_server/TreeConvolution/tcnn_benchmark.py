@@ -0,0 +1,261 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from util import prepare_trees
+import tcnn
+
+# Micro-benchmarks for `prepare_trees` and the tree convolution layers
+# (`BinaryTreeConv`, `TreeLayerNorm` and `DynamicPooling`), over tree depth,
+# tree shape, batch size and channel width. Each layer is timed forward and
+# backward, along with the peak memory of a forward and backward pass (for
+# `prepare_trees`, the peak memory of its NumPy arrays).
+#
+# The trees are synthetic query plans shaped like the trees Bao builds from
+# PostgreSQL plans: joins (Nested Loop, Hash Join, Merge Join) as inner
+# nodes and scans as leaves, each with its estimated cost and rows. Nodes
+# with a single child (Hash, Sort, Aggregate, ...) do not appear in these
+# trees, as Bao's featurizer skips them. A "left-deep" tree joins one scan
+# at each level, a "bushy" tree may join a subtree of up to three levels of
+# joins instead. Trees are generated from a fixed seed, so every run
+# measures the same trees.
+
+JOIN_TYPES = ["Nested Loop", "Hash Join", "Merge Join"]
+SCAN_TYPES = ["Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan"]
+NODE_TYPES = JOIN_TYPES + SCAN_TYPES
+
+# node type one-hot, then log cost and log rows
+IN_CHANNELS = len(NODE_TYPES) + 2
+
+SHAPES = ["left-deep", "bushy"]
+
+# the deepest subtree a bushy tree joins in place of a scan
+MAX_BUSHY_SUBTREE_DEPTH = 3
+
+def _node(node_type, cost, rows, children=()):
+    vec = np.zeros(IN_CHANNELS)
+    vec[NODE_TYPES.index(node_type)] = 1
+    vec[-2] = math.log1p(cost)
+    vec[-1] = math.log1p(rows)
+    return (vec, *children)
+
+def _cost(node):
+    return math.expm1(node[0][-2])
+
+def _rows(node):
+    return math.expm1(node[0][-1])
+
+def _scan(rng):
+    rows = rng.lognormvariate(8, 3)
+    cost = rows * rng.uniform(0.01, 0.05) + rng.lognormvariate(6, 2)
+    return _node(rng.choice(SCAN_TYPES), cost, rows)
+
+def _join(rng, left, right):
+    rows = max(1.0, max(_rows(left), _rows(right)) * rng.uniform(0.01, 2.0))
+    cost = _cost(left) + _cost(right) + rows * rng.uniform(0.01, 0.1)
+    return _node(rng.choice(JOIN_TYPES), cost, rows, (left, right))
+
+def _bushy(rng, depth):
+    # a tree of exactly `depth` joins from the root to its deepest scan
+    if depth == 0:
+        return _scan(rng)
+    other = rng.randint(0, min(depth - 1, MAX_BUSHY_SUBTREE_DEPTH))
+    return _join(rng, _bushy(rng, depth - 1), _bushy(rng, other))
+
+def synthetic_tree(rng, depth, shape):
+    """
+    A plan tree with `depth` levels of joins, as nested tuples of
+    (node vector, left child, right child), or (node vector,) for scans.
+    """
+    if shape == "left-deep":
+        tree = _scan(rng)
+        for _ in range(depth):
+            tree = _join(rng, tree, _scan(rng))
+        return tree
+    elif shape == "bushy":
+        return _bushy(rng, depth)
+    raise ValueError(f"Unknown tree shape: {shape}")
+
+def left_child(x):
+    return x[1] if len(x) > 1 else None
+
+def right_child(x):
+    return x[2] if len(x) > 1 else None
+
+def transformer(x):
+    return x[0]
+
+def tree_nodes(tree):
+    if len(tree) == 1:
+        return 1
+    return 1 + tree_nodes(tree[1]) + tree_nodes(tree[2])
+
+
+def peak_memory(fn):
+    """
+    The peak memory of the tensors allocated while running `fn`, in bytes,
+    as recorded by the torch profiler one operator at a time.
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+
+    allocated = peak = 0
+    for event in sorted(prof.events(), key=lambda x: x.time_range.start):
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+def peak_array_memory(fn):
+    # the peak memory of the Python objects (including NumPy arrays)
+    # allocated while running `fn`, in bytes
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def _summary(times):
+    times = np.array(times) * 1000.0
+    return {"mean": float(times.mean()),
+            "p50": float(np.percentile(times, 50)),
+            "min": float(times.min())}
+
+def _layer(name, width):
+    if name == "BinaryTreeConv":
+        return tcnn.BinaryTreeConv(width, width)
+    elif name == "TreeLayerNorm":
+        return tcnn.TreeLayerNorm()
+    elif name == "DynamicPooling":
+        return tcnn.DynamicPooling()
+    raise ValueError(f"Unknown layer: {name}")
+
+LAYERS = ["BinaryTreeConv", "TreeLayerNorm", "DynamicPooling"]
+
+def bench_prepare(trees, repeat):
+    prepare = lambda: prepare_trees(trees, transformer, left_child, right_child)
+    prepare()
+    return {"forward_ms": _summary(_timed(prepare, repeat)),
+            "peak_bytes": peak_array_memory(prepare)}
+
+def bench_layer(layer, indexes, width, repeat, seed=0):
+    # `indexes` are from `prepare_trees`, the node vectors are random
+    # vectors of `width` channels
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.randn((indexes.shape[0], width, indexes.shape[1] // 3 + 1),
+                       generator=generator)
+    data[:, :, 0] = 0
+    data.requires_grad_(True)
+
+    def output():
+        out = layer((data, indexes))
+        return out[0] if isinstance(out, tuple) else out
+
+    def forward():
+        with torch.no_grad():
+            output()
+
+    def forward_backward():
+        output().sum().backward()
+
+    def backward():
+        # time the backward pass alone
+        loss = output().sum()
+        start = time.perf_counter()
+        loss.backward()
+        return time.perf_counter() - start
+
+    forward_backward()
+    return {"forward_ms": _summary(_timed(forward, repeat)),
+            "backward_ms": _summary([backward() for _ in range(repeat)]),
+            "peak_bytes": peak_memory(forward_backward)}
+
+def run(depths, shapes, batch_sizes, widths, repeat, seed=0):
+    results = []
+
+    def record(result, **params):
+        results.append({**params, **result})
+        backward = result.get("backward_ms")
+        peak = result["peak_bytes"]
+        print(" ".join(f"{k}={v}" for k, v in params.items()),
+              f"forward {result['forward_ms']['p50']:.3f}ms",
+              f"backward {backward['p50']:.3f}ms" if backward else "",
+              f"peak {peak / 2**20:.2f}MiB")
+
+    for shape in shapes:
+        for depth in depths:
+            for batch_size in batch_sizes:
+                rng = random.Random(f"{seed}/{shape}/{depth}/{batch_size}")
+                trees = [synthetic_tree(rng, depth, shape) for _ in range(batch_size)]
+                nodes = float(np.mean([tree_nodes(x) for x in trees]))
+                tree_params = {"shape": shape, "depth": depth,
+                               "batch": batch_size, "mean_nodes": nodes}
+
+                record(bench_prepare(trees, repeat), layer="prepare_trees",
+                       **tree_params)
+
+                _, indexes = prepare_trees(trees, transformer, left_child, right_child)
+                for width in widths:
+                    for name in LAYERS:
+                        record(bench_layer(_layer(name, width), indexes, width, repeat),
+                               layer=name, width=width, **tree_params)
+    return results
+
+
+def _ints(x):
+    return [int(v) for v in x.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the tree convolution layers")
+    parser.add_argument("--depths", type=_ints, default=[2, 4, 8, 16],
+                        help="Join depths of the trees (default 2,4,8,16)")
+    parser.add_argument("--shapes", type=lambda x: x.split(","), default=SHAPES,
+                        help="Tree shapes (default left-deep,bushy)")
+    parser.add_argument("--batch-sizes", type=_ints, default=[1, 16, 64],
+                        help="Trees per batch (default 1,16,64)")
+    parser.add_argument("--widths", type=_ints, default=[16, 64, 256],
+                        help="Channels of the layers (default 16,64,256)")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Timed runs of each benchmark (default 20)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int,
+                        help="Torch threads (default: torch's default)")
+    parser.add_argument("--output", metavar="PATH",
+                        help="Also write the results as JSON to PATH")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = run(args.depths, args.shapes, args.batch_sizes, args.widths,
+                  args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"time": time.time(),
+                                "python": platform.python_version(),
+                                "numpy": np.__version__,
+                                "torch": torch.__version__,
+                                "platform": platform.platform(),
+                                "cpus": os.cpu_count(),
+                                "torch_threads": torch.get_num_threads(),
+                                "repeat": args.repeat,
+                                "seed": args.seed},
+                       "results": results}, f, indent=2)
+        print("Results written to", args.output)
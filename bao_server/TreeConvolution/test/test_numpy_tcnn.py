@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+import torch
+from torch import nn
+
+from util import prepare_trees, flatten_trees
+import tcnn
+import numpy_tcnn
+
+class TestNumpyTreeConvolution(unittest.TestCase):
+
+    def test_matches_torch(self):
+        tree1 = (
+            (0, 1),
+            ((1, 2), ((0, 1),), ((-1, 0),)),
+            ((-3, 0), ((2, 3),), ((1, 2),))
+        )
+
+        tree2 = (
+            (16, 3),
+            ((0, 1), ((5, 3),), ((2, 6),)),
+            ((2, 9),)
+        )
+
+        trees = [tree1, tree2]
+
+        def left_child(x):
+            if len(x) == 1:
+                return None
+            return x[1]
+
+        def right_child(x):
+            if len(x) == 1:
+                return None
+            return x[2]
+
+        def transformer(x):
+            return np.array(x[0])
+
+        torch.manual_seed(0)
+        net = nn.Sequential(
+            tcnn.BinaryTreeConv(2, 16),
+            tcnn.TreeLayerNorm(),
+            tcnn.TreeActivation(nn.LeakyReLU()),
+            tcnn.BinaryTreeConv(16, 8),
+            tcnn.TreeLayerNorm(),
+            tcnn.DynamicPooling(),
+            nn.Linear(8, 1)
+        )
+
+        def arrays(module):
+            return [p.detach().numpy() for p in module.parameters()]
+
+        np_net = numpy_tcnn.Sequential(
+            numpy_tcnn.BinaryTreeConv(*arrays(net[0])),
+            numpy_tcnn.TreeLayerNorm(),
+            numpy_tcnn.TreeActivation(numpy_tcnn.LeakyReLU()),
+            numpy_tcnn.BinaryTreeConv(*arrays(net[3])),
+            numpy_tcnn.TreeLayerNorm(),
+            numpy_tcnn.DynamicPooling(),
+            numpy_tcnn.Linear(*arrays(net[6]))
+        )
+
+        expected = net(prepare_trees(trees, transformer, left_child, right_child))
+        expected = expected.detach().numpy()
+
+        flat_trees, indexes = flatten_trees(trees, transformer, left_child, right_child)
+        result = np_net((flat_trees.astype(np.float32), indexes.astype(np.int64)))
+
+        self.assertEqual(result.shape, (2, 1))
+        np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import random
+import unittest
+
+from util import prepare_trees
+import tcnn_benchmark
+
+def _depth(tree):
+    if len(tree) == 1:
+        return 0
+    return 1 + max(_depth(tree[1]), _depth(tree[2]))
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_trees(self):
+        for shape in tcnn_benchmark.SHAPES:
+            for depth in (1, 4, 16):
+                rng = random.Random(0)
+                trees = [tcnn_benchmark.synthetic_tree(rng, depth, shape) for _ in range(8)]
+                for tree in trees:
+                    self.assertEqual(_depth(tree), depth)
+
+                trees_again = [tcnn_benchmark.synthetic_tree(random.Random(0), depth, shape)]
+                self.assertEqual(tcnn_benchmark.tree_nodes(trees[0]),
+                                 tcnn_benchmark.tree_nodes(trees_again[0]))
+
+                flat_trees, indexes = prepare_trees(trees, tcnn_benchmark.transformer,
+                                                    tcnn_benchmark.left_child,
+                                                    tcnn_benchmark.right_child)
+                self.assertEqual(flat_trees.shape[1], tcnn_benchmark.IN_CHANNELS)
+
+    def test_left_deep(self):
+        tree = tcnn_benchmark.synthetic_tree(random.Random(0), 8, "left-deep")
+        self.assertEqual(tcnn_benchmark.tree_nodes(tree), 17)
+
+    def test_layers(self):
+        trees = [tcnn_benchmark.synthetic_tree(random.Random(0), 3, "bushy")]
+        _, indexes = prepare_trees(trees, tcnn_benchmark.transformer,
+                                   tcnn_benchmark.left_child, tcnn_benchmark.right_child)
+        for name in tcnn_benchmark.LAYERS:
+            result = tcnn_benchmark.bench_layer(tcnn_benchmark._layer(name, 8), indexes, 8, 2)
+            self.assertGreater(result["forward_ms"]["mean"], 0)
+            self.assertGreater(result["backward_ms"]["mean"], 0)
+            self.assertGreaterEqual(result["peak_bytes"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from util import prepare_trees, TreeConvolutionError
+from util import prepare_trees, prepare_flat_trees, TreeConvolutionError
 
 
 class TestUtils(unittest.TestCase):
@@ -88,5 +88,36 @@ class TestUtils(unittest.TestCase):
             prepare_trees(trees,
                           transformer, left_child, right_child)
 
+    def test_prepare_flat(self):
+        tree1 = (
+            (0, 1),
+            ((1, 2), ((0, 1),), ((-1, 0),)),
+            ((-3, 0), ((2, 3),), ((1, 2),))
+        )
+
+        # tree1, flattened in preorder after a zero vector
+        flat_tree1 = np.array([(0, 0), (0, 1), (1, 2), (0, 1), (-1, 0),
+                               (-3, 0), (2, 3), (1, 2)])
+        indexes1 = np.array([1, 2, 5, 2, 3, 4, 3, 0, 0, 4, 0, 0,
+                             5, 6, 7, 6, 0, 0, 7, 0, 0]).reshape(-1, 1)
+
+        def left_child(x):
+            if len(x) == 1:
+                return None
+            return x[1]
+
+        def right_child(x):
+            if len(x) == 1:
+                return None
+            return x[2]
+
+        def transformer(x):
+            return np.array(x[0])
+
+        expected = prepare_trees([tree1], transformer, left_child, right_child)
+        prepared = prepare_flat_trees([flat_tree1], [indexes1])
+        self.assertTrue((expected[0] == prepared[0]).all())
+        self.assertTrue((expected[1] == prepared[1]).all())
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,4 @@
 import numpy as np
-import torch
 
 
 class TreeConvolutionError(Exception):
@@ -135,9 +134,25 @@ def _pad_and_combine(x):
 
     return np.array(vecs)
 
-def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
+def flatten_trees(trees, transformer, left_child, right_child):
+    """
+    Like `prepare_trees`, but returns plain numpy arrays (batch x max tree
+    nodes x channels, batch x 3 * max tree nodes x 1) and does not need torch.
+    """
     flat_trees = [_flatten(x, transformer, left_child, right_child) for x in trees]
-    flat_trees = _pad_and_combine(flat_trees)
+    indexes = [_tree_conv_indexes(x, left_child, right_child) for x in trees]
+    return combine_flat_trees(flat_trees, indexes)
+
+def combine_flat_trees(flat_trees, indexes):
+    """
+    Pads and stacks trees that are already flattened, each given as its
+    node vectors (with a leading zero vector) and its convolution indexes.
+    """
+    return (_pad_and_combine(flat_trees), _pad_and_combine(indexes))
+
+def _to_torch(flat_trees, indexes, cuda):
+    import torch
+
     flat_trees = torch.Tensor(flat_trees)
 
     # flat trees is now batch x max tree nodes x channels
@@ -145,13 +160,17 @@ def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
     if cuda:
         flat_trees = flat_trees.cuda()
 
-    indexes = [_tree_conv_indexes(x, left_child, right_child) for x in trees]
-    indexes = _pad_and_combine(indexes)
     indexes = torch.Tensor(indexes).long()
 
     if cuda:
         indexes = indexes.cuda()
 
     return (flat_trees, indexes)
-                    
 
+def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
+    flat_trees, indexes = flatten_trees(trees, transformer, left_child, right_child)
+    return _to_torch(flat_trees, indexes, cuda)
+
+def prepare_flat_trees(flat_trees, indexes, cuda=False):
+    # `prepare_trees` for trees that are already flattened
+    return _to_torch(*combine_flat_trees(flat_trees, indexes), cuda)
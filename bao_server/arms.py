@@ -0,0 +1,112 @@
+import storage
+from common import BaoException
+from config import read_config
+
+# The arms Bao chooses between. Each arm is a planner configuration: the
+# options it turns on, with every other option in `OPTIONS` turned off. For
+# every query, the extension plans the first `bao_num_arms` arms of
+# `set_arm_options` (pg_extension/bao_planner.h), and the server selects
+# one of them by its index. `DEFAULT_ARMS` is the same table, in the same
+# order, so that exploration can run each arm with SET statements.
+#
+# The arms in use (the first `Arms` of them, see bao.cfg) are kept in the
+# Bao DB, along with how often the server selects each one. Retired arms
+# are never explored, checked for regressions, or selected.
+
+OPTIONS = [
+    "enable_nestloop", "enable_hashjoin", "enable_mergejoin",
+    "enable_seqscan", "enable_indexscan", "enable_indexonlyscan"
+]
+
+DEFAULT_ARMS = [
+    OPTIONS,
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_mergejoin", "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_nestloop",
+     "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_nestloop", "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_mergejoin",
+     "enable_nestloop"],
+    ["enable_hashjoin", "enable_indexscan", "enable_mergejoin",
+     "enable_nestloop"],
+    ["enable_indexonlyscan", "enable_mergejoin", "enable_nestloop"],
+    ["enable_hashjoin", "enable_indexonlyscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_nestloop"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_mergejoin",
+     "enable_nestloop", "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_mergejoin",
+     "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexscan", "enable_nestloop"],
+    ["enable_indexscan", "enable_nestloop"],
+    ["enable_indexscan", "enable_mergejoin", "enable_nestloop",
+     "enable_seqscan"],
+    ["enable_indexonlyscan", "enable_indexscan", "enable_nestloop"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_mergejoin", "enable_nestloop"],
+    ["enable_indexscan", "enable_mergejoin", "enable_nestloop"],
+    ["enable_indexonlyscan", "enable_mergejoin", "enable_nestloop",
+     "enable_seqscan"],
+    ["enable_indexonlyscan", "enable_indexscan", "enable_nestloop",
+     "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_indexscan",
+     "enable_mergejoin"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_mergejoin"],
+    ["enable_hashjoin", "enable_indexscan", "enable_nestloop",
+     "enable_seqscan"],
+    ["enable_hashjoin", "enable_indexscan"],
+    ["enable_hashjoin", "enable_indexonlyscan", "enable_nestloop"],
+]
+
+def configured_arms(config=None):
+    # {arm index: options} for the arms in bao.cfg. An arm can be redefined
+    # with an ArmN setting, for extensions built with different arms.
+    if config is None:
+        config = read_config()
+
+    num_arms = int(config.get("Arms", "5"))
+    arms = {}
+    for arm_idx in range(num_arms):
+        options = config.get(f"Arm{arm_idx}")
+        if options is not None:
+            options = [x.strip() for x in options.split(",") if x.strip()]
+        elif arm_idx < len(DEFAULT_ARMS):
+            options = DEFAULT_ARMS[arm_idx]
+        else:
+            raise BaoException(f"Arm {arm_idx} has no default definition, "
+                               + f"set Arm{arm_idx} in bao.cfg.")
+
+        for option in options:
+            if option not in OPTIONS:
+                raise BaoException(f"Unknown planner option {option} "
+                                   + f"for arm {arm_idx}.")
+        arms[arm_idx] = options
+
+    return arms
+
+def sync_registry(config=None):
+    """
+    Store the arms from bao.cfg in the Bao DB, keeping the usage statistics
+    and retirement of arms that were already there, and return the active
+    arms as {arm index: options}.
+    """
+    storage.register_arms(configured_arms(config))
+    return {x["arm"]: x["options"] for x in storage.arm_registry()
+            if not x["retired"]}
+
+def hints(options):
+    # SET statements that plan a query with the arm turning on `options`
+    stmts = [f"SET {option} TO off" for option in OPTIONS]
+    stmts.extend(f"SET {option} TO on" for option in options)
+    return stmts
+
+def retire(arm_idx, retired=True):
+    if arm_idx == 0 and retired:
+        raise BaoException("Arm 0 is the PostgreSQL optimizer, "
+                           + "and cannot be retired.")
+    if not storage.set_arm_retired(arm_idx, retired):
+        raise BaoException(f"Arm {arm_idx} is not in the arm registry.")
@@ -1,14 +1,26 @@
 import argparse
 import socket
+import struct
 import json
 
 def __json_bytes(obj):
     return (json.dumps(obj) + "\n").encode("UTF-8")
 
 def __connect():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(("localhost", 9381))
-    return s
+    from config import read_config
+    config = read_config()
+
+    # prefer the Unix socket, since baoctl runs next to the Bao server
+    if unix_socket := config.get("UnixSocket", ""):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(unix_socket)
+        return s
+
+    host = config["ListenOn"]
+    if host in ("0.0.0.0", "::"):
+        host = "localhost"
+
+    return socket.create_connection((host, int(config["Port"])))
 
 def send_model_load(path):
     with __connect() as s:
@@ -16,6 +28,40 @@ def send_model_load(path):
         s.sendall(__json_bytes({"path": path}))
         s.sendall(__json_bytes({"final": True}))
 
+def __recv_exactly(s, size):
+    data = b""
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Bao server closed the connection early.")
+        data += chunk
+    return data
+
+def get_model_version():
+    # see `BaoModel.model_version`
+    with __connect() as s:
+        s.sendall(__json_bytes({"type": "model version"}))
+        s.sendall(__json_bytes({"final": True}))
+        s.shutdown(socket.SHUT_WR)
+        version, = struct.unpack("Q", __recv_exactly(s, struct.calcsize("Q")))
+        return version
+
+def send_predict_batch(plans, buffers=None):
+    # Each plan is a Bao plan JSON object, optionally with its own
+    # "Buffers". Otherwise, `buffers` is used for every plan.
+    with __connect() as s:
+        s.sendall(__json_bytes({"type": "predict batch"}))
+        for plan in plans:
+            s.sendall(__json_bytes(plan))
+        if buffers is not None:
+            s.sendall(__json_bytes(buffers))
+        s.sendall(__json_bytes({"final": True}))
+        s.shutdown(socket.SHUT_WR)
+
+        count, = struct.unpack("I", __recv_exactly(s, struct.calcsize("I")))
+        return list(struct.unpack(f"{count}d",
+                                  __recv_exactly(s, struct.calcsize(f"{count}d"))))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Bao for PostgreSQL Controller")
@@ -25,23 +71,62 @@ if __name__ == "__main__":
     parser.add_argument("--train",
                         metavar="PATH",
                         help="Train a Bao model and save it")
+    parser.add_argument("--convert",
+                        metavar="PATH",
+                        help="Convert a Bao model saved in the old directory format into a model file")
     parser.add_argument("--retrain", action="store_true",
                         help="Force the Bao server to train a model and load it")
+    parser.add_argument("--model-version", action="store_true",
+                        help="Print the version of the model the Bao server uses (the number of models it has accepted)")
     parser.add_argument("--test-connection", action="store_true",
                         help="Test the connection from the Bao server to the PostgreSQL instance.")
     parser.add_argument("--add-test-query", metavar="PATH",
                         help="Add the SQL query in the file at PATH to the test query list")
+    parser.add_argument("--predict-batch", metavar="PATH",
+                        help="Print the Bao server's prediction for each plan in the JSONL file at PATH")
+    parser.add_argument("--buffers", metavar="PATH",
+                        help="Buffer state JSON used with --predict-batch for plans without their own")
     parser.add_argument("--status", action="store_true",
                         help="Print out information about the Bao server.")
     parser.add_argument("--experiment", metavar="SECONDS", type=int,
                         help="Conduct experiments on test queries for (up to) SECONDS seconds.")
+    parser.add_argument("--arms", action="store_true",
+                        help="Print how often the Bao server selects each arm.")
+    parser.add_argument("--retire-arm", metavar="ARM", type=int,
+                        help="Stop exploring, checking, and selecting arm ARM.")
+    parser.add_argument("--restore-arm", metavar="ARM", type=int,
+                        help="Use the retired arm ARM again.")
+
+    # override the training settings in bao.cfg for --train and --retrain
+    parser.add_argument("--max-epochs", type=int,
+                        help="Maximum number of training epochs")
+    parser.add_argument("--time-budget", metavar="SECONDS", type=float,
+                        help="Stop training after SECONDS seconds")
+    parser.add_argument("--batch-size", type=int,
+                        help="Training batch size")
+    parser.add_argument("--learning-rate", type=float,
+                        help="Training learning rate")
+    parser.add_argument("--validation-fraction", type=float,
+                        help="Fraction of the experience held out for early stopping")
+    parser.add_argument("--patience", metavar="EPOCHS", type=int,
+                        help="Epochs without validation improvement before stopping")
     
     args = parser.parse_args()
 
-    if args.train:
+    if args.train or args.retrain:
         import train
+        params = train.training_params({
+            "max_epochs": args.max_epochs,
+            "time_budget": args.time_budget,
+            "batch_size": args.batch_size,
+            "learning_rate": args.learning_rate,
+            "validation_fraction": args.validation_fraction,
+            "patience": args.patience
+        })
+
+    if args.train:
         print("Training Bao model from collected experience")
-        train.train_and_save_model(args.train)
+        train.train_and_save_model(args.train, params=params)
         exit(0)
 
     if args.load:
@@ -55,14 +140,26 @@ if __name__ == "__main__":
         print("Message sent to server.")
         exit(0)
 
+    if args.convert:
+        import model
+        print("Converting the Bao model at", args.convert)
+        model.convert_directory_model(args.convert)
+        print("Model converted.")
+        exit(0)
+
     if args.retrain:
-        import train
         from constants import DEFAULT_MODEL_PATH, OLD_MODEL_PATH, TMP_MODEL_PATH
-        train.train_and_swap(DEFAULT_MODEL_PATH, OLD_MODEL_PATH, TMP_MODEL_PATH,
-                             verbose=True)
+        if not train.train_and_swap(DEFAULT_MODEL_PATH, OLD_MODEL_PATH, TMP_MODEL_PATH,
+                                    verbose=True, params=params):
+            print("No new model was accepted, the Bao server keeps its model.")
+            exit(1)
         send_model_load(DEFAULT_MODEL_PATH)
         exit(0)
 
+    if args.model_version:
+        print(get_model_version())
+        exit(0)
+
     if args.test_connection:
         from reg_blocker import ExperimentRunner
         er = ExperimentRunner()
@@ -89,6 +186,19 @@ if __name__ == "__main__":
         er.explore(args.experiment)
         exit(0)
 
+    if args.predict_batch:
+        with open(args.predict_batch) as f:
+            plans = [json.loads(line) for line in f if line.strip()]
+
+        buffers = None
+        if args.buffers:
+            with open(args.buffers) as f:
+                buffers = json.load(f)
+
+        for prediction in send_predict_batch(plans, buffers):
+            print(prediction)
+        exit(0)
+
     if args.status:
         from reg_blocker import ExperimentRunner
         er = ExperimentRunner()
@@ -101,5 +211,45 @@ if __name__ == "__main__":
             
         exit(0)
 
+    if args.retire_arm is not None or args.restore_arm is not None:
+        import arms
+        arms.sync_registry()
+        if args.retire_arm is not None:
+            arms.retire(args.retire_arm)
+            print("Retired arm", args.retire_arm)
+        if args.restore_arm is not None:
+            arms.retire(args.restore_arm, retired=False)
+            print("Restored arm", args.restore_arm)
+        exit(0)
 
-    
+    if args.arms:
+        import time
+        import arms
+        import storage
+        arms.sync_registry()
+        registry = storage.arm_registry()
+        total = sum(x["selected"] for x in registry)
+
+        print("Arm  Selected  Share  Last selected  Options")
+        for x in registry:
+            share = x["selected"] / total if total else 0
+            last = ("never" if x["last_selected"] is None
+                    else f"{round(time.time() - x['last_selected'])}s ago")
+            print(str(x["arm"]).rjust(3), str(x["selected"]).rjust(9),
+                  f"{share:6.1%}", last.rjust(14),
+                  " ", ", ".join(x["options"]),
+                  "(retired)" if x["retired"] else "")
+
+        # PostgreSQL plans every one of the first bao_num_arms arms for
+        # each query, so only trailing arms can stop costing planning time.
+        needed = max(x["arm"] for x in registry if not x["retired"]) + 1
+        unused = [x["arm"] for x in registry
+                  if x["arm"] != 0 and not x["retired"] and not x["selected"]]
+        if unused:
+            print("Never selected:", ", ".join(str(x) for x in unused),
+                  "(retire them with --retire-arm)")
+        if needed < len(registry):
+            print(f"Only the first {needed} arm(s) are in use, set bao_num_arms",
+                  f"to {needed} in PostgreSQL and Arms to {needed} in bao.cfg",
+                  "to stop planning the others.")
+        exit(0)
@@ -0,0 +1,107 @@
+import collections
+import hashlib
+import json
+import os
+
+from common import BaoException
+
+# Clients send the buffer state (a JSON object mapping each relation or
+# index name to its number of buffered blocks) with every query, prediction,
+# and reward. For databases with many relations this is large, so the server
+# keeps recent snapshots, each identified by a version id, and clients can
+# send one of:
+#
+#   {"rel": count, ...}                       a full snapshot
+#   {"Buffer Version": id}                    a snapshot the server has
+#   {"Buffer Delta": {"rel": count, ...},
+#    "Base Version": id}                      changes to a snapshot the
+#                                             server has (a count of 0
+#                                             removes the relation)
+#
+# Snapshots are stored with a "buffers" message, which is answered with the
+# version id of the snapshot. Version ids are derived from the snapshot
+# contents, so every server worker assigns the same id to the same snapshot.
+# When there are several workers, snapshots are also written to a directory
+# they share, since the "buffers" message and the messages that use the
+# version may reach different workers.
+
+def _version(counts):
+    digest = hashlib.blake2b(json.dumps(counts, sort_keys=True).encode("UTF-8"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+class BufferStateCache:
+    def __init__(self, capacity=64, shared_dir=None):
+        self.__capacity = capacity
+        self.__snapshots = collections.OrderedDict()
+        self.__shared_dir = shared_dir
+
+    def __shared_path(self, version):
+        return os.path.join(self.__shared_dir, f"{version}.json")
+
+    def __remember(self, version, counts):
+        self.__snapshots[version] = counts
+        self.__snapshots.move_to_end(version)
+        while len(self.__snapshots) > self.__capacity:
+            self.__snapshots.popitem(last=False)
+
+    def __get(self, version):
+        if version not in self.__snapshots:
+            if not self.__shared_dir or not os.path.exists(self.__shared_path(version)):
+                raise BaoException(f"Unknown buffer state version {version}")
+
+            # stored by another worker
+            with open(self.__shared_path(version)) as f:
+                self.__remember(version, json.load(f))
+
+        self.__snapshots.move_to_end(version)
+        return self.__snapshots[version]
+
+    def resolve(self, message):
+        """
+        Returns the buffer counts for a buffer state message in any of the
+        forms above. Snapshots from the cache are shared, and must not be
+        modified.
+        """
+        if "Buffer Version" in message:
+            return self.__get(message["Buffer Version"])
+
+        if "Buffer Delta" in message:
+            counts = dict(self.__get(message["Base Version"]))
+            for rel, count in message["Buffer Delta"].items():
+                if count:
+                    counts[rel] = count
+                else:
+                    counts.pop(rel, None)
+            return counts
+
+        return message
+
+    def put(self, message):
+        # Keep the snapshot described by `message`, returning its version.
+        counts = self.resolve(message)
+        version = _version(counts)
+        self.__remember(version, counts)
+
+        if self.__shared_dir:
+            path = self.__shared_path(version)
+            with open(path + ".tmp", "w") as f:
+                json.dump(counts, f)
+            os.replace(path + ".tmp", path)
+            self.__prune_shared()
+
+        return version
+
+    def __prune_shared(self):
+        # keep as many snapshots on disk as each worker keeps in memory
+        paths = [os.path.join(self.__shared_dir, x)
+                 for x in os.listdir(self.__shared_dir) if x.endswith(".json")]
+        if len(paths) <= self.__capacity:
+            return
+
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:-self.__capacity]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # removed by another worker
@@ -2,3 +2,4 @@ PG_OPTIMIZER_INDEX = 0
 DEFAULT_MODEL_PATH = "bao_default_model"
 TMP_MODEL_PATH = "bao_tmp_model"
 OLD_MODEL_PATH = "bao_previous_model"
+ONLINE_MODEL_PATH = "bao_online_model"
@@ -1,14 +1,37 @@
+import hashlib
+import json
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 
 JOIN_TYPES = ["Nested Loop", "Hash Join", "Merge Join"]
 LEAF_TYPES = ["Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Index Scan"]
 ALL_TYPES = JOIN_TYPES + LEAF_TYPES
 
+# the one-hot column of each operator type in a node's feature vector
+_TYPE_COLUMNS = {t: i for i, t in enumerate(ALL_TYPES)}
+
 
 class TreeBuilderError(Exception):
     def __init__(self, msg):
         self.__msg = msg
 
+# Accessors for the trees of `plan_to_feature_tree`, in the form
+# `TreeConvolution.util.flatten_trees` takes. `plan_to_arrays` produces the
+# flattened arrays directly, these build the same arrays the long way.
+def left_child(x):
+    if len(x) != 3:
+        return None
+    return x[1]
+
+def right_child(x):
+    if len(x) != 3:
+        return None
+    return x[2]
+
+def features(x):
+    return x[0]
+
 def is_join(node):
     return node["Node Type"] in JOIN_TYPES
 
@@ -16,25 +39,58 @@ def is_scan(node):
     return node["Node Type"] in LEAF_TYPES
 
 class TreeBuilder:
-    def __init__(self, stats_extractor, relations):
+    def __init__(self, stats_extractor, relations, index_relations=None):
         self.__stats = stats_extractor
         self.__relations = sorted(relations, key=lambda x: len(x), reverse=True)
 
+        # index name -> relation name, for bitmap index scans. Filled in at
+        # fit time for the indexes in the training plans, and as new index
+        # names are seen.
+        self.__index_relations = dict(index_relations or {})
+
+    def __setstate__(self, state):
+        # builders pickled by older versions have no index map
+        self.__dict__.update(state)
+        self.__dict__.setdefault("_TreeBuilder__index_relations", {})
+
+    def relations(self):
+        return self.__relations
+
+    def stats(self):
+        return self.__stats
+
+    def index_relations(self):
+        return self.__index_relations
+
+    def __index_relation(self, index_name):
+        if index_name not in self.__index_relations:
+            # find the first (longest) relation name that appears in the index name
+            for rel in self.__relations:
+                if rel in index_name:
+                    self.__index_relations[index_name] = rel
+                    break
+            else:
+                raise TreeBuilderError("Could not find relation name for bitmap index scan")
+
+        return self.__index_relations[index_name]
+
+    def resolve_indexes(self, index_names):
+        for index_name in index_names:
+            try:
+                self.__index_relation(index_name)
+            except TreeBuilderError:
+                pass # reported when a plan using the index is featurized
+
     def __relation_name(self, node):
         if "Relation Name" in node:
             return node["Relation Name"]
 
         if node["Node Type"] == "Bitmap Index Scan":
-            # find the first (longest) relation name that appears in the index name
             name_key = "Index Name" if "Index Name" in node else "Relation Name"
             if name_key not in node:
                 print(node)
                 raise TreeBuilderError("Bitmap operator did not have an index name or a relation name")
-            for rel in self.__relations:
-                if rel in node[name_key]:
-                    return rel
-
-            raise TreeBuilderError("Could not find relation name for bitmap index scan")
+            return self.__index_relation(node[name_key])
 
         raise TreeBuilderError("Cannot extract relation type from node")
                 
@@ -70,6 +126,77 @@ class TreeBuilder:
 
         raise TreeBuilderError("Node wasn't transparent, a join, or a scan: " + str(plan))
 
+    def plan_to_arrays(self, plan, buffers=None):
+        """
+        Featurize and flatten a plan in one pass. Returns the same arrays as
+        `TreeConvolution.util.flatten_trees` produces for the tree from
+        `plan_to_feature_tree`, before padding: the node features in
+        preorder after a zero row, and the (node, left, right) convolution
+        indexes. When `buffers` (a buffer state map) is given, leaf buffer
+        counts are read from it, as `_attach_buf_data` would set them.
+        """
+        types = []
+        nodes = []
+        triples = []
+
+        def recurse(node):
+            children = node["Plans"] if "Plans" in node else []
+            if len(children) == 1:
+                return recurse(children[0])
+
+            if is_join(node):
+                assert len(children) == 2
+            elif is_scan(node):
+                assert not children
+                self.__relation_name(node)
+            else:
+                raise TreeBuilderError("Node wasn't transparent, a join, or a scan: "
+                                       + str(node))
+
+            my_id = len(types) + 1
+            types.append(_TYPE_COLUMNS[node["Node Type"]])
+            nodes.append(node)
+            triple = [my_id, 0, 0]
+            triples.append(triple)
+
+            if children:
+                triple[1] = recurse(children[0])
+                triple[2] = recurse(children[1])
+            return my_id
+
+        recurse(plan)
+
+        n = len(types)
+        stats = self.__stats
+        vecs = np.zeros((n + 1, len(ALL_TYPES) + len(stats.fields())))
+        vecs[np.arange(1, n + 1), types] = 1
+
+        # normalize each statistic over all nodes at once
+        for col, (field, lo, hi) in enumerate(zip(stats.fields(), stats.mins(), stats.maxs()),
+                                              start=len(ALL_TYPES)):
+            if field == "Buffers" and buffers is not None:
+                values = [get_buffer_count_for_leaf(x, buffers) if "Plans" not in x
+                          else x.get(field, 0)
+                          for x in nodes]
+                present = ["Plans" not in x or field in x for x in nodes]
+            else:
+                values = [x.get(field, 0) for x in nodes]
+                present = [field in x for x in nodes]
+
+            vecs[1:, col] = np.where(present,
+                                     norm(np.array(values, dtype=np.float64), lo, hi),
+                                     0)
+
+        indexes = np.array(triples, dtype=np.int64).reshape(-1, 1)
+        return (vecs, indexes)
+
+def tree_size(plan):
+    # The number of nodes `TreeBuilder` will produce for this plan: nodes
+    # with a single child are skipped.
+    children = plan["Plans"] if "Plans" in plan else []
+    own = 0 if len(children) == 1 else 1
+    return own + sum(tree_size(child) for child in children)
+
 def norm(x, lo, hi):
     return (np.log(x + 1) - lo) / (hi - lo)
 
@@ -89,6 +216,15 @@ class StatExtractor:
         self.__mins = mins
         self.__maxs = maxs
 
+    def fields(self):
+        return self.__fields
+
+    def mins(self):
+        return self.__mins
+
+    def maxs(self):
+        return self.__maxs
+
     def __call__(self, inp):
         res = []
         for f, lo, hi in zip(self.__fields, self.__mins, self.__maxs):
@@ -98,12 +234,14 @@ class StatExtractor:
                 res.append(norm(inp[f], lo, hi))
         return res
 
-def get_plan_stats(data):
+def _stat_ranges(data):
+    # the (min, max) of the log of each plan statistic. Buffer counts are
+    # only included if some node has one.
     costs = []
     rows = []
     bufs = []
     
-    def recurse(n, buffers=None):
+    def recurse(n):
         costs.append(n["Total Cost"])
         rows.append(n["Plan Rows"])
         if "Buffers" in n:
@@ -114,36 +252,33 @@ def get_plan_stats(data):
                 recurse(child)
 
     for plan in data:
-        recurse(plan["Plan"], buffers=plan.get("Buffers", None))
+        recurse(plan["Plan"])
+
+    ranges = {}
+    for field, values in (("Buffers", bufs), ("Total Cost", costs), ("Plan Rows", rows)):
+        if len(values) != 0:
+            values = np.log(np.array(values) + 1)
+            ranges[field] = (np.min(values), np.max(values))
+    return ranges
+
+def _merge_stat_ranges(all_ranges):
+    merged = {}
+    for ranges in all_ranges:
+        for field, (lo, hi) in ranges.items():
+            if field in merged:
+                lo = min(lo, merged[field][0])
+                hi = max(hi, merged[field][1])
+            merged[field] = (lo, hi)
+    return merged
+
+def _stat_extractor(ranges):
+    fields = [f for f in ("Buffers", "Total Cost", "Plan Rows") if f in ranges]
+    return StatExtractor(fields,
+                         [ranges[f][0] for f in fields],
+                         [ranges[f][1] for f in fields])
 
-    costs = np.array(costs)
-    rows = np.array(rows)
-    bufs = np.array(bufs)
-    
-    costs = np.log(costs + 1)
-    rows = np.log(rows + 1)
-    bufs = np.log(bufs + 1)
-
-    costs_min = np.min(costs)
-    costs_max = np.max(costs)
-    rows_min = np.min(rows)
-    rows_max = np.max(rows)
-    bufs_min = np.min(bufs) if len(bufs) != 0 else 0
-    bufs_max = np.max(bufs) if len(bufs) != 0 else 0
-
-    if len(bufs) != 0:
-        return StatExtractor(
-            ["Buffers", "Total Cost", "Plan Rows"],
-            [bufs_min, costs_min, rows_min],
-            [bufs_max, costs_max, rows_max]
-        )
-    else:
-        return StatExtractor(
-            ["Total Cost", "Plan Rows"],
-            [costs_min, rows_min],
-            [costs_max, rows_max]
-        )
-        
+def get_plan_stats(data):
+    return _stat_extractor(_stat_ranges(data))
 
 def get_all_relations(data):
     all_rels = []
@@ -161,6 +296,24 @@ def get_all_relations(data):
         
     return set(all_rels)
 
+def get_bitmap_index_names(data):
+    # the index names bitmap index scans are resolved by
+    names = set()
+
+    def recurse(plan):
+        if (plan["Node Type"] == "Bitmap Index Scan"
+                and "Relation Name" not in plan and "Index Name" in plan):
+            names.add(plan["Index Name"])
+
+        if "Plans" in plan:
+            for child in plan["Plans"]:
+                recurse(child)
+
+    for plan in data:
+        recurse(plan["Plan"])
+
+    return names
+
 def get_featurized_trees(data):
     all_rels = get_all_relations(data)
     stats_extractor = get_plan_stats(data)
@@ -191,21 +344,218 @@ def _attach_buf_data(tree):
 
     recurse(tree["Plan"])
 
+# The only plan fields featurization reads. Plans produced by EXPLAIN carry
+# many more (output lists, estimates, conditions), which are dropped when
+# plans are parsed or stored.
+PLAN_FIELDS = ("Node Type", "Relation Name", "Index Name",
+               "Total Cost", "Plan Rows", "Buffers", "Plans")
+
+def _select_plan_fields(pairs):
+    obj = dict(pairs)
+    if "Node Type" in obj:
+        return {k: obj[k] for k in PLAN_FIELDS if k in obj}
+    if "Plan" in obj:
+        return {k: obj[k] for k in ("Plan", "Buffers") if k in obj}
+
+    # not a plan node, e.g. a buffer state map
+    return obj
+
+_PLAN_DECODER = json.JSONDecoder(object_pairs_hook=_select_plan_fields)
+
+def parse_plan(text):
+    """
+    Parse a plan serialized as JSON, keeping only the fields in PLAN_FIELDS
+    as each node is decoded. Text that does not hold a plan is parsed in full.
+    """
+    plan = _PLAN_DECODER.decode(text)
+    if not isinstance(plan, dict) or "Plan" not in plan:
+        return json.loads(text)
+    return plan
+
+def compact_plan(plan):
+    # the same selection as `parse_plan`, for a plan that is already parsed
+    def recurse(node):
+        node = {k: node[k] for k in PLAN_FIELDS if k in node}
+        if "Plans" in node:
+            node["Plans"] = [recurse(child) for child in node["Plans"]]
+        return node
+
+    compact = {"Plan": recurse(plan["Plan"])}
+    if "Buffers" in plan:
+        compact["Buffers"] = plan["Buffers"]
+    return compact
+
+def with_leaf_buffer_counts(plan):
+    # Replace the full buffer state of a plan with the buffer count of each
+    # leaf, which is all featurization needs.
+    _attach_buf_data(plan)
+    plan.pop("Buffers", None)
+    return plan
+
+def plan_key(plan):
+    """
+    A hash identifying a plan by everything featurization uses, except
+    that leaf buffer counts only count up to their power of two bucket.
+    Repeated executions of the same plan with similar buffer states share
+    a key.
+    """
+    buffers = plan.get("Buffers")
+
+    def recurse(node):
+        key = [node.get(f) for f in ("Node Type", "Relation Name", "Index Name",
+                                     "Total Cost", "Plan Rows")]
+        if "Plans" in node:
+            key.append([recurse(child) for child in node["Plans"]])
+        else:
+            count = (get_buffer_count_for_leaf(node, buffers) if buffers is not None
+                     else node.get("Buffers", 0))
+            key.append(int(count).bit_length())
+        return key
+
+    return hashlib.blake2b(json.dumps(recurse(plan["Plan"])).encode("UTF-8"),
+                           digest_size=16).hexdigest()
+
+# Fitting and transforming large training sets can be spread over a pool
+# of processes. The plans are split into contiguous shards: for fitting,
+# each process summarizes its shard (relations, index names, statistic
+# ranges) and the summaries are merged. For transforming, the output arrays
+# are allocated in shared memory and each process writes the arrays of its
+# shard there. The plans are handed to the processes when the pool starts:
+# pools fork where the platform can, so the plans are inherited rather than
+# pickled (with other start methods they are pickled once per process).
+
+_MIN_PLANS_PER_WORKER = 1000
+
+_POOL_CONTEXT = multiprocessing.get_context(
+    "fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+
+def _shards(items, workers):
+    # contiguous (start, end) ranges, or None if a pool is not worth it
+    num_shards = min(workers, len(items) // _MIN_PLANS_PER_WORKER)
+    if num_shards < 2:
+        return None
+
+    bounds = np.linspace(0, len(items), num_shards + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+_pool_trees = None
+
+def _init_pool(trees):
+    global _pool_trees
+    _pool_trees = trees
+
+def _pool(trees, num_shards):
+    return _POOL_CONTEXT.Pool(num_shards, initializer=_init_pool,
+                              initargs=(trees,))
+
+def _fit_shard(trees):
+    for t in trees:
+        _attach_buf_data(t)
+    return (get_all_relations(trees),
+            get_bitmap_index_names(trees),
+            _stat_ranges(trees))
+
+def _fit_pool_shard(start, end):
+    return _fit_shard(_pool_trees[start:end])
+
+def _transform_pool_shard(tree_builder, start, end,
+                          vecs_shm, vecs_shape, vecs_start,
+                          indexes_shm, indexes_shape, indexes_start):
+    vecs_mem = shared_memory.SharedMemory(name=vecs_shm)
+    indexes_mem = shared_memory.SharedMemory(name=indexes_shm)
+    try:
+        all_vecs = np.ndarray(vecs_shape, dtype=np.float64, buffer=vecs_mem.buf)
+        all_indexes = np.ndarray(indexes_shape, dtype=np.int64, buffer=indexes_mem.buf)
+        for x in _pool_trees[start:end]:
+            vecs, indexes = tree_builder.plan_to_arrays(x["Plan"], x.get("Buffers"))
+            all_vecs[vecs_start:vecs_start + len(vecs)] = vecs
+            all_indexes[indexes_start:indexes_start + len(indexes)] = indexes
+            vecs_start += len(vecs)
+            indexes_start += len(indexes)
+        del all_vecs, all_indexes
+    finally:
+        vecs_mem.close()
+        indexes_mem.close()
+
+def _shared_array(shape, dtype):
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    return shared_memory.SharedMemory(create=True, size=size)
+
 class TreeFeaturizer:
     def __init__(self):
         self.__tree_builder = None
 
-    def fit(self, trees):
-        for t in trees:
-            _attach_buf_data(t)
-        all_rels = get_all_relations(trees)
-        stats_extractor = get_plan_stats(trees)
+    def fit(self, trees, workers=1):
+        shards = _shards(trees, workers)
+        if shards is None:
+            summaries = [_fit_shard(trees)]
+        else:
+            with _pool(trees, len(shards)) as pool:
+                summaries = pool.starmap(_fit_pool_shard, shards)
+
+        all_rels = set().union(*(x[0] for x in summaries))
+        index_names = set().union(*(x[1] for x in summaries))
+        stats_extractor = _stat_extractor(_merge_stat_ranges(x[2] for x in summaries))
         self.__tree_builder = TreeBuilder(stats_extractor, all_rels)
-
-    def transform(self, trees):
-        for t in trees:
-            _attach_buf_data(t)
-        return [self.__tree_builder.plan_to_feature_tree(x["Plan"]) for x in trees]
+        self.__tree_builder.resolve_indexes(index_names)
+
+    def transform(self, trees, workers=1):
+        # each plan as (node features, convolution indexes), see
+        # `TreeBuilder.plan_to_arrays`.
+        shards = _shards(trees, workers)
+        if shards is None:
+            return [self.__tree_builder.plan_to_arrays(x["Plan"], x.get("Buffers"))
+                    for x in trees]
+
+        # each plan has a zero row and a row per node, and three indexes
+        # per node
+        sizes = np.array([tree_size(x["Plan"]) for x in trees])
+        vecs_starts = np.concatenate(([0], np.cumsum(sizes + 1)))
+        indexes_starts = np.concatenate(([0], np.cumsum(3 * sizes)))
+        channels = len(ALL_TYPES) + len(self.__tree_builder.stats().fields())
+        vecs_shape = (int(vecs_starts[-1]), channels)
+        indexes_shape = (int(indexes_starts[-1]), 1)
+
+        vecs_mem = _shared_array(vecs_shape, np.float64)
+        indexes_mem = _shared_array(indexes_shape, np.int64)
+        try:
+            with _pool(trees, len(shards)) as pool:
+                pool.starmap(_transform_pool_shard, [
+                    (self.__tree_builder, int(s), int(e),
+                     vecs_mem.name, vecs_shape, int(vecs_starts[s]),
+                     indexes_mem.name, indexes_shape, int(indexes_starts[s]))
+                    for s, e in shards])
+
+            all_vecs = np.ndarray(vecs_shape, dtype=np.float64,
+                                  buffer=vecs_mem.buf).copy()
+            all_indexes = np.ndarray(indexes_shape, dtype=np.int64,
+                                     buffer=indexes_mem.buf).copy()
+        finally:
+            vecs_mem.close()
+            vecs_mem.unlink()
+            indexes_mem.close()
+            indexes_mem.unlink()
+
+        return [(all_vecs[vecs_starts[i]:vecs_starts[i + 1]],
+                 all_indexes[indexes_starts[i]:indexes_starts[i + 1]])
+                for i in range(len(trees))]
+
+    def export(self):
+        # the fitted state, as plain lists and arrays (for `model_file`).
+        stats = self.__tree_builder.stats()
+        return {"relations": list(self.__tree_builder.relations()),
+                "index_relations": dict(self.__tree_builder.index_relations()),
+                "stat_fields": list(stats.fields()),
+                "stat_mins": np.array(stats.mins(), dtype=np.float64),
+                "stat_maxs": np.array(stats.maxs(), dtype=np.float64)}
+
+    def restore(self, relations, stat_fields, stat_mins, stat_maxs,
+                index_relations=None):
+        stats_extractor = StatExtractor(list(stat_fields),
+                                        [float(x) for x in stat_mins],
+                                        [float(x) for x in stat_maxs])
+        self.__tree_builder = TreeBuilder(stats_extractor, relations,
+                                          index_relations)
 
     def num_operators(self):
         return len(ALL_TYPES)
@@ -1,15 +1,24 @@
 import socketserver
+import socket
+import selectors
+import signal
+import multiprocessing
+import collections
+import tempfile
+import shutil
 import json
 import struct
 import sys
+import threading
 import time
 import os
 import storage
-import model
-import train
-import baoctl
 import math
+import numpy as np
 import reg_blocker
+from common import BaoException
+from featurize import tree_size
+from buffers import BufferStateCache
 from constants import (PG_OPTIMIZER_INDEX, DEFAULT_MODEL_PATH,
                        OLD_MODEL_PATH, TMP_MODEL_PATH)
 
@@ -18,9 +27,66 @@ def add_buffer_info_to_plans(buffer_info, plans):
         p["Buffers"] = buffer_info
     return plans
 
-class BaoModel:
+# how often each worker adds its arm selection counts to the arm registry,
+# and picks up arms that were retired
+ARM_STATS_INTERVAL_SECONDS = 10
+
+def _new_regression(backend):
+    # import lazily, so that the NumPy backend never imports torch.
+    if backend == "numpy":
+        import np_model
+        return np_model.NumpyBaoRegression()
+    elif backend == "torch":
+        import model
+        return model.BaoRegression(have_cache_data=True)
+    raise BaoException(f"Unknown inference backend: {backend}")
+
+class SharedModelState:
+    # Which model file the server workers should be serving. A worker that
+    # accepts a new model publishes it here, and the other workers pick it
+    # up before handling their next message.
     def __init__(self):
+        self.__generation = multiprocessing.Value("L", 0)
+        self.__path = multiprocessing.Array("c", 4096)
+
+    def publish(self, path):
+        with self.__generation.get_lock():
+            self.__path.value = path.encode("UTF-8")
+            self.__generation.value += 1
+            return self.__generation.value
+
+    def current(self):
+        with self.__generation.get_lock():
+            return (self.__generation.value,
+                    self.__path.value.decode("UTF-8"))
+
+class BaoModel:
+    def __init__(self, backend="torch", precision="float32", shared_state=None):
         self.__current_model = None
+        self.__backend = backend
+        self.__precision = precision
+        self.__shared_state = shared_state
+        self.__generation = 0
+
+        self.__selections = collections.Counter()
+        self.__stats_time = time.time()
+        self.__refresh_arms()
+
+    def __refresh_arms(self):
+        # the arms in the registry that may be selected (None for any)
+        registry = storage.arm_registry()
+        self.__active_arms = ({x["arm"] for x in registry if not x["retired"]}
+                              if registry else None)
+
+    def __record_selection(self, idx):
+        self.__selections[idx] += 1
+        if time.time() - self.__stats_time < ARM_STATS_INTERVAL_SECONDS:
+            return
+
+        storage.record_arm_selections(self.__selections)
+        self.__selections.clear()
+        self.__stats_time = time.time()
+        self.__refresh_arms()
 
     def select_plan(self, messages):
         start = time.time()
@@ -29,12 +95,22 @@ class BaoModel:
 
         # if we don't have a model, default to the PG optimizer
         if self.__current_model is None:
+            self.__record_selection(PG_OPTIMIZER_INDEX)
             return PG_OPTIMIZER_INDEX
 
         # if we do have a model, make predictions for each plan.
         arms = add_buffer_info_to_plans(buffers, arms)
         res = self.__current_model.predict(arms)
-        idx = res.argmin()
+        if self.__active_arms is None:
+            idx = res.argmin()
+        else:
+            # never select retired arms, or arms not in the registry
+            masked = np.full(len(arms), np.inf)
+            for arm_idx in self.__active_arms:
+                if arm_idx < len(arms):
+                    masked[arm_idx] = res[arm_idx][0]
+            idx = masked.argmin() if np.isfinite(masked).any() else PG_OPTIMIZER_INDEX
+        self.__record_selection(int(idx))
         stop = time.time()
         print("Selected index", idx,
               "after", f"{round((stop - start) * 1000)}ms",
@@ -54,17 +130,53 @@ class BaoModel:
         plans = add_buffer_info_to_plans(buffers, [plan])
         res = self.__current_model.predict(plans)
         return res[0][0]
+
+    def predict_batch(self, messages):
+        # Plans may carry their own "Buffers", otherwise the last message
+        # can be a buffer state shared by every plan.
+        plans = messages
+        if plans and "Plan" not in plans[-1]:
+            *plans, buffers = plans
+            plans = [p if "Buffers" in p else dict(p, Buffers=buffers)
+                     for p in plans]
+
+        if not plans:
+            return []
+
+        # if we don't have a model, make a prediction of NaN for each plan
+        if self.__current_model is None:
+            return [math.nan] * len(plans)
+
+        # Trees in a batch are padded to the same size, and the padding
+        # changes the layer norm statistics. So rather than one predict call
+        # for the whole batch, there is one per group of equally sized
+        # trees. Each plan then gets the prediction of a `predict` message,
+        # up to float32 rounding (about 1e-5 relative).
+        by_size = collections.defaultdict(list)
+        for idx, plan in enumerate(plans):
+            by_size[tree_size(plan["Plan"])].append(idx)
+
+        result = [None] * len(plans)
+        for idxes in by_size.values():
+            res = self.__current_model.predict([plans[i] for i in idxes])
+            for i, prediction in zip(idxes, res[:, 0]):
+                result[i] = float(prediction)
+        return result
     
-    def load_model(self, fp):
+    def load_model(self, fp, notify_workers=True):
         try:
-            new_model = model.BaoRegression(have_cache_data=True)
-            new_model.load(fp)
+            new_model = self.__load(fp)
 
             if reg_blocker.should_replace_model(
                     self.__current_model,
                     new_model):
                 self.__current_model = new_model
                 print("Accepted new model.")
+                if notify_workers:
+                    if self.__shared_state:
+                        self.__generation = self.__shared_state.publish(fp)
+                    else:
+                        self.__generation += 1
             else:
                 print("Rejecting load of new model due to regresison profile.")
                 
@@ -72,27 +184,82 @@ class BaoModel:
             print("Failed to load Bao model from", fp,
                   "Exception:", sys.exc_info()[0])
             raise e
+
+    def model_version(self):
+        # the number of models accepted from `load model` messages since
+        # the server started (0 for the model it started with, if any)
+        return self.__generation
+
+    def sync(self):
+        # Switch to the model most recently accepted by another worker. That
+        # worker already checked it for regressions.
+        if self.__shared_state is None:
+            return
+
+        generation, fp = self.__shared_state.current()
+        if generation != self.__generation:
+            # only try each published model once, and keep serving the
+            # current model if it cannot be loaded
+            self.__generation = generation
+            try:
+                self.__current_model = self.__load(fp)
+            except Exception as e:
+                print("Failed to load model accepted by another worker from", fp,
+                      "Exception:", e, "Keeping the current model.")
+                return
+            print("Loaded model accepted by another worker from", fp)
+
+    def __load(self, fp):
+        new_model = _new_regression(self.__backend)
+        new_model.load(fp)
+        return self.__reduce_precision(new_model)
+
+    def __reduce_precision(self, float_model):
+        if self.__precision == "float32":
+            return float_model
+
+        if self.__backend != "torch":
+            print("Reduced precision inference requires the torch backend,",
+                  "using float32.")
+            return float_model
+
+        quantized_model = float_model.quantized(self.__precision)
+
+        # Only keep the quantized model if it picks the same arms as the
+        # float model on the experimental queries.
+        changed = reg_blocker.changed_arm_choices(float_model, quantized_model)
+        if changed:
+            print(f"Rejecting {self.__precision} model, it changed the selected",
+                  f"arm of {changed} experimental queries. Using float32.")
+            return float_model
+
+        print(f"Using {self.__precision} weights for inference.")
+        return quantized_model
             
 
 class JSONTCPHandler(socketserver.BaseRequestHandler):
     def handle(self):
         str_buf = ""
         while True:
-            str_buf += self.request.recv(1024).decode("UTF-8")
-            if not str_buf:
-                # no more data, connection is finished.
-                return
-            
-            if (null_loc := str_buf.find("\n")) != -1:
+            data = self.request.recv(1024).decode("UTF-8")
+            str_buf += data
+
+            # handle every complete message we have, since a single read
+            # can contain many small messages (e.g., a batch of plans).
+            while (null_loc := str_buf.find("\n")) != -1:
                 json_msg = str_buf[:null_loc].strip()
                 str_buf = str_buf[null_loc + 1:]
                 if json_msg:
                     try:
                         if self.handle_json(json.loads(json_msg)):
-                            break
+                            return
                     except json.decoder.JSONDecodeError:
                         print("Error decoding JSON:", json_msg)
-                        break
+                        return
+
+            if not data:
+                # no more data, connection is finished.
+                return
 
 
 class BaoJSONHandler(JSONTCPHandler):
@@ -103,55 +270,297 @@ class BaoJSONHandler(JSONTCPHandler):
         if "final" in data:
             message_type = self.__messages[0]["type"]
             self.__messages = self.__messages[1:]
+            self.server.bao_model.sync()
 
-            if message_type == "query":
-                result = self.server.bao_model.select_plan(self.__messages)
-                self.request.sendall(struct.pack("I", result))
-                self.request.close()
-            elif message_type == "predict":
-                result = self.server.bao_model.predict(self.__messages)
-                self.request.sendall(struct.pack("d", result))
-                self.request.close()
-            elif message_type == "reward":
-                plan, buffers, obs_reward = self.__messages
-                plan = add_buffer_info_to_plans(buffers, [plan])[0]
-                storage.record_reward(plan, obs_reward["reward"], obs_reward["pid"])
-            elif message_type == "load model":
-                path = self.__messages[0]["path"]
-                self.server.bao_model.load_model(path)
-            else:
-                print("Unknown message type:", message_type)
+            recorder = self.server.traffic_recorder
+            captured = recorder and recorder.capture(message_type, self.__messages,
+                                                     self.server.buffer_cache)
+            start = time.time()
+            try:
+                self.__dispatch(message_type)
+            except BaoException as e:
+                # e.g., a buffer state version this worker does not know.
+                # Closing without a response makes the client fall back to
+                # the PostgreSQL plan.
+                print("Could not handle", message_type, "message:", e)
+
+            if captured:
+                recorder.write(captured, start, time.time() - start)
             
             return True
 
         self.__messages.append(data)
         return False
+
+    def __resolve_buffers(self, idx):
+        self.__messages[idx] = self.server.buffer_cache.resolve(self.__messages[idx])
+
+    def __dispatch(self, message_type):
+        if message_type == "query":
+            self.__resolve_buffers(-1)
+            result = self.server.bao_model.select_plan(self.__messages)
+            self.request.sendall(struct.pack("I", result))
+            self.request.close()
+        elif message_type == "predict":
+            self.__resolve_buffers(1)
+            result = self.server.bao_model.predict(self.__messages)
+            self.request.sendall(struct.pack("d", result))
+            self.request.close()
+        elif message_type == "predict batch":
+            if self.__messages and "Plan" not in self.__messages[-1]:
+                self.__resolve_buffers(-1)
+            # plans may carry their own buffer state, in any of its forms
+            for i, msg in enumerate(self.__messages):
+                if "Plan" in msg and "Buffers" in msg:
+                    buffers = self.server.buffer_cache.resolve(msg["Buffers"])
+                    self.__messages[i] = dict(msg, Buffers=buffers)
+            result = self.server.bao_model.predict_batch(self.__messages)
+            # the count, then the predictions (packed separately, so
+            # there is no alignment padding between them)
+            self.request.sendall(struct.pack("I", len(result))
+                                 + struct.pack(f"{len(result)}d", *result))
+            self.request.close()
+        elif message_type == "reward":
+            plan, buffers, obs_reward = self.__messages
+            try:
+                plan["Buffers"] = self.server.buffer_cache.resolve(buffers)
+            except BaoException as e:
+                # the snapshot was evicted. The reward is still worth
+                # keeping: without buffer counts, as for clients that send
+                # no buffer state.
+                print("Recording a reward without buffer counts:", e)
+            storage.record_reward(plan, obs_reward["reward"], obs_reward["pid"])
+        elif message_type == "buffers":
+            version = self.server.buffer_cache.put(self.__messages[0])
+            self.request.sendall(struct.pack("Q", version))
+            self.request.close()
+        elif message_type == "load model":
+            path = self.__messages[0]["path"]
+            self.server.bao_model.load_model(path)
+        elif message_type == "model version":
+            self.request.sendall(struct.pack("Q", self.server.bao_model.model_version()))
+            self.request.close()
+        else:
+            print("Unknown message type:", message_type)
                 
 
-def start_server(listen_on, port):
-    model = BaoModel()
+class ReusePortTCPServer(socketserver.TCPServer):
+    # Lets several worker processes bind the same address, with the kernel
+    # spreading incoming connections between them.
+    allow_reuse_address = True
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class SharedUnixStreamServer(socketserver.UnixStreamServer):
+    # Accepts connections on a Unix socket bound by the parent process, so
+    # that every worker can serve connections from the same socket.
+    def __init__(self, listen_socket, handler):
+        super().__init__(listen_socket.getsockname(), handler,
+                         bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+
+def bind_unix_socket(path, mode=0o660, group=None):
+    # remove a socket file left behind by a previous server
+    if os.path.exists(path):
+        os.remove(path)
+
+    listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listen_socket.bind(path)
+
+    # connecting needs write permission on the socket file, e.g. for the
+    # postgres user through its group
+    if group:
+        shutil.chown(path, group=group)
+    os.chmod(path, mode)
+
+    listen_socket.listen(socketserver.UnixStreamServer.request_queue_size)
+
+    # every worker is woken up for a new connection, but only one of them
+    # gets it. The others must not block in accept().
+    listen_socket.setblocking(False)
+    return listen_socket
+
+def serve(servers):
+    # handle requests from all of this worker's listeners in one thread
+    with selectors.DefaultSelector() as selector:
+        for server in servers:
+            selector.register(server, selectors.EVENT_READ)
+
+        while True:
+            for key, _events in selector.select():
+                key.fileobj.handle_request()
+
+def retain_experience(policy, limit, interval):
+    # evict experience in the background, in small batches
+    while True:
+        try:
+            evicted = 0
+            while (batch := storage.evict_experience(policy, limit)) > 0:
+                evicted += batch
+                time.sleep(0.1)
+
+            if evicted:
+                print("Evicted", evicted, "experience row(s)")
+                storage.incremental_vacuum()
+        except Exception as e:
+            print("Experience eviction failed:", e)
+
+        time.sleep(interval)
+
+def start_server(listen_on, port, unix_socket, backend, precision,
+                 shared_state=None, buffer_dir=None, traffic=None):
+    model = BaoModel(backend, precision, shared_state)
+    buffer_cache = BufferStateCache(shared_dir=buffer_dir)
+
+    # `traffic` is the arguments of the TrafficRecorder, if recording
+    traffic_recorder = None
+    if traffic:
+        from traffic import TrafficRecorder
+        traffic_recorder = TrafficRecorder(*traffic)
 
     if os.path.exists(DEFAULT_MODEL_PATH):
         print("Loading existing model")
-        model.load_model(DEFAULT_MODEL_PATH)
-    
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.TCPServer((listen_on, port), BaoJSONHandler) as server:
+        # every worker loads the default model on startup
+        model.load_model(DEFAULT_MODEL_PATH, notify_workers=False)
+
+    servers = []
+    if listen_on:
+        if shared_state:
+            server_type = ReusePortTCPServer
+        else:
+            socketserver.TCPServer.allow_reuse_address = True
+            server_type = socketserver.TCPServer
+        servers.append(server_type((listen_on, port), BaoJSONHandler))
+
+    if unix_socket:
+        servers.append(SharedUnixStreamServer(unix_socket, BaoJSONHandler))
+
+    for server in servers:
         server.bao_model = model
-        server.serve_forever()
+        server.buffer_cache = buffer_cache
+        server.traffic_recorder = traffic_recorder
+
+    try:
+        serve(servers)
+    finally:
+        for server in servers:
+            server.server_close()
 
 
 if __name__ == "__main__":
     from multiprocessing import Process
     from config import read_config
+    import arms
 
     config = read_config()
     port = int(config["Port"])
     listen_on = config["ListenOn"]
+    unix_socket_path = config.get("UnixSocket", "")
+    backend = config.get("InferenceBackend", "torch")
+    precision = config.get("InferencePrecision", "float32")
+    workers = int(config.get("Workers", "1"))
 
-    print(f"Listening on {listen_on} port {port}")
-    
-    server = Process(target=start_server, args=[listen_on, port])
+    if not listen_on and not unix_socket_path:
+        print("bao.cfg must set ListenOn, UnixSocket, or both.")
+        exit(-1)
+
+    if listen_on:
+        print(f"Listening on {listen_on} port {port}")
+
+    unix_socket = None
+    if unix_socket_path:
+        print(f"Listening on Unix socket {unix_socket_path}")
+        unix_socket = bind_unix_socket(unix_socket_path,
+                                       int(config.get("UnixSocketMode", "0660"), 8),
+                                       config.get("UnixSocketGroup", "") or None)
+
+    print(f"Using the {backend} inference backend")
+    if workers > 1 and backend != "numpy":
+        print(f"Warning: with Workers = {workers} and the {backend} backend, every",
+              "worker holds its own copy of the model weights. Use",
+              "InferenceBackend = numpy to share one memory-mapped copy.")
+
+    try:
+        active_arms = arms.sync_registry(config)
+    except BaoException as e:
+        print("Invalid arm configuration:", e)
+        exit(-1)
+    print(f"Selecting between {len(active_arms)} arm(s):",
+          ", ".join(str(x) for x in active_arms))
+
+    online_learning = config.get("OnlineLearning", "off") == "on"
+
+    shared_state = None
+    buffer_dir = None
+    if workers > 1 or online_learning:
+        # the online learner publishes the models it promotes here
+        shared_state = SharedModelState()
+    if workers > 1:
+        buffer_dir = tempfile.mkdtemp(prefix="bao_buffers_")
+
+    traffic = None
+    if traffic_dir := config.get("TrafficLog", ""):
+        sample_rate = float(config.get("TrafficSampleRate", "1.0"))
+        print(f"Recording {sample_rate:.0%} of requests to {traffic_dir}")
+        traffic = (traffic_dir, sample_rate,
+                   round(float(config.get("TrafficLogMaxMB", "100")) * 1024 * 1024),
+                   int(config.get("TrafficLogBackups", "5")))
+
+    servers = [Process(target=start_server,
+                       args=[listen_on, port, unix_socket, backend, precision,
+                             shared_state, buffer_dir, traffic])
+               for _ in range(workers)]
     
-    print("Spawning server process...")
-    server.start()
+    print(f"Spawning {workers} server process(es)...")
+    for server in servers:
+        server.start()
+
+    retention = config.get("ExperienceRetention", "all")
+    if retention != "all":
+        limit = {"window": lambda: int(config["ExperienceWindow"]),
+                 "ttl": lambda: float(config["ExperienceTTLSeconds"]),
+                 "reservoir": lambda: int(config["ExperienceReservoirSize"])}
+        if retention not in limit:
+            print("Unknown ExperienceRetention policy:", retention)
+            exit(-1)
+
+        print(f"Retaining experience with the {retention} policy")
+        threading.Thread(target=retain_experience,
+                         args=[retention, limit[retention](),
+                               float(config.get("ExperienceEvictionIntervalSeconds", "60"))],
+                         daemon=True).start()
+
+    if online_learning:
+        from online import OnlineLearner
+        print("Online learning is on")
+        learner = OnlineLearner(
+            shared_state,
+            buffer_size=int(config.get("OnlineReplayBufferSize", "10000")),
+            batch_size=int(config.get("OnlineBatchSize", "16")),
+            learning_rate=float(config.get("OnlineLearningRate", "0.0001")),
+            steps_per_update=int(config.get("OnlineStepsPerUpdate", "10")),
+            update_interval=float(config.get("OnlineUpdateIntervalSeconds", "10")),
+            promote_interval=float(config.get("OnlinePromoteIntervalSeconds", "600")))
+        threading.Thread(target=learner.run, daemon=True).start()
+
+    # stopping the server (e.g., by systemd) stops its workers too
+    def stop(*_):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for server in servers:
+            server.join()
+    finally:
+        for server in servers:
+            server.terminate()
+        if buffer_dir:
+            # the buffer state snapshots shared by the workers
+            shutil.rmtree(buffer_dir, ignore_errors=True)
+        if unix_socket:
+            unix_socket.close()
+            if os.path.exists(unix_socket_path):
+                os.remove(unix_socket_path)
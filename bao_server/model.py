@@ -1,4 +1,6 @@
-import json
+import copy
+import random
+import time
 import numpy as np
 import torch
 import torch.optim
@@ -9,10 +11,13 @@ from sklearn.pipeline import Pipeline
 
 from torch.utils.data import DataLoader
 import net
-from featurize import TreeFeaturizer
+import model_file
+from featurize import TreeFeaturizer, parse_plan
 
 CUDA = torch.cuda.is_available()
 
+# paths inside the old directory-based model format, kept so that those
+# models can still be loaded and converted.
 def _nn_path(base):
     return os.path.join(base, "nn_weights")
 
@@ -47,18 +52,44 @@ class BaoData:
 def collate(x):
     trees = []
     targets = []
+    weights = []
+    censored = []
 
-    for tree, target in x:
+    for tree, target, weight, is_censored in x:
         trees.append(tree)
         targets.append(target)
+        weights.append(weight)
+        censored.append(is_censored)
 
-    targets = torch.tensor(targets)
-    return trees, targets
+    targets = torch.tensor(np.array(targets))
+    weights = torch.tensor(weights, dtype=torch.float32).reshape(-1, 1)
+    censored = torch.tensor(censored, dtype=torch.bool).reshape(-1, 1)
+    return trees, targets, weights, censored
+
+def _weighted_mse(y_pred, y, weights, censored):
+    # a censored target is a lower bound, so predicting above it is not
+    # an error
+    error = y_pred - y
+    error = torch.where(censored & (error > 0), torch.zeros_like(error), error)
+    return torch.sum(weights * error ** 2) / torch.sum(weights)
 
 class BaoRegression:
-    def __init__(self, verbose=False, have_cache_data=False):
+    def __init__(self, verbose=False, have_cache_data=False, featurize_workers=1,
+                 max_epochs=100, time_budget=None, batch_size=16,
+                 learning_rate=0.001, validation_fraction=0.0, patience=10):
         self.__net = None
         self.__verbose = verbose
+        self.__featurize_workers = featurize_workers
+
+        # training budget. With a validation fraction, training stops once
+        # the validation loss has not improved for `patience` epochs, and
+        # the weights with the lowest validation loss are kept.
+        self.__max_epochs = max_epochs
+        self.__time_budget = time_budget
+        self.__batch_size = batch_size
+        self.__learning_rate = learning_rate
+        self.__validation_fraction = validation_fraction
+        self.__patience = patience
 
         log_transformer = preprocessing.FunctionTransformer(
             np.log1p, _inv_log1p,
@@ -71,6 +102,9 @@ class BaoRegression:
         self.__tree_transform = TreeFeaturizer()
         self.__have_cache_data = have_cache_data
         self.__in_channels = None
+        self.__y_min = None
+        self.__y_scale = None
+        self.__update_optimizer = None
         self.__n = 0
         
     def __log(self, *args):
@@ -81,6 +115,23 @@ class BaoRegression:
         return self.__n
             
     def load(self, path):
+        if os.path.isdir(path):
+            self.__load_directory(path)
+            return
+
+        metadata, tensors = model_file.read(path, mmap=False)
+        self.__n = metadata["n"]
+        self.__in_channels = metadata["in_channels"]
+
+        self.__net = net.BaoNet(self.__in_channels)
+        self.__net.load_state_dict({k: torch.from_numpy(np.array(v))
+                                    for k, v in model_file.net_arrays(tensors).items()})
+        self.__net.eval()
+
+        self.__y_min, self.__y_scale = model_file.y_transform(tensors)
+        self.__tree_transform = model_file.featurizer(metadata, tensors)
+
+    def __load_directory(self, path):
         with open(_n_path(path), "rb") as f:
             self.__n = joblib.load(f)
         with open(_channels_path(path), "rb") as f:
@@ -94,45 +145,68 @@ class BaoRegression:
             self.__pipeline = joblib.load(f)
         with open(_x_transform_path(path), "rb") as f:
             self.__tree_transform = joblib.load(f)
+        self.__set_y_transform()
+
+    def __set_y_transform(self):
+        scaler = self.__pipeline.named_steps["scale"]
+        self.__y_min = scaler.min_
+        self.__y_scale = scaler.scale_
 
     def save(self, path):
-        # try to create a directory here
-        os.makedirs(path, exist_ok=True)
-        
-        torch.save(self.__net.state_dict(), _nn_path(path))
-        with open(_y_transform_path(path), "wb") as f:
-            joblib.dump(self.__pipeline, f)
-        with open(_x_transform_path(path), "wb") as f:
-            joblib.dump(self.__tree_transform, f)
-        with open(_channels_path(path), "wb") as f:
-            joblib.dump(self.__in_channels, f)
-        with open(_n_path(path), "wb") as f:
-            joblib.dump(self.__n, f)
-
-    def fit(self, X, y):
+        model_file.write(path, *self.export())
+
+    def export(self):
+        # the model as (metadata, tensors), see `model_file`.
+        net_arrays = {k: v.detach().cpu().numpy()
+                      for k, v in self.__net.state_dict().items()}
+        return model_file.pack(self.__n, self.__in_channels, net_arrays,
+                               self.__y_min, self.__y_scale,
+                               self.__tree_transform)
+
+    def quantized(self, precision):
+        # a copy of this model for inference with reduced precision weights
+        reg = copy.copy(self)
+        reg.__net = net.quantize(self.__net, precision)
+        reg.__net.eval()
+        return reg
+
+    def fit(self, X, y, sample_weight=None, censored=None):
         if isinstance(y, list):
             y = np.array(y)
+        if sample_weight is None:
+            sample_weight = np.ones(len(y))
+        if censored is None:
+            censored = np.zeros(len(y), dtype=bool)
 
-        X = [json.loads(x) if isinstance(x, str) else x for x in X]
+        X = [parse_plan(x) if isinstance(x, str) else x for x in X]
         self.__n = len(X)
             
         # transform the set of trees into feature vectors using a log
         # (assuming the tail behavior exists, TODO investigate
         #  the quantile transformer from scikit)
         y = self.__pipeline.fit_transform(y.reshape(-1, 1)).astype(np.float32)
+        self.__set_y_transform()
         
-        self.__tree_transform.fit(X)
-        X = self.__tree_transform.transform(X)
+        self.__tree_transform.fit(X, workers=self.__featurize_workers)
+        X = self.__tree_transform.transform(X, workers=self.__featurize_workers)
+
+        pairs = list(zip(X, y, sample_weight, censored))
+        num_validation = int(len(pairs) * self.__validation_fraction)
+        if num_validation > 0 and num_validation < len(pairs):
+            random.shuffle(pairs)
+            validation_pairs = pairs[:num_validation]
+            pairs = pairs[num_validation:]
+        else:
+            validation_pairs = []
 
-        pairs = list(zip(X, y))
         dataset = DataLoader(pairs,
-                             batch_size=16,
+                             batch_size=self.__batch_size,
                              shuffle=True,
                              collate_fn=collate)
 
         # determine the initial number of channels
-        for inp, _tar in dataset:
-            in_channels = inp[0][0].shape[0]
+        for inp, _tar, _weights, _censored in dataset:
+            in_channels = inp[0][0].shape[1]
             break
 
         self.__log("Initial input channels:", in_channels)
@@ -147,17 +221,23 @@ class BaoRegression:
         if CUDA:
             self.__net = self.__net.cuda()
 
-        optimizer = torch.optim.Adam(self.__net.parameters())
-        loss_fn = torch.nn.MSELoss()
-        
+        optimizer = torch.optim.Adam(self.__net.parameters(),
+                                     lr=self.__learning_rate)
+
+        start_time = time.time()
         losses = []
-        for epoch in range(100):
+        best_loss = None
+        best_state = None
+        epochs_since_best = 0
+        for epoch in range(self.__max_epochs):
             loss_accum = 0
-            for x, y in dataset:
+            for x, y, weights, censored in dataset:
                 if CUDA:
                     y = y.cuda()
+                    weights = weights.cuda()
+                    censored = censored.cuda()
                 y_pred = self.__net(x)
-                loss = loss_fn(y_pred, y)
+                loss = _weighted_mse(y_pred, y, weights, censored)
                 loss_accum += loss.item()
         
                 optimizer.zero_grad()
@@ -169,6 +249,26 @@ class BaoRegression:
             if epoch % 15 == 0:
                 self.__log("Epoch", epoch, "training loss:", loss_accum)
 
+            if self.__time_budget and time.time() - start_time > self.__time_budget:
+                self.__log("Stopped training after the time budget at epoch", epoch)
+                break
+
+            if validation_pairs:
+                validation_loss = self.__validation_loss(validation_pairs)
+                if epoch % 15 == 0:
+                    self.__log("Epoch", epoch, "validation loss:", validation_loss)
+
+                if best_loss is None or validation_loss < best_loss:
+                    best_loss = validation_loss
+                    best_state = copy.deepcopy(self.__net.state_dict())
+                    epochs_since_best = 0
+                else:
+                    epochs_since_best += 1
+                    if epochs_since_best >= self.__patience:
+                        self.__log("Stopped training from validation loss at epoch", epoch)
+                        break
+                continue
+
             # stopping condition
             if len(losses) > 10 and losses[-1] < 0.1:
                 last_two = np.min(losses[-2:])
@@ -178,14 +278,76 @@ class BaoRegression:
         else:
             self.__log("Stopped training after max epochs")
 
+        if best_state is not None:
+            self.__log("Restoring the weights with validation loss", best_loss)
+            self.__net.load_state_dict(best_state)
+
+    def __validation_loss(self, pairs):
+        dataset = DataLoader(pairs,
+                             batch_size=self.__batch_size,
+                             collate_fn=collate)
+        loss_accum = 0
+        total_weight = 0
+        with torch.no_grad():
+            for x, y, weights, censored in dataset:
+                if CUDA:
+                    y = y.cuda()
+                    weights = weights.cuda()
+                    censored = censored.cuda()
+                loss_accum += (_weighted_mse(self.__net(x), y, weights, censored).item()
+                               * weights.sum().item())
+                total_weight += weights.sum().item()
+        return loss_accum / total_weight
+
     def predict(self, X):
         if not isinstance(X, list):
             X = [X]
-        X = [json.loads(x) if isinstance(x, str) else x for x in X]
+        X = [parse_plan(x) if isinstance(x, str) else x for x in X]
 
         X = self.__tree_transform.transform(X)
         
         self.__net.eval()
         pred = self.__net(X).cpu().detach().numpy()
-        return self.__pipeline.inverse_transform(pred)
+
+        # invert the MinMaxScaler, then the log1p transform
+        return _inv_log1p((pred - self.__y_min) / self.__y_scale)
+
+    # Small updates to an already trained model, for online learning. The
+    # featurizer and target scaling stay as they were fit.
+
+    def featurize(self, X, y):
+        # (featurized plans, scaled targets), as used by `update`
+        X = [parse_plan(x) if isinstance(x, str) else x for x in X]
+        y = np.log1p(np.array(y, dtype=np.float64)) * self.__y_scale + self.__y_min
+        return self.__tree_transform.transform(X), y.astype(np.float32).reshape(-1, 1)
+
+    def update(self, X, y, learning_rate):
+        # one SGD step on a batch from `featurize`
+        if self.__update_optimizer is None:
+            self.__update_optimizer = torch.optim.SGD(self.__net.parameters(),
+                                                      lr=learning_rate)
+
+        y = torch.tensor(np.array(y))
+        if CUDA:
+            y = y.cuda()
+
+        self.__net.train()
+        loss = torch.nn.functional.mse_loss(self.__net(X), y)
+        self.__update_optimizer.zero_grad()
+        loss.backward()
+        self.__update_optimizer.step()
+        self.__net.eval()
+        self.__n += len(X)
+        return loss.item()
+
+
+def convert_directory_model(path):
+    # rewrite a model saved in the old directory format as a model file
+    reg = BaoRegression(have_cache_data=True)
+    reg.load(path)
+
+    converted_path = path + ".converted"
+    reg.save(converted_path)
+    model_file.remove(path)
+    os.rename(converted_path, path)
 
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import struct
+import numpy as np
+
+from common import BaoException
+from featurize import TreeFeaturizer
+
+# A single-file format for trained Bao models. The file starts with a fixed
+# preamble (magic bytes, format version, header length), followed by a JSON
+# header holding the model metadata and a table of tensors. The raw tensor
+# data follows, with each tensor aligned so that the whole file can be
+# memory-mapped and each tensor viewed in place without copying.
+#
+#   [ b"BAOMODEL" | uint32 version | uint32 header length ]
+#   [ JSON header ]
+#   [ padding to a multiple of _ALIGNMENT ]
+#   [ tensor data, each tensor starting on a multiple of _ALIGNMENT ]
+#
+# Tensor offsets in the header are relative to the start of the tensor data.
+# Nothing in the file is pickled.
+
+MAGIC = b"BAOMODEL"
+FORMAT_VERSION = 1
+
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGNMENT = 64
+
+
+def _align(x):
+    return (x + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+def write(path, metadata, tensors):
+    """
+    Write `metadata` (a JSON-serializable dict) and `tensors` (a dict of name
+    to numpy array) to `path`. The file is written next to `path` and renamed
+    into place, so readers never observe a partially written model.
+    """
+    table = {}
+    offset = 0
+    for name, arr in tensors.items():
+        arr = np.asarray(arr)
+        table[name] = {"dtype": arr.dtype.str,
+                       "shape": list(arr.shape),
+                       "offset": offset}
+        offset = _align(offset + arr.nbytes)
+
+    header = json.dumps({"metadata": metadata,
+                         "tensors": table}).encode("UTF-8")
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, arr in tensors.items():
+            f.seek(data_start + table[name]["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+
+        # make sure the file always ends on an aligned boundary
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+def read(path, mmap=True):
+    """
+    Read a model file, returning (metadata, tensors). When `mmap` is true,
+    each tensor is a read-only view into a memory map of the file, so
+    processes that load the same file share its pages.
+    """
+    with open(path, "rb") as f:
+        magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise BaoException(f"{path} is not a Bao model file.")
+        if version != FORMAT_VERSION:
+            raise BaoException(f"{path} has model format version {version}, "
+                               + f"but only version {FORMAT_VERSION} is supported.")
+        header = json.loads(f.read(header_len).decode("UTF-8"))
+
+    data_start = _align(_PREAMBLE.size + header_len)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        with open(path, "rb") as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+
+    tensors = {}
+    for name, info in header["tensors"].items():
+        dtype = np.dtype(info["dtype"])
+        start = data_start + info["offset"]
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        tensors[name] = (buf[start:start + count * dtype.itemsize]
+                         .view(dtype)
+                         .reshape(info["shape"]))
+
+    return header["metadata"], tensors
+
+def remove(path):
+    # models may be in the current single-file format or the old
+    # directory format.
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def publish(new, current, previous):
+    """
+    Make the model at `new` the model at `current`, keeping the model that
+    was there at `previous`. `current` is replaced with a single atomic
+    rename, so a reader always sees either the old or the new model.
+    """
+    remove(previous)
+    if os.path.isdir(current):
+        # old directory-format models cannot be swapped atomically.
+        os.rename(current, previous)
+    elif os.path.exists(current):
+        os.link(current, previous)
+
+    os.replace(new, current)
+
+
+# Bao models are stored with the following tensors: the BaoNet state_dict
+# (prefixed by "net."), the constants of the target MinMaxScaler, and the
+# normalization constants of the featurizer.
+
+def pack(n, in_channels, net_arrays, y_min, y_scale, featurizer):
+    exported = featurizer.export()
+    metadata = {"n": int(n),
+                "in_channels": int(in_channels),
+                "relations": exported["relations"],
+                "index_relations": exported["index_relations"],
+                "stat_fields": exported["stat_fields"]}
+
+    tensors = {"net." + k: v for k, v in net_arrays.items()}
+    tensors["y_transform.min"] = y_min
+    tensors["y_transform.scale"] = y_scale
+    tensors["featurizer.stat_mins"] = exported["stat_mins"]
+    tensors["featurizer.stat_maxs"] = exported["stat_maxs"]
+    return metadata, tensors
+
+def net_arrays(tensors):
+    return {k[len("net."):]: v for k, v in tensors.items()
+            if k.startswith("net.")}
+
+def y_transform(tensors):
+    return tensors["y_transform.min"], tensors["y_transform.scale"]
+
+def featurizer(metadata, tensors):
+    tree_transform = TreeFeaturizer()
+    tree_transform.restore(metadata["relations"],
+                           metadata["stat_fields"],
+                           tensors["featurizer.stat_mins"],
+                           tensors["featurizer.stat_maxs"],
+                           # not in files written before it was added
+                           metadata.get("index_relations", {}))
+    return tree_transform
@@ -1,20 +1,9 @@
+import copy
+import torch
 import torch.nn as nn
 from TreeConvolution.tcnn import BinaryTreeConv, TreeLayerNorm
 from TreeConvolution.tcnn import TreeActivation, DynamicPooling
-from TreeConvolution.util import prepare_trees
-
-def left_child(x):
-    if len(x) != 3:
-        return None
-    return x[1]
-
-def right_child(x):
-    if len(x) != 3:
-        return None
-    return x[2]
-
-def features(x):
-    return x[0]
+from TreeConvolution.util import prepare_flat_trees
 
 class BaoNet(nn.Module):
     def __init__(self, in_channels):
@@ -41,10 +30,46 @@ class BaoNet(nn.Module):
         return self.__in_channels
         
     def forward(self, x):
-        trees = prepare_trees(x, features, left_child, right_child,
-                              cuda=self.__cuda)
+        # x is a list of flattened trees, from `TreeFeaturizer.transform`
+        flat_trees, indexes = zip(*x)
+        trees = prepare_flat_trees(flat_trees, indexes, cuda=self.__cuda)
         return self.tree_conv(trees)
 
     def cuda(self):
         self.__cuda = True
         return super().cuda()
+
+
+class _LinearTreeConvWeights(nn.Module):
+    # The stride-3 Conv1d of a BinaryTreeConv, computed as a Linear layer
+    # over each (parent, left, right) triple. Torch can only quantize
+    # Linear layers dynamically.
+    def __init__(self, conv):
+        super(_LinearTreeConvWeights, self).__init__()
+        out_channels, in_channels, kernel_size = conv.weight.shape
+        self.linear = nn.Linear(in_channels * kernel_size, out_channels)
+        self.linear.weight.data = conv.weight.data.reshape(
+            out_channels, in_channels * kernel_size).clone()
+        self.linear.bias.data = conv.bias.data.clone()
+
+    def forward(self, x):
+        batch_size, channels, length = x.shape
+        x = (x.reshape(batch_size, channels, length // 3, 3)
+             .transpose(1, 2)
+             .reshape(batch_size, length // 3, channels * 3))
+        return self.linear(x).transpose(1, 2)
+
+QUANTIZED_DTYPES = {"float16": torch.float16, "int8": torch.qint8}
+
+def quantize(bao_net, precision):
+    """
+    Returns a copy of `bao_net` with float16 or int8 weights for the tree
+    convolution and linear layers (dynamic quantization, CPU only).
+    """
+    bao_net = copy.deepcopy(bao_net)
+    for layer in bao_net.tree_conv:
+        if isinstance(layer, BinaryTreeConv):
+            layer.weights = _LinearTreeConvWeights(layer.weights)
+
+    return torch.quantization.quantize_dynamic(
+        bao_net, {nn.Linear}, dtype=QUANTIZED_DTYPES[precision])
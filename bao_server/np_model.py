@@ -0,0 +1,87 @@
+import os
+import numpy as np
+
+import model_file
+from TreeConvolution import numpy_tcnn
+from TreeConvolution.util import combine_flat_trees
+from featurize import parse_plan
+
+# An inference-only version of `model.BaoRegression` that runs the trained
+# network with NumPy. Loading and predicting with this class never imports
+# torch or scikit-learn, which keeps server startup fast and its memory
+# footprint small.
+
+def _inv_log1p(x):
+    return np.exp(x) - 1
+
+class NumpyBaoNet:
+    def __init__(self, arrays):
+        def conv(prefix):
+            return numpy_tcnn.BinaryTreeConv(arrays[prefix + ".weights.weight"],
+                                             arrays[prefix + ".weights.bias"])
+
+        def linear(prefix):
+            return numpy_tcnn.Linear(arrays[prefix + ".weight"],
+                                     arrays[prefix + ".bias"])
+
+        # mirrors the layers of `net.BaoNet`, keyed by their state_dict names
+        self.tree_conv = numpy_tcnn.Sequential(
+            conv("tree_conv.0"),
+            numpy_tcnn.TreeLayerNorm(),
+            numpy_tcnn.TreeActivation(numpy_tcnn.LeakyReLU()),
+            conv("tree_conv.3"),
+            numpy_tcnn.TreeLayerNorm(),
+            numpy_tcnn.TreeActivation(numpy_tcnn.LeakyReLU()),
+            conv("tree_conv.6"),
+            numpy_tcnn.TreeLayerNorm(),
+            numpy_tcnn.DynamicPooling(),
+            linear("tree_conv.9"),
+            numpy_tcnn.LeakyReLU(),
+            linear("tree_conv.11")
+        )
+
+    def __call__(self, x):
+        # x is a list of flattened trees, from `TreeFeaturizer.transform`
+        flat_trees, indexes = combine_flat_trees(*zip(*x))
+        trees = (flat_trees.astype(np.float32), indexes.astype(np.int64))
+        return self.tree_conv(trees)
+
+class NumpyBaoRegression:
+    def __init__(self):
+        self.__net = None
+        self.__tree_transform = None
+        self.__y_min = None
+        self.__y_scale = None
+        self.__n = 0
+
+    def num_items_trained_on(self):
+        return self.__n
+
+    def load(self, path):
+        if os.path.isdir(path):
+            # models saved in the old directory format need torch once
+            # to be read.
+            import model
+            print("Model at", path, "is in the old directory format,",
+                  "use `baoctl.py --convert` to avoid loading it with torch.")
+            reg = model.BaoRegression(have_cache_data=True)
+            reg.load(path)
+            metadata, tensors = reg.export()
+        else:
+            metadata, tensors = model_file.read(path)
+
+        self.__n = metadata["n"]
+        self.__net = NumpyBaoNet(model_file.net_arrays(tensors))
+        self.__y_min, self.__y_scale = model_file.y_transform(tensors)
+        self.__tree_transform = model_file.featurizer(metadata, tensors)
+
+    def predict(self, X):
+        if not isinstance(X, list):
+            X = [X]
+        X = [parse_plan(x) if isinstance(x, str) else x for x in X]
+
+        X = self.__tree_transform.transform(X)
+        pred = self.__net(X)
+
+        # invert the MinMaxScaler, then the log1p transform
+        return _inv_log1p((pred - self.__y_min) / self.__y_scale)
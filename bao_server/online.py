@@ -0,0 +1,130 @@
+import collections
+import os
+import random
+import time
+
+import model
+import model_file
+import reg_blocker
+import storage
+from featurize import TreeBuilderError
+from constants import DEFAULT_MODEL_PATH, OLD_MODEL_PATH, ONLINE_MODEL_PATH
+
+# Online learning between retrains. Every reward the server receives is
+# stored, so the learner follows the experience table for new rewards,
+# featurizes them with the featurizer of the served model, and keeps the
+# most recent ones in a replay buffer. It trains a shadow copy of the served
+# model with small SGD steps on batches sampled from the buffer, and every
+# so often offers the shadow as the new served model. The shadow is saved
+# as a new model file and only published to the server workers if it
+# passes the regression check, so the served model is never changed in
+# place.
+
+class OnlineLearner:
+    def __init__(self, shared_state, buffer_size=10000, batch_size=16,
+                 learning_rate=0.0001, steps_per_update=10,
+                 update_interval=10, promote_interval=600):
+        self.__shared_state = shared_state
+        self.__replay = collections.deque(maxlen=buffer_size)
+        self.__batch_size = batch_size
+        self.__learning_rate = learning_rate
+        self.__steps_per_update = steps_per_update
+        self.__update_interval = update_interval
+        self.__promote_interval = promote_interval
+
+        self.__served = None
+        self.__served_stat = None
+        self.__shadow = None
+        self.__last_id = 0
+        self.__last_promotion = time.time()
+        self.__steps_since_promotion = 0
+
+    def __load(self):
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.load(DEFAULT_MODEL_PATH)
+        return reg
+
+    def __model_changed(self):
+        # the served model file is replaced on retrains, and by promotions
+        if not os.path.exists(DEFAULT_MODEL_PATH):
+            return False
+        stat = os.stat(DEFAULT_MODEL_PATH)
+        return (stat.st_ino, stat.st_mtime_ns) != self.__served_stat
+
+    def __reset(self):
+        # start over from the served model. Its featurizer may differ, so
+        # the replay buffer is refilled from the most recent experience.
+        stat = os.stat(DEFAULT_MODEL_PATH)
+        self.__served = self.__load()
+        self.__shadow = self.__load()
+        self.__served_stat = (stat.st_ino, stat.st_mtime_ns)
+        self.__replay.clear()
+        self.__last_id = max(0, storage.last_experience_id() - self.__replay.maxlen)
+        self.__steps_since_promotion = 0
+        print("Online learning from the model at", DEFAULT_MODEL_PATH)
+
+    def __collect(self):
+        # returns the number of new rewards
+        collected = 0
+        while rows := storage.experience_since(self.__last_id):
+            self.__last_id = rows[-1][0]
+            for _exp_id, plan, reward in rows:
+                try:
+                    X, y = self.__shadow.featurize([plan], [reward])
+                except (TreeBuilderError, KeyError, AssertionError):
+                    # plans the featurizer of this model cannot handle
+                    continue
+                self.__replay.append((X[0], y[0]))
+                collected += 1
+        return collected
+
+    def __train(self):
+        if len(self.__replay) < self.__batch_size:
+            return
+
+        for _ in range(self.__steps_per_update):
+            batch = random.sample(self.__replay, self.__batch_size)
+            X = [x for x, _y in batch]
+            y = [y for _x, y in batch]
+            self.__shadow.update(X, y, self.__learning_rate)
+        self.__steps_since_promotion += self.__steps_per_update
+
+    def __promote(self):
+        self.__last_promotion = time.time()
+        if not self.__steps_since_promotion:
+            return
+
+        if not reg_blocker.should_replace_model(self.__served, self.__shadow):
+            print("Online model rejected, continuing to train it.")
+            return
+
+        self.__shadow.save(ONLINE_MODEL_PATH)
+        model_file.publish(ONLINE_MODEL_PATH, DEFAULT_MODEL_PATH, OLD_MODEL_PATH)
+        self.__shared_state.publish(DEFAULT_MODEL_PATH)
+        print("Promoted the online model after",
+              self.__steps_since_promotion, "update steps.")
+
+        # the shadow is now served, continue from a fresh copy of it
+        stat = os.stat(DEFAULT_MODEL_PATH)
+        self.__served = self.__load()
+        self.__served_stat = (stat.st_ino, stat.st_mtime_ns)
+        self.__steps_since_promotion = 0
+
+    def run(self):
+        while True:
+            try:
+                if self.__model_changed():
+                    self.__reset()
+
+                # only train when there are new rewards, so that the
+                # shadow does not overfit the replay buffer while idle
+                if self.__shadow is not None and self.__collect():
+                    self.__train()
+
+                if (self.__shadow is not None
+                        and time.time() - self.__last_promotion > self.__promote_interval):
+                    self.__promote()
+            except Exception as e:
+                print("Online learning failed:", e)
+
+            time.sleep(self.__update_interval)
@@ -1,11 +1,14 @@
-import random
+import math
+import os
 import time
 import psycopg2
 import json
 
+import arms
 import storage
 from common import BaoException
 from config import read_config
+from constants import DEFAULT_MODEL_PATH
 
 # Code to block models that would create query regressions on important queries.
 # The basic methodology is to allow the user to submit the SQL of important queries,
@@ -14,50 +17,26 @@ from config import read_config
 # When a new model is proposed, we can compute it's maximum regression on the known
 # queries.
 
-_ALL_OPTIONS = [
-    "enable_nestloop", "enable_hashjoin", "enable_mergejoin",
-    "enable_seqscan", "enable_indexscan", "enable_indexonlyscan"
-]
-
-def _arm_idx_to_hints(arm_idx):
-    hints = []
-    for option in _ALL_OPTIONS:
-        hints.append(f"SET {option} TO off")
-
-    if arm_idx == 0:
-        for option in _ALL_OPTIONS:
-            hints.append(f"SET {option} TO on")
-    elif arm_idx == 1:
-        hints.append("SET enable_hashjoin TO on")
-        hints.append("SET enable_indexonlyscan TO on")
-        hints.append("SET enable_indexscan TO on")
-        hints.append("SET enable_mergejoin TO on")
-        hints.append("SET enable_seqscan TO on")
-    elif arm_idx == 2:
-        hints.append("SET enable_hashjoin TO on")
-        hints.append("SET enable_indexonlyscan TO on")
-        hints.append("SET enable_nestloop TO on")
-        hints.append("SET enable_seqscan TO on")
-    elif arm_idx == 3:
-        hints.append("SET enable_hashjoin TO on")
-        hints.append("SET enable_indexonlyscan TO on")
-        hints.append("SET enable_seqscan TO on")
-    elif arm_idx == 4:
-        hints.append("SET enable_hashjoin TO on")
-        hints.append("SET enable_indexonlyscan TO on")
-        hints.append("SET enable_indexscan TO on")
-        hints.append("SET enable_nestloop TO on")
-        hints.append("SET enable_seqscan TO on")
-    else:
-        raise BaoException("RegBlocker only supports the first 5 arms")
-    return hints
-        
+def _model_identity(path):
+    # Identifies the model file at `path`. A new model is published by
+    # replacing the file, which changes its inode.
+    stat = os.stat(path)
+    return f"{stat.st_ino}:{stat.st_mtime_ns}"
+
 class ExperimentRunner:
     def __init__(self):
         config = read_config()
         self.__pg_connect_str = config["PostgreSQLConnectString"]
         self.__max_query_time = int(config["MaxQueryTimeSeconds"]) * 1000
 
+        # arms are cancelled once they take this many times longer than the
+        # fastest arm seen for the same query (0 to disable)
+        self.__timeout_multiple = float(config.get("ExplorationTimeoutMultiple", "0"))
+        self.__min_timeout = round(float(config.get("ExplorationMinTimeoutSeconds", "1")) * 1000)
+
+        # {arm index: options} of the arms to explore
+        self.__arms = arms.sync_registry(config)
+
     def __get_pg_cursor(self):
         try:
             conn = psycopg2.connect(self.__pg_connect_str)
@@ -101,6 +80,117 @@ class ExperimentRunner:
         
         return to_r
         
+    def __explain(self, c, sql, arm_idx):
+        # the Bao plan of `sql` under an arm, with the current buffer state
+        c.execute(f"SET statement_timeout TO {self.__max_query_time}")
+        for stmt in arms.hints(self.__arms[arm_idx]):
+            c.execute(stmt)
+        c.execute("EXPLAIN (FORMAT JSON) " + sql)
+        bao_props, _qplan = c.fetchall()[0][0]
+
+        bao_plan = json.loads(bao_props["Bao"]["Bao plan JSON"])
+        bao_plan["Buffers"] = json.loads(bao_props["Bao"]["Bao buffer JSON"])
+        return bao_plan
+
+    def __stored_plan_or_explain(self, c, experiment):
+        # the plan stored with the experiment's prediction, which was planned
+        # under the same arm
+        bao_plan = storage.experiment_plan(experiment["id"], experiment["arm"])
+        if bao_plan is None:
+            bao_plan = self.__explain(c, experiment["query"], experiment["arm"])
+        return bao_plan
+
+    def __explain_after_restart(self, sql, arm_idx):
+        # plan `sql` on a new connection, once the server is back up
+        time.sleep(5)
+        with self.__get_pg_cursor() as c:
+            c.execute("SET bao_include_json_in_explain TO on")
+            c.execute("SET enable_bao TO on")
+            return self.__explain(c, sql, arm_idx)
+
+    def __predict_experiments(self, c, experiments, deadline):
+        # Predict the latency of each experiment with the current model, or
+        # take PostgreSQL's cost estimate when there is no model. Ranking an
+        # arm needs its plan, so this runs one EXPLAIN per experiment before
+        # the experiment first executes (and executing it plans it again).
+        # That EXPLAIN happens once per experiment, ever: predictions are
+        # kept in the Bao DB with the plan they were made from, and later
+        # runs predict from the stored plans. Predictions made by another
+        # model (or by cost, before there was a model) are made again. No
+        # experiment is planned after `deadline`, the ones left without a
+        # prediction are scheduled last.
+        predictions = storage.experiment_predictions()
+
+        bao_model = None
+        model_id = None
+        if os.path.exists(DEFAULT_MODEL_PATH):
+            import np_model
+            model_id = _model_identity(DEFAULT_MODEL_PATH)
+            bao_model = np_model.NumpyBaoRegression()
+            bao_model.load(DEFAULT_MODEL_PATH)
+        stored_plans = storage.experiment_plans()
+
+        for experiment in experiments:
+            key = (experiment["id"], experiment["arm"])
+            if key in predictions and predictions[key][2] == model_id:
+                continue
+
+            bao_plan = stored_plans.get(key)
+            if bao_plan is None:
+                if time.time() >= deadline:
+                    continue
+                bao_plan = self.__explain(c, experiment["query"], experiment["arm"])
+
+            if bao_model:
+                predicted = float(bao_model.predict(bao_plan)[0][0])
+            else:
+                predicted = float(bao_plan["Plan"]["Total Cost"])
+
+            storage.record_experiment_prediction(key[0], key[1], predicted,
+                                                 model_id, bao_plan)
+            predictions[key] = (predicted, bao_model is not None, model_id)
+
+        return predictions
+
+    def __schedule(self, experiments, predictions):
+        # Yield the experiments in the order to run them: first arm 0 of
+        # every query, cheapest first, so each query has a baseline (and a
+        # timeout for its other arms). Then the other arms, taking the arm
+        # predicted fastest of every query before the second fastest, and
+        # so on. Arms predicted to take longer than their timeout go last.
+        def predicted(experiment):
+            return predictions.get((experiment["id"], experiment["arm"]),
+                                   (math.inf, False, None))
+
+        best_rewards = storage.best_experiment_rewards()
+        for experiment in sorted((x for x in experiments if x["arm"] == 0),
+                                 key=lambda x: predicted(x)[0]):
+            yield experiment
+            best_rewards[experiment["id"]] = storage.best_experiment_reward(
+                experiment["id"])
+
+        by_query = {}
+        for experiment in experiments:
+            if experiment["arm"] != 0:
+                by_query.setdefault(experiment["id"], []).append(experiment)
+
+        scheduled = []
+        for experiment_id, arms_of_query in by_query.items():
+            best_reward = best_rewards.get(experiment_id)
+            arms_of_query.sort(key=lambda x: predicted(x)[0])
+            for rank, experiment in enumerate(arms_of_query):
+                predicted_reward, from_model, _model = predicted(experiment)
+                likely_timeout = from_model and (
+                    predicted_reward > self.__max_query_time
+                    or (self.__timeout_multiple > 0 and best_reward is not None
+                        and predicted_reward > best_reward * self.__timeout_multiple))
+                scheduled.append(((2 if likely_timeout else 1, rank, predicted_reward),
+                                  experiment))
+
+        scheduled.sort(key=lambda x: x[0])
+        for _priority, experiment in scheduled:
+            yield experiment
+
     def explore(self, time_limit):
         start = time.time()
         unexecuted = storage.unexecuted_experiments()
@@ -110,7 +200,6 @@ class ExperimentRunner:
             return
 
         print("We have", len(unexecuted), "unexecuted experiment(s).")
-        random.shuffle(unexecuted)
 
         with self.__get_pg_cursor() as c:
             c.execute("SELECT pg_backend_pid()")
@@ -122,34 +211,42 @@ class ExperimentRunner:
             c.execute("SET enable_bao_rewards TO on")
             c.execute("commit")
 
-            for experiment in unexecuted:
+            predictions = self.__predict_experiments(c, unexecuted, start + time_limit)
+            for experiment in self.__schedule(unexecuted, predictions):
                 experiment_id = experiment["id"]
                 sql = experiment["query"]
                 arm_idx = experiment["arm"]
-                prev_id = storage.last_reward_from_pid(pid)
+
+                # The extension sends the reward for the experiment, with
+                # the plan and buffer state it executed, from this backend.
+                # It is the first reward from the backend after this one:
+                # the backend only runs the statements of this loop, one at
+                # a time, and of those only an experiment query that runs
+                # to completion sends a reward (EXPLAIN, SET and cancelled
+                # queries send none).
+                reward_token = storage.last_reward_from_pid(pid)
 
                 time_remaining = round((time_limit - (time.time() - start)) * 1000.0)
                 print("Time remaining:", time_remaining, "ms")
                 if time_remaining < 0:
                     break
 
-                statement_timeout = min(self.__max_query_time, time_remaining)
-                is_timeout_from_time_remaining = time_remaining < self.__max_query_time
+                query_timeout = self.__max_query_time
+                best_reward = storage.best_experiment_reward(experiment_id)
+                if self.__timeout_multiple > 0 and best_reward is not None:
+                    query_timeout = min(query_timeout,
+                                        max(round(best_reward * self.__timeout_multiple),
+                                            self.__min_timeout))
+                is_adaptive_timeout = query_timeout < self.__max_query_time
+
+                statement_timeout = min(query_timeout, time_remaining)
+                is_timeout_from_time_remaining = time_remaining < query_timeout
 
                 # set PG to timeout and to use the arm we want to test
                 c.execute(f"SET statement_timeout TO {statement_timeout}")
-                for stmt in _arm_idx_to_hints(arm_idx):
+                for stmt in arms.hints(self.__arms[arm_idx]):
                     c.execute(stmt)
                 
-                # get the Bao plan JSON so we can record a timeout if there is one
-                c.execute("EXPLAIN (FORMAT JSON) " + sql)
-                explain_json = c.fetchall()[0][0]
-                
-                bao_props, _qplan = explain_json
-
-                bao_plan = json.loads(bao_props["Bao"]["Bao plan JSON"])
-                bao_buffer = json.loads(bao_props["Bao"]["Bao buffer JSON"])
-                
                 try:
                     c.execute(sql)
                     c.fetchall()
@@ -159,12 +256,26 @@ class ExperimentRunner:
                         print("Hit experimental timeout, stopping.")
                         break
 
-                    # otherwise, the timeout was because we went past the
-                    # reasonable query limit. We should record that experiene.
-                    print("Query hit timeout, recording 2*timeout as the reward.")
-                    bao_plan["Buffers"] = bao_buffer
-                    storage.record_reward(bao_plan, 2 * self.__max_query_time,
-                                          pid)
+                    # there is no reward for a cancelled query, so record
+                    # the timeout with the plan the experiment was predicted
+                    # from. This is the only place exploration plans a query
+                    # outside the prediction pass, when that plan is missing
+                    # (the rollback undoes the SETs above).
+                    c.execute("rollback")
+                    bao_plan = self.__stored_plan_or_explain(c, experiment)
+                    if is_adaptive_timeout:
+                        # the arm is already much slower than another arm
+                        # of this query. All we know is a lower bound.
+                        print("Query was cut off after", statement_timeout,
+                              "ms, recording a censored reward.")
+                        storage.record_reward(bao_plan, statement_timeout, pid,
+                                              censored=True)
+                    else:
+                        # otherwise, the timeout was because we went past the
+                        # reasonable query limit. We should record that experiene.
+                        print("Query hit timeout, recording 2*timeout as the reward.")
+                        storage.record_reward(bao_plan, 2 * self.__max_query_time,
+                                              pid)
                     c.execute("rollback")
                 except psycopg2.OperationalError as e:
                     # this query caused the server to go down! give it a
@@ -172,13 +283,19 @@ class ExperimentRunner:
                     print("Server down after experiment with arm", arm_idx)
                     if arm_idx != 0:
                         print("Treating this as a timeout and ceasing further experiments.")
-                        bao_plan["Buffers"] = bao_buffer
-                        storage.record_reward(bao_plan, 2 * self.__max_query_time,
-                                              pid)
+                        try:
+                            bao_plan = storage.experiment_plan(experiment_id, arm_idx)
+                            if bao_plan is None:
+                                bao_plan = self.__explain_after_restart(sql, arm_idx)
+                            storage.record_reward(bao_plan, 2 * self.__max_query_time,
+                                                  pid)
+                        except (BaoException, psycopg2.OperationalError):
+                            print("Could not plan the query after the server",
+                                  "went down, no reward was recorded.")
                     raise BaoException(f"Server down after experiment with arm {arm_idx}") from e
 
                 retries_remaining = 5
-                while (last_id := storage.last_reward_from_pid(pid)) == prev_id:
+                while (last_id := storage.reward_from_pid_after(pid, reward_token)) is None:
                     # wait a second to make sure the reward is flushed to the DB
                     time.sleep(1)
                     retries_remaining -= 1
@@ -192,13 +309,22 @@ class ExperimentRunner:
         print("Finished all experiments")
 
 
+def _latency(experiment, timeout_penalty):
+    # A censored experiment was cut off, and may have run until the query
+    # limit. Charge it like a query that hit the limit.
+    if experiment["censored"]:
+        return max(experiment["reward"], timeout_penalty)
+    return experiment["reward"]
+
 def compute_regressions(bao_reg):
+    timeout_penalty = 2 * int(read_config()["MaxQueryTimeSeconds"]) * 1000
     total_regressed = 0
     total_regression = 0
     for plan_group in storage.experiment_results():
         plan_group = list(plan_group)
         plans = [x["plan"] for x in plan_group]
-        best_latency = min(plan_group, key=lambda x: x["reward"])["reward"]
+        latencies = [_latency(x, timeout_penalty) for x in plan_group]
+        best_latency = min(latencies)
         
         if bao_reg:
             selection = bao_reg.predict(plans).argmin()
@@ -206,7 +332,7 @@ def compute_regressions(bao_reg):
             # If bao_reg is false-y, compare against PostgreSQL.
             selection = 0
                 
-        selected_plan_latency = plan_group[selection]["reward"]
+        selected_plan_latency = latencies[selection]
         
         # Check to see if the regression is more than 1%.
         if selected_plan_latency > best_latency * 1.01:
@@ -217,6 +343,17 @@ def compute_regressions(bao_reg):
     return (total_regressed, total_regression)
 
 
+def changed_arm_choices(first_model, second_model):
+    # Count the experimental queries where the two models would select
+    # different arms.
+    changed = 0
+    for plan_group in storage.experiment_results():
+        plans = [x["plan"] for x in plan_group]
+        if first_model.predict(plans).argmin() != second_model.predict(plans).argmin():
+            changed += 1
+    return changed
+
+
 def should_replace_model(old_model, new_model):
     # Check the trained model for regressions on experimental queries.
     new_num_reg, new_reg_amnt = compute_regressions(new_model)
@@ -0,0 +1,171 @@
+import argparse
+import json
+import math
+import queue
+import socket
+import threading
+import time
+
+from traffic import read_traffic
+
+# Replays requests recorded by the Bao server (see `traffic.py`) against a
+# running server, and reports its throughput and latency. Note that
+# replayed rewards are stored in the Bao DB of the server they are sent to.
+
+REPLAYED_TYPES = ["query", "predict", "predict batch", "reward"]
+
+def _json_bytes(obj):
+    return (json.dumps(obj) + "\n").encode("UTF-8")
+
+def _connect(address):
+    if isinstance(address, str):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(address)
+        return s
+    return socket.create_connection(address)
+
+def _server_address():
+    # the address of the server in bao.cfg, as `baoctl.py` connects to it
+    from config import read_config
+    config = read_config()
+    if unix_socket := config.get("UnixSocket", ""):
+        return unix_socket
+
+    host = config["ListenOn"]
+    if host in ("0.0.0.0", "::"):
+        host = "localhost"
+    return (host, int(config["Port"]))
+
+def send(address, record):
+    # Send one recorded request, and wait until the server has answered it
+    # (and closed the connection).
+    with _connect(address) as s:
+        s.sendall(_json_bytes({"type": record["type"]})
+                  + b"".join(_json_bytes(x) for x in record["messages"])
+                  + _json_bytes({"final": True}))
+        s.shutdown(socket.SHUT_WR)
+        while s.recv(4096):
+            pass
+
+def percentile(values, p):
+    # nearest-rank percentile of a non-empty list
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+class Replayer:
+    def __init__(self, address, concurrency=1, speed=1.0):
+        # speed is relative to the recording, 0 sends requests as fast as
+        # the connections allow.
+        self.__address = address
+        self.__concurrency = concurrency
+        self.__speed = speed
+
+    def __send_loop(self, work, results, lock):
+        while (item := work.get()) is not None:
+            record, scheduled = item
+            start = time.time()
+            try:
+                send(self.__address, record)
+                error = None
+            except OSError as e:
+                error = str(e)
+            stop = time.time()
+
+            with lock:
+                results.append({"type": record["type"],
+                                "latency": (stop - start) * 1000.0,
+                                # how far behind the recorded pace we are
+                                "lag": (start - scheduled) * 1000.0 if scheduled else 0.0,
+                                "recorded": record.get("duration_ms"),
+                                "error": error})
+
+    def replay(self, records):
+        work = queue.Queue(maxsize=self.__concurrency * 4)
+        results = []
+        lock = threading.Lock()
+        threads = [threading.Thread(target=self.__send_loop,
+                                    args=(work, results, lock))
+                   for _ in range(self.__concurrency)]
+        for thread in threads:
+            thread.start()
+
+        start = time.time()
+        first = records[0]["time"] if records else 0
+        for record in records:
+            scheduled = None
+            if self.__speed > 0:
+                scheduled = start + (record["time"] - first) / self.__speed
+                time.sleep(max(scheduled - time.time(), 0))
+            work.put((record, scheduled))
+
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return results, time.time() - start
+
+def print_report(results, elapsed):
+    ok = [x for x in results if not x["error"]]
+    print(f"Replayed {len(results)} requests ({len(results) - len(ok)} failed)",
+          f"in {elapsed:.1f}s, {len(ok) / elapsed if elapsed else 0:.1f} requests/s")
+
+    for message_type in REPLAYED_TYPES:
+        of_type = [x for x in ok if x["type"] == message_type]
+        if not of_type:
+            continue
+
+        latencies = [x["latency"] for x in of_type]
+        print(f"{message_type} ({len(of_type)}): latency ms",
+              " ".join(f"p{p}={percentile(latencies, p):.2f}" for p in (50, 95, 99)),
+              f"max={max(latencies):.2f}")
+
+        recorded = [x["recorded"] for x in of_type if x["recorded"] is not None]
+        if recorded:
+            print(" " * len(message_type), "  recorded handling ms",
+                  " ".join(f"p{p}={percentile(recorded, p):.2f}" for p in (50, 95, 99)))
+
+    lags = [x["lag"] for x in ok]
+    if lags and max(lags) > 0:
+        print("Send lag behind the recording ms:",
+              " ".join(f"p{p}={percentile(lags, p):.2f}" for p in (50, 95, 99)),
+              "(if large, use more --concurrency)")
+
+    errors = sorted({x["error"] for x in results if x["error"]})
+    for error in errors[:5]:
+        print("Error:", error)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Replay recorded Bao server traffic")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="Traffic files, or directories of them (see TrafficLog in bao.cfg)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed relative to the recording, e.g. 10 for ten "
+                        + "times faster, or 0 for as fast as possible (default 1)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Number of requests in flight at once (default 8)")
+    parser.add_argument("--types", default=",".join(REPLAYED_TYPES),
+                        help="Comma-separated message types to replay "
+                        + f"(default {','.join(REPLAYED_TYPES)})")
+    parser.add_argument("--host", help="Server host (default from bao.cfg)")
+    parser.add_argument("--port", type=int, help="Server port (default from bao.cfg)")
+    parser.add_argument("--unix-socket", metavar="PATH",
+                        help="Server Unix socket (default from bao.cfg)")
+    args = parser.parse_args()
+
+    if args.unix_socket:
+        address = args.unix_socket
+    elif args.host or args.port:
+        from config import read_config
+        address = (args.host or "localhost",
+                   args.port or int(read_config()["Port"]))
+    else:
+        address = _server_address()
+
+    types = set(args.types.split(","))
+    records = [x for x in read_traffic(args.paths) if x["type"] in types]
+    print("Replaying", len(records), "requests against", address)
+
+    results, elapsed = Replayer(address, args.concurrency, args.speed).replay(records)
+    print_report(results, elapsed)
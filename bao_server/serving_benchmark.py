@@ -0,0 +1,442 @@
+import argparse
+import collections
+import contextlib
+import functools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+
+import featurize
+import main
+import np_model
+import storage
+from featurize import tree_size
+from main import BaoModel, add_buffer_info_to_plans
+
+# Benchmarks for the serving hot path: `select_plan`, `predict` and
+# `record_reward` as the server runs them, and a breakdown of a prediction
+# into its stages (parsing the messages, attaching the buffer state,
+# featurizing, preparing the trees, the forward pass, and inverting the
+# target transform), for several numbers of arms, batch sizes and plan
+# sizes. Results are written as JSON so that runs can be compared.
+#
+# The plans come from a fixture file with one JSON object per line:
+#
+#   {"query": name, "arm": arm index, "plan": Bao plan JSON,
+#    "buffers": Bao buffer JSON, "synthetic": true or false}
+#
+# Fixtures of real plans are captured from PostgreSQL with `--capture`
+# (the EXPLAIN of each query under each arm). Without fixtures, synthetic
+# plans shaped like PostgreSQL plans for the join order benchmark are
+# generated instead, and the results are marked as synthetic.
+
+SIZE_BUCKETS = [("small", 7), ("medium", 15), ("large", float("inf"))]
+
+# (relation, size in blocks) for synthetic plans
+_RELATIONS = [
+    ("title", 35000), ("cast_info", 250000), ("movie_info", 160000),
+    ("movie_companies", 20000), ("movie_keyword", 30000), ("name", 50000),
+    ("char_name", 30000), ("company_name", 2700), ("keyword", 1000),
+    ("info_type", 1), ("kind_type", 1), ("role_type", 1),
+    ("company_type", 1), ("movie_info_idx", 9000), ("aka_name", 7000),
+    ("aka_title", 4000), ("complete_cast", 1000), ("comp_cast_type", 1),
+    ("link_type", 1), ("movie_link", 200), ("person_info", 40000),
+]
+
+# "Node Type ID" of each node type, as PostgreSQL 12 tags them
+_NODE_TAGS = {"Seq Scan": 18, "Index Scan": 20, "Index Only Scan": 21,
+              "Bitmap Index Scan": 22, "Nested Loop": 36, "Merge Join": 37,
+              "Hash Join": 38}
+
+
+def _node(node_type, cost, rows, children=(), relation=None, tag=None):
+    node = {"Node Type": node_type if node_type in _NODE_TAGS else "Other",
+            "Node Type ID": str(tag or _NODE_TAGS.get(node_type, 45))}
+    if relation:
+        node["Relation Name"] = relation
+    node["Total Cost"] = cost
+    node["Plan Rows"] = rows
+    if children:
+        node["Plans"] = list(children)
+    return node
+
+def _synthetic_scan(rng, relation, blocks, scan_types):
+    rows = max(1.0, blocks * 50 * rng.uniform(0.0001, 1.0))
+    cost = blocks * rng.uniform(0.1, 1.2) + rows * 0.01
+    scan_type = rng.choice(scan_types)
+    if scan_type == "Bitmap Heap Scan":
+        index_scan = _node("Bitmap Index Scan", cost * 0.2, rows, relation=relation)
+        return _node("Bitmap Heap Scan", cost, rows, [index_scan],
+                     relation=relation, tag=23)
+    return _node(scan_type, cost, rows, relation=relation)
+
+def _synthetic_join(rng, join_type, left, right):
+    rows = max(1.0, max(left["Plan Rows"], right["Plan Rows"]) * rng.uniform(0.01, 2.0))
+    cost = left["Total Cost"] + right["Total Cost"] + rows * rng.uniform(0.01, 0.1)
+    if join_type == "Hash Join":
+        right = _node("Hash", right["Total Cost"], right["Plan Rows"], [right])
+    elif join_type == "Merge Join":
+        left = _node("Sort", left["Total Cost"] * 1.2, left["Plan Rows"], [left])
+        right = _node("Sort", right["Total Cost"] * 1.2, right["Plan Rows"], [right])
+    return _node(join_type, cost, rows, [left, right])
+
+def synthetic_query(rng, num_joins, num_arms):
+    """
+    Fixtures for the arms of one synthetic query joining `num_joins` + 1
+    relations: mostly left-deep plans, with an aggregate on top, that differ
+    between arms in their join and scan operators.
+    """
+    relations = rng.choices(_RELATIONS, k=num_joins + 1)
+    name = f"synthetic_{num_joins}_joins_{rng.getrandbits(32):08x}"
+    buffers = {relation: rng.randint(0, blocks) for relation, blocks in _RELATIONS}
+    buffers.update({f"{relation}_pkey": rng.randint(0, max(1, blocks // 10))
+                    for relation, blocks in _RELATIONS})
+
+    fixtures = []
+    for arm_idx in range(num_arms):
+        arm_rng = random.Random(f"{name}/{arm_idx}")
+        join_types = arm_rng.sample(["Hash Join", "Merge Join", "Nested Loop"],
+                                    arm_rng.randint(1, 3))
+        scan_types = arm_rng.sample(["Seq Scan", "Index Scan", "Index Only Scan",
+                                     "Bitmap Heap Scan"], arm_rng.randint(1, 4))
+
+        scans = [_synthetic_scan(arm_rng, relation, blocks, scan_types)
+                 for relation, blocks in relations]
+        plan = scans[0]
+        rest = scans[1:]
+        while rest:
+            if len(rest) >= 2 and arm_rng.random() < 0.15:
+                # a bushy join of two relations
+                right = _synthetic_join(arm_rng, arm_rng.choice(join_types),
+                                        rest[0], rest[1])
+                rest = rest[2:]
+            else:
+                right, rest = rest[0], rest[1:]
+            plan = _synthetic_join(arm_rng, arm_rng.choice(join_types), plan, right)
+
+        plan = _node("Aggregate", plan["Total Cost"] * 1.01, 1.0, [plan])
+        fixtures.append({"query": name, "arm": arm_idx, "plan": {"Plan": plan},
+                         "buffers": buffers, "synthetic": True})
+    return fixtures
+
+def synthetic_fixtures(num_queries, num_arms, seed=0):
+    rng = random.Random(seed)
+    fixtures = []
+    for i in range(num_queries):
+        # 1 to 16 joins, as in the join order benchmark
+        fixtures.extend(synthetic_query(rng, 1 + i % 16, num_arms))
+    return fixtures
+
+def capture_fixtures(sql_paths, out_path):
+    # EXPLAIN each query under each configured arm, see `reg_blocker`
+    import psycopg2
+    import arms
+    from config import read_config
+
+    config = read_config()
+    configured = arms.configured_arms(config)
+    conn = psycopg2.connect(config["PostgreSQLConnectString"])
+    with conn.cursor() as c, open(out_path, "w") as out:
+        c.execute("SET bao_include_json_in_explain TO on")
+        c.execute("SET enable_bao TO on")
+        c.execute("SET enable_bao_selection TO off")
+        for path in sql_paths:
+            with open(path) as f:
+                sql = f.read()
+            for arm_idx, options in configured.items():
+                for stmt in arms.hints(options):
+                    c.execute(stmt)
+                c.execute("EXPLAIN (FORMAT JSON) " + sql)
+                bao_props, _qplan = c.fetchall()[0][0]
+                out.write(json.dumps({
+                    "query": os.path.basename(path), "arm": arm_idx,
+                    "plan": json.loads(bao_props["Bao"]["Bao plan JSON"]),
+                    "buffers": json.loads(bao_props["Bao"]["Bao buffer JSON"]),
+                    "synthetic": False}) + "\n")
+            print("Captured", path)
+    conn.close()
+
+def load_fixtures(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _size_bucket(plan):
+    size = tree_size(plan["Plan"])
+    return next(name for name, limit in SIZE_BUCKETS if size <= limit)
+
+def _queries_by_size(fixtures):
+    # {size bucket: [[fixtures of each arm of a query], ...]}
+    queries = {}
+    for fixture in fixtures:
+        queries.setdefault(fixture["query"], []).append(fixture)
+
+    by_size = {}
+    for arms in queries.values():
+        arms.sort(key=lambda x: x["arm"])
+        by_size.setdefault(_size_bucket(arms[0]["plan"]), []).append(arms)
+    return by_size
+
+def _summary(values):
+    values = np.array(values) * 1000.0
+    return {"mean": float(values.mean()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "min": float(values.min())}
+
+def _wire(plans, buffers):
+    # the messages as the server receives them
+    return [json.dumps(x) for x in plans] + [json.dumps(buffers)]
+
+
+class StageTimer:
+    """
+    Times the stages of the server's own prediction code, by wrapping the
+    functions `BaoModel` calls for each stage while the timer is active.
+    `take` returns the seconds spent in each stage since the last call.
+    """
+    def __init__(self, backend):
+        self.__patches = [(main, "add_buffer_info_to_plans", "attach_buffers"),
+                          (featurize.TreeFeaturizer, "transform", "featurize")]
+        if backend == "torch":
+            import model
+            import net
+            self.__patches += [(net, "prepare_flat_trees", "prepare_trees"),
+                               (net.BaoNet, "forward", "net"),
+                               (model, "_inv_log1p", "inverse_transform")]
+        else:
+            self.__patches += [(np_model, "combine_flat_trees", "prepare_trees"),
+                               (np_model.NumpyBaoNet, "__call__", "net"),
+                               (np_model, "_inv_log1p", "inverse_transform")]
+        self.__originals = []
+        self.__times = collections.defaultdict(float)
+
+    def __wrap(self, fn, stage):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.__times[stage] += time.perf_counter() - start
+        return timed
+
+    def __enter__(self):
+        for owner, name, stage in self.__patches:
+            original = getattr(owner, name)
+            self.__originals.append((owner, name, original))
+            setattr(owner, name, self.__wrap(original, stage))
+        return self
+
+    def __exit__(self, *args):
+        for owner, name, original in reversed(self.__originals):
+            setattr(owner, name, original)
+        self.__originals = []
+
+    def take(self, total):
+        # the stages of a call that took `total` seconds, the time not in
+        # any stage (e.g. selecting the arm) is "other"
+        times = dict(self.__times)
+        self.__times.clear()
+        # the network's call includes preparing the trees
+        if "net" in times:
+            times["forward"] = times.pop("net") - times.get("prepare_trees", 0.0)
+        times["other"] = total - sum(times.values())
+        return times
+
+
+def _time_cases(cases, fn, repeat, timer, warmup=3):
+    # Time `fn` over the cases, cycling through them `repeat` times in all.
+    # Each case is a list of messages as the server receives them, parsed
+    # as the server parses them.
+    for i in range(warmup):
+        fn([json.loads(x) for x in cases[i % len(cases)]])
+    timer.take(0)
+
+    totals = []
+    stages = {}
+    for i in range(repeat):
+        start = time.perf_counter()
+        messages = [json.loads(x) for x in cases[i % len(cases)]]
+        parsed = time.perf_counter()
+        fn(messages)
+        stop = time.perf_counter()
+
+        totals.append(stop - start)
+        times = timer.take(stop - parsed)
+        times["parse"] = parsed - start
+        for name, seconds in times.items():
+            stages.setdefault(name, []).append(seconds)
+    return totals, stages
+
+def run_benchmarks(model_path, fixtures, backend, arm_counts, batch_sizes, repeat):
+    results = []
+    by_size = _queries_by_size(fixtures)
+
+    bao_model = BaoModel(backend)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        bao_model.load_model(model_path, notify_workers=False)
+
+    def record(benchmark, size, cases, totals, stages, **params):
+        nodes = [tree_size(plan["Plan"]) for case in cases
+                 for plan in (json.loads(x) for x in case[:-1])]
+        results.append({"benchmark": benchmark, "backend": backend,
+                        "tree_size": size, "mean_nodes": float(np.mean(nodes)),
+                        **params,
+                        "total_ms": _summary(totals),
+                        "stages_ms": {k: _summary(v) for k, v in stages.items()}})
+        print(f"{benchmark:<14} {size:<7} {json.dumps(params):<20}",
+              f"p50 {results[-1]['total_ms']['p50']:8.3f} ms",
+              f"p95 {results[-1]['total_ms']['p95']:8.3f} ms")
+
+    def reward(messages):
+        plan, buffers = messages
+        plan = add_buffer_info_to_plans(buffers, [plan])[0]
+        storage.record_reward(plan, 100.0, 0)
+
+    with open(os.devnull, "w") as devnull, StageTimer(backend) as timer:
+        def quietly(fn):
+            def run(messages):
+                with contextlib.redirect_stdout(devnull):
+                    return fn(messages)
+            return run
+
+        for size, queries in by_size.items():
+            for num_arms in arm_counts:
+                cases = [_wire([x["plan"] for x in arms[:num_arms]], arms[0]["buffers"])
+                         for arms in queries if len(arms) >= num_arms]
+                if not cases:
+                    continue
+                totals, stages = _time_cases(cases, quietly(bao_model.select_plan),
+                                             repeat, timer)
+                record("select_plan", size, cases, totals, stages, arms=num_arms)
+
+            plans = [(arm["plan"], arm["buffers"]) for arms in queries for arm in arms]
+            cases = [_wire([plan], buffers) for plan, buffers in plans]
+            totals, stages = _time_cases(cases, bao_model.predict, repeat, timer)
+            record("predict", size, cases, totals, stages)
+
+            totals, stages = _time_cases(cases, quietly(reward), repeat, timer)
+            record("record_reward", size, cases, totals, stages)
+
+            for batch_size in batch_sizes:
+                cases = [_wire([plan for plan, _ in plans[i:i + batch_size]],
+                               plans[i][1])
+                         for i in range(0, len(plans) - batch_size + 1, batch_size)]
+                if not cases:
+                    continue
+                totals, stages = _time_cases(cases, bao_model.predict_batch,
+                                             repeat, timer)
+                record("predict_batch", size, cases, totals, stages, batch=batch_size)
+
+    return results
+
+def _train_model(fixtures, path, epochs):
+    # a model for synthetic fixtures, with latencies derived from the plan cost
+    import model
+    rng = random.Random(0)
+    plans = [dict(x["plan"], Buffers=x["buffers"]) for x in fixtures]
+    latencies = [x["plan"]["Plan"]["Total Cost"] / 1000.0 * rng.uniform(0.5, 2.0)
+                 for x in fixtures]
+    reg = model.BaoRegression(have_cache_data=True, max_epochs=epochs)
+    reg.fit(plans, latencies)
+    reg.save(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the Bao server hot path")
+    parser.add_argument("--model", metavar="PATH",
+                        help="Trained model to benchmark (default: train one on the fixtures)")
+    parser.add_argument("--fixtures", metavar="PATH",
+                        help="Plan fixtures (default: synthetic plans)")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="Capture plan fixtures for the SQL files given with --queries to PATH")
+    parser.add_argument("--queries", nargs="+", metavar="SQL",
+                        help="SQL files to capture fixtures for")
+    parser.add_argument("--backend", choices=["torch", "numpy"], default="torch")
+    parser.add_argument("--arms", default="1,5,26",
+                        help="Numbers of arms for select_plan (default 1,5,26)")
+    parser.add_argument("--batch-sizes", default="1,16,64,256",
+                        help="Batch sizes for predict (default 1,16,64,256)")
+    parser.add_argument("--synthetic-queries", type=int, default=64,
+                        help="Number of synthetic queries (default 64)")
+    parser.add_argument("--repeat", type=int, default=30,
+                        help="Timed runs of each benchmark (default 30)")
+    parser.add_argument("--train-epochs", type=int, default=5,
+                        help="Epochs to train a model for, without --model (default 5)")
+    parser.add_argument("--output", metavar="PATH", default="bao_benchmark.json",
+                        help="Where to write the results (default bao_benchmark.json)")
+    args = parser.parse_args()
+
+    if args.capture:
+        capture_fixtures(args.queries or [], args.capture)
+        exit(0)
+
+    arm_counts = [int(x) for x in args.arms.split(",")]
+    batch_sizes = [int(x) for x in args.batch_sizes.split(",")]
+    output = os.path.abspath(args.output)
+
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+        corpus = {"source": os.path.abspath(args.fixtures)}
+    else:
+        fixtures = synthetic_fixtures(args.synthetic_queries, max(arm_counts))
+        corpus = {"source": "synthetic", "queries": args.synthetic_queries, "seed": 0}
+    corpus["plans"] = len(fixtures)
+    corpus["synthetic"] = any(x.get("synthetic") for x in fixtures)
+    model_path = os.path.abspath(args.model) if args.model else None
+
+    # the benchmarks store rewards and read the arm registry, so they run
+    # against a scratch Bao DB
+    with tempfile.TemporaryDirectory(prefix="bao_benchmark_") as scratch:
+        os.chdir(scratch)
+        if model_path is None:
+            try:
+                import model
+            except ImportError:
+                parser.error("training a model needs torch, give a trained model with --model")
+            print("Training a model on the fixtures")
+            model_path = os.path.join(scratch, "model")
+            with contextlib.redirect_stdout(sys.stderr):
+                _train_model(fixtures, model_path, args.train_epochs)
+            model_info = {"source": "trained on the fixtures for benchmarking",
+                          "epochs": args.train_epochs}
+        elif os.path.isdir(model_path):
+            # directory-format models are converted to a model file first
+            import model
+            reg = model.BaoRegression(have_cache_data=True)
+            reg.load(model_path)
+            model_info = {"source": model_path}
+            model_path = os.path.join(scratch, "model")
+            reg.save(model_path)
+        else:
+            model_info = {"source": model_path}
+
+        results = run_benchmarks(model_path, fixtures, args.backend,
+                                 arm_counts, batch_sizes, args.repeat)
+
+    try:
+        import torch
+        torch_version, torch_threads = torch.__version__, torch.get_num_threads()
+    except ImportError:
+        torch_version = torch_threads = None
+
+    with open(output, "w") as f:
+        json.dump({"meta": {"time": time.time(),
+                            "python": platform.python_version(),
+                            "numpy": np.__version__,
+                            "torch": torch_version,
+                            "platform": platform.platform(),
+                            "cpus": os.cpu_count(),
+                            "torch_threads": torch_threads,
+                            "backend": args.backend,
+                            "repeat": args.repeat,
+                            "corpus": corpus,
+                            "model": model_info},
+                   "results": results}, f, indent=2)
+    print("Results written to", output)
@@ -1,19 +1,41 @@
 import sqlite3
 import json
+import os
 import itertools
+import random
+import time
 
 from common import BaoException
+from featurize import compact_plan, get_all_relations, with_leaf_buffer_counts
+
+# the Bao DB files whose schema this process has created or migrated
+_migrated = set()
 
 def _bao_db():
     conn = sqlite3.connect("bao.db")
+    path = os.path.abspath("bao.db")
+    if path not in _migrated:
+        _migrate(conn)
+        _migrated.add(path)
+    return conn
+
+def _migrate(conn):
     c = conn.cursor()
+    # lets evicted experience be returned to the file system bit by bit
+    # (only takes effect on a new database, see `_enable_incremental_vacuum`)
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
     c.execute("""
 CREATE TABLE IF NOT EXISTS experience (
     id INTEGER PRIMARY KEY,
     pg_pid INTEGER,
     plan TEXT, 
-    reward REAL
+    reward REAL,
+    recorded_at REAL,
+    template TEXT,
+    sample_key REAL,
+    censored INTEGER DEFAULT 0
 )""")
+    _add_columns(c)
     c.execute("""
 CREATE TABLE IF NOT EXISTS experimental_query (
     id INTEGER PRIMARY KEY, 
@@ -27,18 +49,80 @@ CREATE TABLE IF NOT EXISTS experience_for_experimental (
     FOREIGN KEY (experience_id) REFERENCES experience(id),
     FOREIGN KEY (experimental_id) REFERENCES experimental_query(id),
     PRIMARY KEY (experience_id, experimental_id, arm_idx)
+)""")
+    c.execute("""
+CREATE TABLE IF NOT EXISTS experiment_prediction (
+    experimental_id INTEGER,
+    arm_idx INTEGER,
+    predicted_reward REAL,
+    from_model INTEGER,
+    plan TEXT,
+    model TEXT,
+    FOREIGN KEY (experimental_id) REFERENCES experimental_query(id),
+    PRIMARY KEY (experimental_id, arm_idx)
+)""")
+    c.execute("""
+CREATE TABLE IF NOT EXISTS arm (
+    arm_idx INTEGER PRIMARY KEY,
+    options TEXT,
+    retired INTEGER DEFAULT 0,
+    selected INTEGER DEFAULT 0,
+    last_selected REAL
 )""")
     conn.commit()
-    return conn
 
-def record_reward(plan, reward, pid):
+def _add_columns(c):
+    # databases created by older versions lack these columns
+    columns = {row[1] for row in c.execute("PRAGMA table_info(experience)")}
+    if "recorded_at" not in columns:
+        c.execute("ALTER TABLE experience ADD COLUMN recorded_at REAL")
+        c.execute("UPDATE experience SET recorded_at = ?", (time.time(),))
+    if "template" not in columns:
+        c.execute("ALTER TABLE experience ADD COLUMN template TEXT")
+    if "sample_key" not in columns:
+        c.execute("ALTER TABLE experience ADD COLUMN sample_key REAL")
+    if "censored" not in columns:
+        c.execute("ALTER TABLE experience ADD COLUMN censored INTEGER DEFAULT 0")
+
+    columns = {row[1] for row in c.execute("PRAGMA table_info(experiment_prediction)")}
+    if columns and "plan" not in columns:
+        c.execute("ALTER TABLE experiment_prediction ADD COLUMN plan TEXT")
+    if columns and "model" not in columns:
+        c.execute("ALTER TABLE experiment_prediction ADD COLUMN model TEXT")
+
+    c.execute("""
+CREATE INDEX IF NOT EXISTS experience_recorded_at ON experience (recorded_at)""")
+    c.execute("""
+CREATE INDEX IF NOT EXISTS experience_template ON experience (template, sample_key)""")
+
+def _plan_template(plan):
+    # Plans for the same query (under any arm) scan the same relations,
+    # which stands in for the query template.
+    return ",".join(sorted(get_all_relations([plan])))
+
+def _stored_plan(plan):
+    # Only the fields used for featurization are kept, and a buffer state
+    # is replaced by the buffer counts of the plan's own relations.
+    return with_leaf_buffer_counts(compact_plan(plan))
+
+def record_reward(plan, reward, pid, censored=False):
+    # A censored reward is a lower bound: the query was cancelled after
+    # running for `reward` milliseconds.
+    plan = _stored_plan(plan)
     with _bao_db() as conn:
         c = conn.cursor()
-        c.execute("INSERT INTO experience (plan, reward, pg_pid) VALUES (?, ?, ?)",
-                  (json.dumps(plan), reward, pid))
+        c.execute("""
+INSERT INTO experience (plan, reward, pg_pid, recorded_at, template, sample_key,
+                        censored)
+VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  (json.dumps(plan), reward, pid, time.time(),
+                   _plan_template(plan), random.random(), int(censored)))
         conn.commit()
 
-    print("Logged reward of", reward)
+    if censored:
+        print("Logged censored reward of at least", reward)
+    else:
+        print("Logged reward of", reward)
 
 def last_reward_from_pid(pid):
     with _bao_db() as conn:
@@ -50,12 +134,61 @@ def last_reward_from_pid(pid):
             return None
         return res[0][0]
 
+def reward_from_pid_after(pid, experience_id):
+    # the first reward from `pid` recorded after `experience_id` (which may
+    # be None, for the start of the experience)
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT min(id) FROM experience WHERE pg_pid = ? AND id > ?
+""", (pid, experience_id if experience_id is not None else -1))
+        return c.fetchone()[0]
+
 def experience():
     with _bao_db() as conn:
         c = conn.cursor()
         c.execute("SELECT plan, reward FROM experience")
         return c.fetchall()
 
+def weighted_experience(experiment_weight=0):
+    # Each experience as (plan, reward, weight, censored). Experience from
+    # experiments on experimental queries gets `experiment_weight` extra
+    # weight per experiment it was recorded for.
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT e.plan, e.reward,
+       (SELECT count(*) FROM experience_for_experimental efe
+        WHERE efe.experience_id = e.id),
+       e.censored
+FROM experience e
+""")
+        return [(plan, reward, 1 + experiment_weight * num_experiments, bool(censored))
+                for plan, reward, num_experiments, censored in c.fetchall()]
+
+def best_experiment_reward(experimental_id):
+    # the lowest uncensored latency of any arm of an experimental query
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT min(e.reward)
+FROM experience_for_experimental efe, experience e
+WHERE efe.experimental_id = ? AND e.id = efe.experience_id AND NOT e.censored
+""", (experimental_id,))
+        return c.fetchone()[0]
+
+def best_experiment_rewards():
+    # `best_experiment_reward` of every experimental query with one
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT efe.experimental_id, min(e.reward)
+FROM experience_for_experimental efe, experience e
+WHERE e.id = efe.experience_id AND NOT e.censored
+GROUP BY efe.experimental_id
+""")
+        return dict(c.fetchall())
+
 def experiment_experience():
     all_experiment_experience = []
     for res in experiment_results():
@@ -64,6 +197,23 @@ def experiment_experience():
         )
     return all_experiment_experience
     
+def experience_since(experience_id, limit=1000):
+    # (id, plan, reward) of uncensored experience recorded after
+    # `experience_id`
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT id, plan, reward FROM experience WHERE id > ? AND NOT censored
+ORDER BY id LIMIT ?""",
+                  (experience_id, limit))
+        return c.fetchall()
+
+def last_experience_id():
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT coalesce(max(id), 0) FROM experience")
+        return c.fetchone()[0]
+
 def experience_size():
     with _bao_db() as conn:
         c = conn.cursor()
@@ -76,6 +226,99 @@ def clear_experience():
         c.execute("DELETE FROM experience")
         conn.commit()
 
+# Experience retention. Without a policy the experience table keeps every
+# reward. The policies bound it by keeping:
+#
+#   window     the `limit` most recent rewards
+#   ttl        rewards recorded in the last `limit` seconds
+#   reservoir  a uniform random sample of `limit` rewards per query template
+#              (the rewards with the smallest random sample keys)
+#
+# Experience from experiments on experimental queries is always kept, as is
+# very recent experience, which exploration may be about to link to an
+# experiment. Eviction deletes a batch of rows at a time, so it never holds
+# the database lock for long.
+
+RETENTION_POLICIES = ["all", "window", "ttl", "reservoir"]
+
+_EVICTION_GRACE_SECONDS = 600
+
+_EVICTABLE = """
+NOT EXISTS (SELECT 1 FROM experience_for_experimental efe
+            WHERE efe.experience_id = e.id)
+AND e.recorded_at < ?
+"""
+
+def _fill_templates(c, batch_size):
+    # templates of experience recorded before retention was added
+    c.execute("SELECT id, plan FROM experience WHERE template IS NULL LIMIT ?",
+              (batch_size,))
+    rows = c.fetchall()
+    c.executemany("UPDATE experience SET template = ?, sample_key = ? WHERE id = ?",
+                  [(_plan_template(json.loads(plan)), random.random(), exp_id)
+                   for exp_id, plan in rows])
+    return len(rows)
+
+def evict_experience(policy, limit, batch_size=1000):
+    """
+    Delete up to `batch_size` rows of experience that `policy` does not
+    retain, returning the number of rows deleted.
+    """
+    if policy not in RETENTION_POLICIES:
+        raise BaoException(f"Unknown experience retention policy: {policy}")
+    if policy == "all":
+        return 0
+
+    grace = time.time() - _EVICTION_GRACE_SECONDS
+    with _bao_db() as conn:
+        c = conn.cursor()
+        if policy == "window":
+            c.execute(f"""
+SELECT id FROM experience e WHERE {_EVICTABLE}
+AND e.id <= (SELECT id FROM experience ORDER BY id DESC LIMIT 1 OFFSET ?)
+LIMIT ?""", (grace, int(limit), batch_size))
+        elif policy == "ttl":
+            c.execute(f"""
+SELECT id FROM experience e WHERE {_EVICTABLE}
+AND e.recorded_at < ?
+LIMIT ?""", (grace, time.time() - limit, batch_size))
+        elif policy == "reservoir":
+            if _fill_templates(c, batch_size):
+                conn.commit()
+            c.execute(f"""
+SELECT e.id FROM (
+    SELECT e.id, ROW_NUMBER() OVER (PARTITION BY e.template
+                                    ORDER BY e.sample_key) AS sample_rank
+    FROM experience e WHERE e.template IS NOT NULL
+) ranked
+JOIN experience e ON e.id = ranked.id
+WHERE ranked.sample_rank > ? AND {_EVICTABLE}
+LIMIT ?""", (int(limit), grace, batch_size))
+
+        evicted = [(row[0],) for row in c.fetchall()]
+        c.executemany("DELETE FROM experience WHERE id = ?", evicted)
+        conn.commit()
+    return len(evicted)
+
+def _enable_incremental_vacuum(c):
+    # An existing database only switches to incremental auto vacuum after
+    # a full VACUUM, done once.
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("Enabling incremental vacuum on bao.db (one-time full VACUUM)")
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+
+def incremental_vacuum(pages=1000):
+    # return up to `pages` free pages to the file system
+    conn = _bao_db()
+    try:
+        c = conn.cursor()
+        _enable_incremental_vacuum(c)
+        c.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+        c.fetchall()
+    finally:
+        conn.close()
+
 def record_experimental_query(sql):
     try:
         with _bao_db() as conn:
@@ -96,34 +339,83 @@ def num_experimental_queries():
         return c.fetchall()[0][0]
     
 def unexecuted_experiments():
+    # the arms to explore are those in the registry, which
+    # `reg_blocker.ExperimentRunner` syncs first
     with _bao_db() as conn:
         c = conn.cursor()
-        c.execute("CREATE TEMP TABLE arms (arm_idx INTEGER)")
-        c.execute("INSERT INTO arms (arm_idx) VALUES (0),(1),(2),(3),(4)")
-
         c.execute("""
-SELECT eq.id, eq.query, arms.arm_idx 
-FROM experimental_query eq, arms
+SELECT eq.id, eq.query, arm.arm_idx 
+FROM experimental_query eq, arm
 LEFT OUTER JOIN experience_for_experimental efe 
-     ON eq.id = efe.experimental_id AND arms.arm_idx = efe.arm_idx
-WHERE efe.experience_id IS NULL
+     ON eq.id = efe.experimental_id AND arm.arm_idx = efe.arm_idx
+WHERE efe.experience_id IS NULL AND NOT arm.retired
 """)
         return [{"id": x[0], "query": x[1], "arm": x[2]}
                 for x in c.fetchall()]
 
+def experiment_predictions():
+    # {(experimental id, arm): (predicted reward, from model, model)}, where
+    # model identifies the model file that made the prediction (None for
+    # cost estimates), see `reg_blocker.ExperimentRunner.explore`
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT experimental_id, arm_idx, predicted_reward, from_model, model
+FROM experiment_prediction""")
+        return {(x[0], x[1]): (x[2], bool(x[3]), x[4]) for x in c.fetchall()}
+
+def experiment_plans():
+    # {(experimental id, arm): plan} of every prediction with a stored plan
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT experimental_id, arm_idx, plan FROM experiment_prediction
+WHERE plan IS NOT NULL""")
+        return {(x[0], x[1]): json.loads(x[2]) for x in c.fetchall()}
+
+def experiment_plan(experimental_id, arm_idx):
+    # the plan an experiment was predicted from, or None
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT plan FROM experiment_prediction WHERE experimental_id = ? AND arm_idx = ?
+""", (experimental_id, arm_idx))
+        res = c.fetchone()
+        return json.loads(res[0]) if res and res[0] else None
+
+def record_experiment_prediction(experimental_id, arm_idx, predicted_reward,
+                                 model, plan):
+    # `model` identifies the model that made the prediction, or is None for
+    # a cost estimate
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+INSERT OR REPLACE INTO experiment_prediction
+    (experimental_id, arm_idx, predicted_reward, from_model, model, plan)
+VALUES (?, ?, ?, ?, ?, ?)""", (experimental_id, arm_idx, predicted_reward,
+                               int(model is not None), model,
+                               json.dumps(_stored_plan(plan))))
+        conn.commit()
+
 def experiment_results():
+    # The reward of a censored experiment is only a lower bound on its
+    # latency, see `record_reward`. Arms missing from the registry (e.g.
+    # before the server first synced it) count as active, so regressions
+    # are never checked against no experiments at all.
     with _bao_db() as conn:
         c = conn.cursor()
         c.execute("""
-SELECT eq.id, e.reward, e.plan, efe.arm_idx
-FROM experimental_query eq, 
-     experience_for_experimental efe, 
-     experience e 
-WHERE eq.id = efe.experimental_id AND e.id = efe.experience_id
+SELECT eq.id, e.reward, e.plan, efe.arm_idx, e.censored
+FROM experimental_query eq
+JOIN experience_for_experimental efe ON eq.id = efe.experimental_id
+JOIN experience e ON e.id = efe.experience_id
+LEFT OUTER JOIN arm ON arm.arm_idx = efe.arm_idx
+WHERE COALESCE(arm.retired, 0) = 0
 ORDER BY eq.id, efe.arm_idx;
 """)
         for eq_id, grp in itertools.groupby(c, key=lambda x: x[0]):
-            yield ({"reward": x[1], "plan": x[2], "arm": x[3]} for x in grp)
+            yield ({"reward": x[1], "plan": x[2], "arm": x[3], "censored": bool(x[4])}
+                   for x in grp)
         
 
 def record_experiment(experimental_id, experience_id, arm_idx):
@@ -135,4 +427,50 @@ VALUES (?, ?, ?)""", (experience_id, experimental_id, arm_idx))
         conn.commit()
 
 
+# The arm registry, see `arms.py`.
+
+def register_arms(arms):
+    # `arms` is {arm index: options}. Arms no longer configured are removed.
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.executemany("""
+INSERT INTO arm (arm_idx, options) VALUES (?, ?)
+ON CONFLICT (arm_idx) DO UPDATE SET options = excluded.options
+""", [(arm_idx, json.dumps(options)) for arm_idx, options in arms.items()])
+        c.execute(f"""
+DELETE FROM arm WHERE arm_idx NOT IN ({",".join("?" * len(arms))})
+""", list(arms))
+        conn.commit()
+
+def arm_registry():
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+SELECT arm_idx, options, retired, selected, last_selected
+FROM arm ORDER BY arm_idx""")
+        return [{"arm": x[0], "options": json.loads(x[1]),
+                 "retired": bool(x[2]), "selected": x[3],
+                 "last_selected": x[4]}
+                for x in c.fetchall()]
+
+def set_arm_retired(arm_idx, retired):
+    # returns false if the arm is not in the registry
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE arm SET retired = ? WHERE arm_idx = ?",
+                  (int(retired), arm_idx))
+        conn.commit()
+        return c.rowcount > 0
+
+def record_arm_selections(counts):
+    # `counts` is {arm index: number of times the server selected it}
+    now = time.time()
+    with _bao_db() as conn:
+        c = conn.cursor()
+        c.executemany("""
+UPDATE arm SET selected = selected + ?, last_selected = ?
+WHERE arm_idx = ?""", [(count, now, arm_idx)
+                       for arm_idx, count in counts.items()])
+        conn.commit()
+
 # select eq.id, efe.arm_idx, min(e.reward) from experimental_query eq, experience_for_experimental efe, experience e WHERE eq.id = efe.experimental_id AND e.id = efe.experience_id GROUP BY eq.id;
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+import arms
+import storage
+from common import BaoException
+
+class TestConfiguredArms(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(arms.configured_arms({}),
+                         dict(enumerate(arms.DEFAULT_ARMS[:5])))
+        self.assertEqual(len(arms.configured_arms({"Arms": "26"})), 26)
+
+    def test_redefined_arm(self):
+        configured = arms.configured_arms({"Arms": "3",
+                                           "Arm1": "enable_hashjoin, enable_seqscan"})
+        self.assertEqual(configured[1], ["enable_hashjoin", "enable_seqscan"])
+        self.assertEqual(configured[2], arms.DEFAULT_ARMS[2])
+
+    def test_no_definition(self):
+        with self.assertRaises(BaoException):
+            arms.configured_arms({"Arms": str(len(arms.DEFAULT_ARMS) + 1)})
+
+    def test_unknown_option(self):
+        with self.assertRaises(BaoException):
+            arms.configured_arms({"Arm0": "enable_hashjoin, enable_bitmapscan"})
+
+    def test_hints(self):
+        # every option is turned off, then the arm's options back on
+        stmts = arms.hints(["enable_hashjoin"])
+        self.assertEqual(stmts[:len(arms.OPTIONS)],
+                         [f"SET {x} TO off" for x in arms.OPTIONS])
+        self.assertEqual(stmts[len(arms.OPTIONS):], ["SET enable_hashjoin TO on"])
+
+class TestRegistry(unittest.TestCase):
+    # runs in a scratch directory, with its own bao.db
+
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        self.__scratch = tempfile.TemporaryDirectory()
+        os.chdir(self.__scratch.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__scratch.cleanup()
+
+    def test_sync(self):
+        self.assertEqual(arms.sync_registry({"Arms": "3"}),
+                         dict(enumerate(arms.DEFAULT_ARMS[:3])))
+        self.assertEqual([x["arm"] for x in storage.arm_registry()], [0, 1, 2])
+
+        # arms no longer configured are removed, redefined arms updated
+        active = arms.sync_registry({"Arms": "2", "Arm1": "enable_nestloop"})
+        self.assertEqual(active, {0: arms.DEFAULT_ARMS[0], 1: ["enable_nestloop"]})
+        self.assertEqual([x["arm"] for x in storage.arm_registry()], [0, 1])
+
+    def test_sync_keeps_state(self):
+        arms.sync_registry({"Arms": "3"})
+        arms.retire(1)
+        storage.record_arm_selections({0: 4, 2: 1})
+
+        self.assertEqual(list(arms.sync_registry({"Arms": "4"})), [0, 2, 3])
+        registry = {x["arm"]: x for x in storage.arm_registry()}
+        self.assertTrue(registry[1]["retired"])
+        self.assertEqual([registry[x]["selected"] for x in range(4)], [4, 0, 1, 0])
+        self.assertIsNotNone(registry[0]["last_selected"])
+        self.assertIsNone(registry[3]["last_selected"])
+
+    def test_retire(self):
+        arms.sync_registry({"Arms": "3"})
+        arms.retire(2)
+        self.assertEqual(list(arms.sync_registry({"Arms": "3"})), [0, 1])
+
+        # a retired arm can be restored
+        arms.retire(2, retired=False)
+        self.assertEqual(list(arms.sync_registry({"Arms": "3"})), [0, 1, 2])
+
+    def test_retire_default_optimizer(self):
+        arms.sync_registry({"Arms": "3"})
+        with self.assertRaises(BaoException):
+            arms.retire(0)
+        # restoring arm 0 is allowed, and does nothing
+        arms.retire(0, retired=False)
+        self.assertFalse(storage.arm_registry()[0]["retired"])
+
+    def test_retire_unknown_arm(self):
+        arms.sync_registry({"Arms": "3"})
+        with self.assertRaises(BaoException):
+            arms.retire(3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from buffers import BufferStateCache
+from common import BaoException
+
+COUNTS = {"title": 1200, "name": 33, "title_pkey": 7}
+
+class TestBufferStateCache(unittest.TestCase):
+
+    def test_versions(self):
+        cache = BufferStateCache()
+        version = cache.put(dict(COUNTS))
+        self.assertEqual(cache.resolve({"Buffer Version": version}), COUNTS)
+
+        # versions come from the contents, not the order they are stored in
+        self.assertEqual(BufferStateCache().put(dict(reversed(COUNTS.items()))), version)
+        self.assertNotEqual(cache.put(dict(COUNTS, name=34)), version)
+
+        # full snapshots are used as they are
+        self.assertEqual(cache.resolve(COUNTS), COUNTS)
+
+    def test_deltas(self):
+        cache = BufferStateCache()
+        base = cache.put(dict(COUNTS))
+        delta = {"Buffer Delta": {"name": 40, "title_pkey": 0, "movie_info": 5},
+                 "Base Version": base}
+        self.assertEqual(cache.resolve(delta),
+                         {"title": 1200, "name": 40, "movie_info": 5})
+
+        # the base snapshot is unchanged
+        self.assertEqual(cache.resolve({"Buffer Version": base}), COUNTS)
+
+        # a delta can be stored as a new snapshot
+        version = cache.put(delta)
+        self.assertEqual(cache.resolve({"Buffer Version": version}),
+                         {"title": 1200, "name": 40, "movie_info": 5})
+
+    def test_unknown_version(self):
+        cache = BufferStateCache()
+        with self.assertRaises(BaoException):
+            cache.resolve({"Buffer Version": 12345})
+        with self.assertRaises(BaoException):
+            cache.resolve({"Buffer Delta": {"name": 1}, "Base Version": 12345})
+
+    def test_eviction(self):
+        cache = BufferStateCache(capacity=2)
+        first = cache.put({"title": 1})
+        second = cache.put({"title": 2})
+
+        # using a snapshot makes it the most recent one
+        cache.resolve({"Buffer Version": first})
+        cache.put({"title": 3})
+
+        self.assertEqual(cache.resolve({"Buffer Version": first}), {"title": 1})
+        with self.assertRaises(BaoException):
+            cache.resolve({"Buffer Version": second})
+
+    def test_shared_dir(self):
+        with tempfile.TemporaryDirectory() as shared_dir:
+            worker1 = BufferStateCache(capacity=2, shared_dir=shared_dir)
+            worker2 = BufferStateCache(capacity=2, shared_dir=shared_dir)
+
+            # a snapshot stored by one worker can be used by another
+            version = worker1.put(dict(COUNTS))
+            self.assertEqual(worker2.resolve({"Buffer Version": version}), COUNTS)
+
+            # the directory keeps as many snapshots as a worker does
+            for i in range(5):
+                worker1.put({"title": i})
+            self.assertEqual(len(os.listdir(shared_dir)), 2)
+            with self.assertRaises(BaoException):
+                BufferStateCache(shared_dir=shared_dir).resolve({"Buffer Version": version})
+
+if __name__ == '__main__':
+    unittest.main()
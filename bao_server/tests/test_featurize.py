@@ -0,0 +1,171 @@
+import copy
+import unittest
+from multiprocessing import shared_memory
+import numpy as np
+
+import featurize
+from featurize import TreeBuilder, TreeBuilderError
+from TreeConvolution.util import _flatten, _tree_conv_indexes
+
+def _scan(node_type, cost, rows, **fields):
+    return {"Node Type": node_type, "Total Cost": cost, "Plan Rows": rows, **fields}
+
+def _node(node_type, cost, rows, *children, **fields):
+    return {"Node Type": node_type, "Total Cost": cost, "Plan Rows": rows,
+            "Plans": list(children), **fields}
+
+# plans shaped like PostgreSQL's EXPLAIN output: single-child nodes (Hash,
+# Sort, Aggregate, Bitmap Heap Scan, ...) above joins and scans, bitmap
+# index scans known only by their index name, and buffer state maps
+PLANS = [
+    {"Plan": _node("Aggregate", 5103.2, 1,
+                   _node("Hash Join", 5100.7, 980,
+                         _scan("Seq Scan", 2300.0, 120000, **{"Relation Name": "title"}),
+                         _node("Hash", 410.5, 75,
+                               _node("Bitmap Heap Scan", 410.5, 75,
+                                     _scan("Bitmap Index Scan", 4.6, 75,
+                                           **{"Index Name": "movie_keyword_idx_kid"}),
+                                     **{"Relation Name": "movie_keyword"})))),
+     "Buffers": {"title": 1200, "movie_keyword": 33, "movie_keyword_idx_kid": 7}},
+    {"Plan": _node("Sort", 88.1, 20,
+                   _node("Nested Loop", 87.9, 20,
+                         _node("Merge Join", 60.0, 10,
+                               _scan("Index Scan", 30.2, 400,
+                                     **{"Relation Name": "cast_info",
+                                        "Index Name": "cast_info_pkey"}),
+                               _node("Sort", 25.0, 300,
+                                     _scan("Seq Scan", 20.0, 300,
+                                           **{"Relation Name": "name"}))),
+                         _scan("Index Only Scan", 2.1, 2,
+                               **{"Relation Name": "title", "Index Name": "title_pkey"}))),
+     "Buffers": {"cast_info": 5000, "cast_info_pkey": 90, "name": 0}},
+    {"Plan": _scan("Seq Scan", 12.5, 3, **{"Relation Name": "name"})},
+]
+
+class TestPlanToArrays(unittest.TestCase):
+
+    def setUp(self):
+        # the plans as `TreeFeaturizer.fit` sees them, with leaf buffer counts
+        self.__attached = copy.deepcopy(PLANS)
+        for plan in self.__attached:
+            featurize._attach_buf_data(plan)
+
+        self.__builder = TreeBuilder(featurize.get_plan_stats(self.__attached),
+                                     featurize.get_all_relations(self.__attached))
+
+    def test_matches_feature_tree(self):
+        for plan, attached in zip(PLANS, self.__attached):
+            tree = self.__builder.plan_to_feature_tree(attached["Plan"])
+            expected_vecs = _flatten(tree, featurize.features,
+                                     featurize.left_child, featurize.right_child)
+            expected_indexes = _tree_conv_indexes(tree, featurize.left_child,
+                                                  featurize.right_child)
+
+            # leaf buffer counts read from the buffer state, or already attached
+            for source, buffers in ((plan, plan.get("Buffers")), (attached, None)):
+                vecs, indexes = self.__builder.plan_to_arrays(source["Plan"], buffers)
+                np.testing.assert_allclose(vecs, expected_vecs)
+                np.testing.assert_array_equal(indexes, expected_indexes)
+                self.assertEqual(len(vecs), featurize.tree_size(plan["Plan"]) + 1)
+
+    def test_buffer_counts(self):
+        # the bitmap index scan has buffers, so its buffer column is not zero
+        vecs, _ = self.__builder.plan_to_arrays(PLANS[0]["Plan"], PLANS[0]["Buffers"])
+        buffers = self.__builder.stats().fields().index("Buffers") + len(featurize.ALL_TYPES)
+        self.assertGreater(vecs[-1, buffers], 0)
+
+    def test_unknown_node(self):
+        plan = _node("BitmapAnd", 10.0, 5,
+                     _scan("Bitmap Index Scan", 4.6, 75,
+                           **{"Index Name": "movie_keyword_idx_kid"}),
+                     _scan("Bitmap Index Scan", 4.6, 75,
+                           **{"Index Name": "movie_keyword_idx_kid"}))
+        with self.assertRaises(TreeBuilderError):
+            self.__builder.plan_to_feature_tree(plan)
+        with self.assertRaises(TreeBuilderError):
+            self.__builder.plan_to_arrays(plan)
+
+class TestFeaturizerPool(unittest.TestCase):
+
+    def setUp(self):
+        # a pool of two processes for as few as four plans
+        self.__min_plans = featurize._MIN_PLANS_PER_WORKER
+        featurize._MIN_PLANS_PER_WORKER = 2
+
+        self.__shared = []
+        self.__shared_array = featurize._shared_array
+        def shared_array(shape, dtype):
+            mem = self.__shared_array(shape, dtype)
+            self.__shared.append(mem.name)
+            return mem
+        featurize._shared_array = shared_array
+
+    def tearDown(self):
+        featurize._MIN_PLANS_PER_WORKER = self.__min_plans
+        featurize._shared_array = self.__shared_array
+
+    def __fit_transform(self, workers):
+        plans = copy.deepcopy(PLANS * 2)
+        featurizer = featurize.TreeFeaturizer()
+        featurizer.fit(copy.deepcopy(plans), workers=workers)
+        return featurizer.export(), featurizer.transform(plans, workers=workers)
+
+    def test_matches_serial(self):
+        serial_state, serial = self.__fit_transform(1)
+        self.assertEqual(self.__shared, [])
+
+        pool_state, pooled = self.__fit_transform(2)
+        self.assertEqual(len(self.__shared), 2)
+
+        self.assertEqual(sorted(pool_state["relations"]), sorted(serial_state["relations"]))
+        self.assertEqual(pool_state["index_relations"], serial_state["index_relations"])
+        self.assertEqual(pool_state["stat_fields"], serial_state["stat_fields"])
+        np.testing.assert_allclose(pool_state["stat_mins"], serial_state["stat_mins"])
+        np.testing.assert_allclose(pool_state["stat_maxs"], serial_state["stat_maxs"])
+
+        self.assertEqual(len(pooled), len(serial))
+        for (vecs, indexes), (expected_vecs, expected_indexes) in zip(pooled, serial):
+            np.testing.assert_allclose(vecs, expected_vecs)
+            np.testing.assert_array_equal(indexes, expected_indexes)
+
+        # the shared memory is released once the arrays are copied out
+        for name in self.__shared:
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name=name)
+
+class TestPlanKey(unittest.TestCase):
+
+    def key(self, plan=PLANS[0], **buffers):
+        plan = copy.deepcopy(plan)
+        plan["Buffers"].update(buffers)
+        return featurize.plan_key(plan)
+
+    def test_distinct_plans(self):
+        keys = [featurize.plan_key(copy.deepcopy(plan)) for plan in PLANS]
+        self.assertEqual(len(set(keys)), len(PLANS))
+
+    def test_buffer_buckets(self):
+        # 1200 buffers of title, in the bucket [1024, 2048)
+        self.assertEqual(self.key(), self.key(title=1024))
+        self.assertEqual(self.key(), self.key(title=2047))
+        self.assertNotEqual(self.key(), self.key(title=2048))
+        self.assertNotEqual(self.key(), self.key(title=0))
+        # index buffers count towards their leaf
+        self.assertNotEqual(self.key(), self.key(movie_keyword_idx_kid=100))
+        # relations outside the plan do not count
+        self.assertEqual(self.key(), self.key(cast_info=10 ** 6))
+
+    def test_leaf_buffer_counts(self):
+        # a stored plan, with buffer counts on its leaves, has the key of
+        # the plan with the buffer state
+        for plan in PLANS[:2]:
+            stored = featurize.with_leaf_buffer_counts(copy.deepcopy(plan))
+            self.assertEqual(featurize.plan_key(plan), featurize.plan_key(stored))
+
+    def test_costs(self):
+        plan = copy.deepcopy(PLANS[0])
+        plan["Plan"]["Total Cost"] += 1
+        self.assertNotEqual(self.key(), featurize.plan_key(plan))
+
+if __name__ == '__main__':
+    unittest.main()
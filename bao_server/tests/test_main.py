@@ -0,0 +1,237 @@
+import contextlib
+import grp
+import io
+import json
+import math
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import types
+import unittest
+
+import serving_benchmark
+import main
+import storage
+from buffers import BufferStateCache
+
+def _backends():
+    try:
+        import torch
+        return ["numpy", "torch"]
+    except ImportError:
+        return ["numpy"]
+
+class ServerTestCase(unittest.TestCase):
+    # runs in a scratch directory with the repository's bao.cfg, and a
+    # model trained for one epoch on synthetic plans at "model"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch = tempfile.TemporaryDirectory()
+        shutil.copy(os.path.join(os.path.dirname(main.__file__), "bao.cfg"),
+                    cls.scratch.name)
+        cls.fixtures = serving_benchmark.synthetic_fixtures(8, 3)
+
+        cwd = os.getcwd()
+        os.chdir(cls.scratch.name)
+        try:
+            import model
+        except ImportError:
+            raise unittest.SkipTest("training a model needs torch")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                serving_benchmark._train_model(cls.fixtures, "model", epochs=1)
+        finally:
+            os.chdir(cwd)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.scratch.cleanup()
+
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        os.chdir(self.scratch.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+
+    def load(self, backend, shared_state=None, path="model"):
+        bao_model = main.BaoModel(backend, "float32", shared_state)
+        with contextlib.redirect_stdout(io.StringIO()):
+            bao_model.load_model(path, notify_workers=False)
+        return bao_model
+
+class TestPredictBatch(ServerTestCase):
+
+    def test_matches_predict(self):
+        # a batch predicts each plan as a `predict` message does, up to
+        # float32 rounding
+        for backend in _backends():
+            bao_model = self.load(backend)
+            plans = [x["plan"] for x in self.fixtures]
+            buffers = self.fixtures[0]["buffers"]
+
+            single = [bao_model.predict([dict(p), buffers]) for p in plans]
+            batch = bao_model.predict_batch([dict(p) for p in plans] + [buffers])
+            for s, b in zip(single, batch):
+                self.assertAlmostEqual(s, b, delta=abs(s) * 1e-4)
+
+            # per-plan buffer states
+            per_plan = bao_model.predict_batch([dict(x["plan"], Buffers=x["buffers"])
+                                                for x in self.fixtures])
+            for x, b in zip(self.fixtures, per_plan):
+                s = bao_model.predict([dict(x["plan"]), x["buffers"]])
+                self.assertAlmostEqual(s, b, delta=abs(s) * 1e-4)
+
+    def test_message(self):
+        bao_model = self.load("numpy")
+        buffer_cache = BufferStateCache()
+        server = types.SimpleNamespace(bao_model=bao_model, buffer_cache=buffer_cache,
+                                       traffic_recorder=None)
+        buffers = self.fixtures[0]["buffers"]
+        version = buffer_cache.put(buffers)
+        plans = [x["plan"] for x in self.fixtures]
+
+        # every message in one write, so the handler reads many per recv()
+        client, request = socket.socketpair()
+        with client, request:
+            messages = ([{"type": "predict batch"}] + plans
+                        + [{"Buffer Version": version}, {"final": True}])
+            client.sendall("".join(json.dumps(x) + "\n" for x in messages).encode("UTF-8"))
+            client.shutdown(socket.SHUT_WR)
+            main.BaoJSONHandler(request, None, server)
+
+            response = b""
+            while data := client.recv(4096):
+                response += data
+
+        count = struct.unpack("I", response[:4])[0]
+        self.assertEqual(count, len(plans))
+        predictions = struct.unpack(f"{count}d", response[4:])
+        expected = bao_model.predict_batch([dict(p) for p in plans] + [buffers])
+        self.assertEqual(list(predictions), expected)
+
+class TestSharedModel(ServerTestCase):
+
+    def test_coordinated_reload(self):
+        shared_state = main.SharedModelState()
+        worker1 = main.BaoModel("numpy", "float32", shared_state)
+        worker2 = main.BaoModel("numpy", "float32", shared_state)
+        plan = [dict(self.fixtures[0]["plan"]), self.fixtures[0]["buffers"]]
+        self.assertTrue(math.isnan(worker2.predict(list(plan))))
+
+        # a model loaded by one worker is published to the others
+        with contextlib.redirect_stdout(io.StringIO()):
+            worker1.load_model("model")
+            worker2.sync()
+        self.assertEqual(worker1.model_version(), 1)
+        self.assertEqual(worker2.model_version(), 1)
+        prediction = worker1.predict(list(plan))
+        self.assertEqual(worker2.predict(list(plan)), prediction)
+
+        # a published model that cannot be loaded is skipped, and the
+        # worker keeps serving the model it has
+        shared_state.publish("missing_model")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            worker2.sync()
+            worker2.sync()
+        self.assertEqual(out.getvalue().count("Failed to load"), 1)
+        self.assertEqual(worker2.predict(list(plan)), prediction)
+
+class TestRewardMessage(unittest.TestCase):
+
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        self.__scratch = tempfile.TemporaryDirectory()
+        os.chdir(self.__scratch.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__scratch.cleanup()
+
+    def __send(self, buffer_cache, buffers):
+        server = types.SimpleNamespace(bao_model=types.SimpleNamespace(sync=lambda: None),
+                                       buffer_cache=buffer_cache, traffic_recorder=None)
+        plan = {"Plan": {"Node Type": "Seq Scan", "Relation Name": "title",
+                         "Total Cost": 100.0, "Plan Rows": 1000}}
+        client, request = socket.socketpair()
+        with client, request:
+            messages = [{"type": "reward"}, plan, buffers,
+                        {"reward": 12.5, "pid": 7}, {"final": True}]
+            client.sendall("".join(json.dumps(x) + "\n" for x in messages).encode("UTF-8"))
+            client.shutdown(socket.SHUT_WR)
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.BaoJSONHandler(request, None, server)
+
+        rows = storage.experience()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1], 12.5)
+        return json.loads(rows[0][0])["Plan"]
+
+    def test_buffer_version(self):
+        buffer_cache = BufferStateCache()
+        version = buffer_cache.put({"title": 1200, "name": 33})
+        plan = self.__send(buffer_cache, {"Buffer Version": version})
+        self.assertEqual(plan["Buffers"], 1200)
+
+    def test_unknown_buffer_version(self):
+        # the reward is kept, without buffer counts
+        plan = self.__send(BufferStateCache(), {"Buffer Version": 12345})
+        self.assertNotIn("Buffers", plan)
+
+class TestUnixSocket(unittest.TestCase):
+
+    def test_bind(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "bao.sock")
+            # a socket file left behind by a previous server is replaced
+            open(path, "w").close()
+
+            group = grp.getgrgid(os.getgid()).gr_name
+            with main.bind_unix_socket(path, 0o660, group) as listen_socket:
+                stat = os.stat(path)
+                self.assertEqual(stat.st_mode & 0o777, 0o660)
+                self.assertEqual(stat.st_gid, os.getgid())
+
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(path)
+
+class RecordingHandler(main.JSONTCPHandler):
+    def setup(self):
+        self.messages = []
+
+    def handle_json(self, data):
+        self.messages.append(data)
+        return "final" in data
+
+class TestJSONTCPHandler(unittest.TestCase):
+
+    def __handle(self, chunks):
+        client, request = socket.socketpair()
+        with client, request:
+            for chunk in chunks:
+                client.sendall(chunk.encode("UTF-8"))
+            client.shutdown(socket.SHUT_WR)
+            return RecordingHandler(request, None, None).messages
+
+    def test_many_messages_per_read(self):
+        messages = [{"type": "predict batch"}] + [{"i": i} for i in range(50)]
+        text = "".join(json.dumps(x) + "\n" for x in messages + [{"final": True}])
+        self.assertEqual(self.__handle([text]), messages + [{"final": True}])
+
+    def test_split_messages(self):
+        # a message longer than one read, and one split across two writes
+        long_message = {"data": "x" * 5000}
+        self.assertEqual(self.__handle([json.dumps(long_message) + "\n" + '{"a"',
+                                        ': 1}\n\n{"final": true}\n']),
+                         [long_message, {"a": 1}, {"final": True}])
+
+    def test_stops_at_final(self):
+        text = '{"a": 1}\n{"final": true}\n{"b": 2}\n'
+        self.assertEqual(self.__handle([text]), [{"a": 1}, {"final": True}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import serving_benchmark
+import model_file
+from common import BaoException
+
+TENSORS = {"a": np.arange(10, dtype=np.float32),
+           "b": np.arange(12, dtype=np.int64).reshape(3, 4),
+           "c": np.array([1.5], dtype=np.float64)}
+METADATA = {"n": 3, "relations": ["title", "name"]}
+
+class ModelFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.__scratch = tempfile.TemporaryDirectory()
+        self.dir = self.__scratch.name
+
+    def tearDown(self):
+        self.__scratch.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def assertTensorsEqual(self, expected, actual):
+        self.assertEqual(set(expected), set(actual))
+        for name, arr in expected.items():
+            self.assertEqual(arr.dtype, actual[name].dtype)
+            np.testing.assert_array_equal(arr, actual[name])
+
+class TestRoundTrip(ModelFileTestCase):
+
+    def test_mmap(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        metadata, tensors = model_file.read(self.path("m"))
+        self.assertEqual(METADATA, metadata)
+        self.assertTensorsEqual(TENSORS, tensors)
+
+        # views into the read-only memory map, not copies
+        for arr in tensors.values():
+            self.assertIsInstance(arr.base, np.memmap)
+            self.assertFalse(arr.flags.writeable)
+
+    def test_no_mmap(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        metadata, tensors = model_file.read(self.path("m"), mmap=False)
+        self.assertEqual(METADATA, metadata)
+        self.assertTensorsEqual(TENSORS, tensors)
+        for arr in tensors.values():
+            self.assertNotIsInstance(arr.base, np.memmap)
+
+    def test_no_tmp_file_left(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        self.assertEqual(["m"], os.listdir(self.dir))
+
+    def test_alignment(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        _, tensors = model_file.read(self.path("m"))
+        for arr in tensors.values():
+            self.assertEqual(0, arr.__array_interface__["data"][0] % 64)
+        self.assertEqual(0, os.path.getsize(self.path("m")) % 64)
+
+    def test_bad_magic(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        with open(self.path("m"), "r+b") as f:
+            f.write(b"NOTAMODL")
+        with self.assertRaises(BaoException):
+            model_file.read(self.path("m"))
+
+    def test_bad_version(self):
+        model_file.write(self.path("m"), METADATA, TENSORS)
+        with open(self.path("m"), "r+b") as f:
+            f.seek(len(model_file.MAGIC))
+            f.write((model_file.FORMAT_VERSION + 1).to_bytes(4, "little"))
+        with self.assertRaises(BaoException):
+            model_file.read(self.path("m"))
+
+class TestPublish(ModelFileTestCase):
+
+    def test_first_model(self):
+        model_file.write(self.path("new"), {"n": 1}, TENSORS)
+        model_file.publish(self.path("new"), self.path("current"),
+                           self.path("previous"))
+        self.assertEqual({"n": 1}, model_file.read(self.path("current"))[0])
+        self.assertFalse(os.path.exists(self.path("new")))
+        self.assertFalse(os.path.exists(self.path("previous")))
+
+    def test_keeps_previous(self):
+        model_file.write(self.path("current"), {"n": 1}, TENSORS)
+        model_file.write(self.path("previous"), {"n": 0}, TENSORS)
+
+        # a reader holding the current model keeps its version
+        _, held = model_file.read(self.path("current"))
+        inode = os.stat(self.path("current")).st_ino
+
+        model_file.write(self.path("new"), {"n": 2}, {"a": TENSORS["a"] * 2})
+        model_file.publish(self.path("new"), self.path("current"),
+                           self.path("previous"))
+
+        self.assertEqual({"n": 2}, model_file.read(self.path("current"))[0])
+        self.assertEqual({"n": 1}, model_file.read(self.path("previous"))[0])
+        # the previous model is the old file itself, not a copy
+        self.assertEqual(inode, os.stat(self.path("previous")).st_ino)
+        self.assertFalse(os.path.exists(self.path("new")))
+        self.assertTensorsEqual(TENSORS, held)
+
+    def test_directory_model(self):
+        os.mkdir(self.path("current"))
+        with open(os.path.join(self.path("current"), "n"), "w") as f:
+            f.write("old")
+
+        model_file.write(self.path("new"), {"n": 2}, TENSORS)
+        model_file.publish(self.path("new"), self.path("current"),
+                           self.path("previous"))
+
+        self.assertEqual({"n": 2}, model_file.read(self.path("current"))[0])
+        self.assertTrue(os.path.isdir(self.path("previous")))
+
+class TestBaoRegression(ModelFileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        try:
+            import model
+        except ImportError:
+            raise unittest.SkipTest("training a model needs torch")
+
+        self.fixtures = serving_benchmark.synthetic_fixtures(8, 3)
+        self.plans = [dict(x["plan"], Buffers=x["buffers"])
+                      for x in self.fixtures]
+        with contextlib.redirect_stdout(io.StringIO()):
+            serving_benchmark._train_model(self.fixtures, self.path("model"),
+                                           epochs=1)
+
+    def load(self, path):
+        import model
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.load(path)
+        return reg
+
+    def write_directory_model(self, path):
+        # the same model in the directory format written before model files
+        import joblib
+        import torch
+        from sklearn import preprocessing
+        from sklearn.pipeline import Pipeline
+        import model
+        import net
+
+        metadata, tensors = model_file.read(self.path("model"), mmap=False)
+        bao_net = net.BaoNet(metadata["in_channels"])
+        bao_net.load_state_dict({k: torch.from_numpy(np.array(v))
+                                 for k, v in model_file.net_arrays(tensors).items()})
+
+        scaler = preprocessing.MinMaxScaler()
+        scaler.min_, scaler.scale_ = model_file.y_transform(tensors)
+        pipeline = Pipeline([("log", preprocessing.FunctionTransformer(
+                                np.log1p, model._inv_log1p, validate=True)),
+                             ("scale", scaler)])
+
+        os.mkdir(path)
+        torch.save(bao_net.state_dict(), model._nn_path(path))
+        joblib.dump(metadata["n"], model._n_path(path))
+        joblib.dump(metadata["in_channels"], model._channels_path(path))
+        joblib.dump(pipeline, model._y_transform_path(path))
+        joblib.dump(model_file.featurizer(metadata, tensors),
+                    model._x_transform_path(path))
+
+    def test_save_load(self):
+        reg = self.load(self.path("model"))
+        reg.save(self.path("saved"))
+        np.testing.assert_array_equal(reg.predict(self.plans),
+                                      self.load(self.path("saved")).predict(self.plans))
+
+    def test_convert_directory_model(self):
+        import model
+        expected = self.load(self.path("model")).predict(self.plans)
+
+        self.write_directory_model(self.path("old"))
+        np.testing.assert_allclose(expected,
+                                   self.load(self.path("old")).predict(self.plans),
+                                   rtol=1e-6)
+
+        model.convert_directory_model(self.path("old"))
+        self.assertTrue(os.path.isfile(self.path("old")))
+        self.assertFalse(os.path.exists(self.path("old") + ".converted"))
+        np.testing.assert_allclose(expected,
+                                   self.load(self.path("old")).predict(self.plans),
+                                   rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+
+import reg_blocker
+import storage
+
+CONFIG = """[bao]
+MaxQueryTimeSeconds = 120
+"""
+
+def _plan(relation):
+    return {"Plan": {"Node Type": "Seq Scan", "Relation Name": relation,
+                     "Total Cost": 10.0, "Plan Rows": 100}}
+
+class ArmModel:
+    # selects the plan that scans `relation`
+    def __init__(self, relation):
+        self.__relation = relation
+
+    def predict(self, plans):
+        return np.array([[0.0 if json.loads(x)["Plan"]["Relation Name"] == self.__relation
+                          else 1.0] for x in plans])
+
+class TestRegressions(unittest.TestCase):
+
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        self.__scratch = tempfile.TemporaryDirectory()
+        os.chdir(self.__scratch.name)
+        with open("bao.cfg", "w") as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__scratch.cleanup()
+
+    def __experiment(self, experimental_id, arm_idx, relation, reward, censored=False):
+        storage.record_reward(_plan(relation), reward, 1, censored=censored)
+        storage.record_experiment(experimental_id, storage.last_reward_from_pid(1), arm_idx)
+
+    def test_censored_arm(self):
+        # arm 1 was cut off after 4 times the 1s of arm 0
+        storage.record_experimental_query("SELECT 1")
+        self.__experiment(1, 0, "title", 1000)
+        self.__experiment(1, 1, "name", 4000, censored=True)
+
+        results = [list(x) for x in storage.experiment_results()]
+        self.assertEqual([x["censored"] for x in results[0]], [False, True])
+
+        self.assertEqual(reg_blocker.compute_regressions(None), (0, 0))
+        self.assertEqual(reg_blocker.compute_regressions(ArmModel("title")), (0, 0))
+
+        # selecting the censored arm costs as much as a query that hit the limit
+        self.assertEqual(reg_blocker.compute_regressions(ArmModel("name")),
+                         (1, 2 * 120 * 1000 - 1000))
+        self.assertFalse(reg_blocker.should_replace_model(None, ArmModel("name")))
+
+    def test_uncensored_arm(self):
+        storage.record_experimental_query("SELECT 1")
+        self.__experiment(1, 0, "title", 1000)
+        self.__experiment(1, 1, "name", 4000)
+
+        self.assertEqual(reg_blocker.compute_regressions(ArmModel("name")), (1, 3000))
+        self.assertEqual(reg_blocker.compute_regressions(ArmModel("title")), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import serving_benchmark
+from featurize import tree_size
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        # the benchmarks write to bao.db in the working directory, and read
+        # bao.cfg from it
+        self.__cwd = os.getcwd()
+        self.__scratch = tempfile.TemporaryDirectory()
+        shutil.copy(os.path.join(os.path.dirname(serving_benchmark.__file__), "bao.cfg"),
+                    self.__scratch.name)
+        os.chdir(self.__scratch.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__scratch.cleanup()
+
+    def test_synthetic_fixtures(self):
+        fixtures = serving_benchmark.synthetic_fixtures(16, 3)
+        self.assertEqual(len(fixtures), 16 * 3)
+        self.assertEqual(fixtures, serving_benchmark.synthetic_fixtures(16, 3))
+
+        sizes = {serving_benchmark._size_bucket(x["plan"]) for x in fixtures}
+        self.assertEqual(sizes, {"small", "medium", "large"})
+        for fixture in fixtures:
+            self.assertTrue(fixture["synthetic"])
+            self.assertGreater(tree_size(fixture["plan"]["Plan"]), 0)
+
+    def test_run_benchmarks(self):
+        try:
+            import torch
+        except ImportError:
+            self.skipTest("training a model needs torch")
+
+        fixtures = serving_benchmark.synthetic_fixtures(4, 2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            serving_benchmark._train_model(fixtures, "model", epochs=1)
+            results = serving_benchmark.run_benchmarks("model", fixtures, "numpy",
+                                               [1, 2], [2], repeat=2)
+
+        benchmarks = {x["benchmark"] for x in results}
+        self.assertEqual(benchmarks, {"select_plan", "predict", "predict_batch",
+                                      "record_reward"})
+        for result in results:
+            if result["benchmark"] != "record_reward":
+                self.assertIn("featurize", result["stages_ms"])
+                self.assertIn("forward", result["stages_ms"])
+            self.assertGreater(result["total_ms"]["mean"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
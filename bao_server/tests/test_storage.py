@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import storage
+from common import BaoException
+
+def _plan(buffers=None):
+    plan = {"Plan": {"Node Type": "Hash Join", "Total Cost": 200.0, "Plan Rows": 10,
+                     "Output": ["t.id"],
+                     "Plans": [{"Node Type": "Seq Scan", "Relation Name": "title",
+                                "Total Cost": 100.0, "Plan Rows": 1000, "Filter": "x"},
+                               {"Node Type": "Index Scan", "Relation Name": "name",
+                                "Index Name": "name_pkey",
+                                "Total Cost": 50.0, "Plan Rows": 10}]}}
+    if buffers is not None:
+        plan["Buffers"] = buffers
+    return plan
+
+BUFFERS = {"title": 1200, "name": 33, "name_pkey": 7, "movie_info": 5000}
+
+class StorageTestCase(unittest.TestCase):
+    # runs in a scratch directory, with its own bao.db
+
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        self.__scratch = tempfile.TemporaryDirectory()
+        os.chdir(self.__scratch.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__scratch.cleanup()
+
+    def rows(self, sql, params=()):
+        with sqlite3.connect("bao.db") as conn:
+            return conn.execute(sql, params).fetchall()
+
+class TestStoredPlans(StorageTestCase):
+
+    def test_reward_plan(self):
+        # rewards keep the featurized fields, and the buffer counts of the
+        # plan's own relations instead of the whole buffer state
+        plan = _plan(dict(BUFFERS))
+        storage.record_reward(plan, 10.0, 1)
+        stored = json.loads(self.rows("SELECT plan FROM experience")[0][0])
+
+        self.assertNotIn("Buffers", stored)
+        self.assertNotIn("Output", stored["Plan"])
+        scan, index_scan = stored["Plan"]["Plans"]
+        self.assertEqual(scan["Buffers"], 1200)
+        self.assertNotIn("Filter", scan)
+        self.assertEqual(index_scan["Buffers"], 33 + 7)
+
+        # the plan passed in is unchanged
+        self.assertEqual(plan, _plan(BUFFERS))
+
+    def test_prediction_plan(self):
+        storage.record_experimental_query("SELECT 1")
+        storage.record_experiment_prediction(1, 0, 5.0, None, _plan(dict(BUFFERS)))
+        storage.record_reward(_plan(dict(BUFFERS)), 10.0, 1)
+
+        stored = storage.experiment_plan(1, 0)
+        self.assertEqual(stored, json.loads(self.rows("SELECT plan FROM experience")[0][0]))
+        self.assertEqual(storage.experiment_plans(), {(1, 0): stored})
+
+    def test_plan_without_buffers(self):
+        storage.record_reward(_plan(), 10.0, 1)
+        stored = json.loads(self.rows("SELECT plan FROM experience")[0][0])
+        for leaf in stored["Plan"]["Plans"]:
+            self.assertNotIn("Buffers", leaf)
+
+def _other_plan():
+    # a plan of a different query template than `_plan`
+    return {"Plan": {"Node Type": "Seq Scan", "Relation Name": "movie_info",
+                     "Total Cost": 300.0, "Plan Rows": 5000}}
+
+class TestEvictExperience(StorageTestCase):
+
+    def record(self, count, plan=_plan, age=3600):
+        # `count` rewards recorded `age` seconds ago, returning their ids
+        for i in range(count):
+            storage.record_reward(plan(), float(i), 1)
+        ids = [x[0] for x in self.rows(
+            "SELECT id FROM experience ORDER BY id DESC LIMIT ?", (count,))]
+        self.backdate(ids, age)
+        return sorted(ids)
+
+    def backdate(self, ids, age):
+        with sqlite3.connect("bao.db") as conn:
+            conn.executemany("UPDATE experience SET recorded_at = ? WHERE id = ?",
+                             [(time.time() - age, x) for x in ids])
+
+    def remaining(self):
+        return [x[0] for x in self.rows("SELECT id FROM experience ORDER BY id")]
+
+    def test_all(self):
+        self.record(5)
+        self.assertEqual(0, storage.evict_experience("all", 1))
+        self.assertEqual(5, storage.experience_size())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(BaoException):
+            storage.evict_experience("lru", 1)
+
+    def test_window(self):
+        ids = self.record(10)
+        self.assertEqual(6, storage.evict_experience("window", 4))
+        self.assertEqual(ids[6:], self.remaining())
+        self.assertEqual(0, storage.evict_experience("window", 4))
+
+    def test_ttl(self):
+        old = self.record(4, age=7200)
+        new = self.record(3, age=3600)
+        self.assertEqual(len(old), storage.evict_experience("ttl", 5400))
+        self.assertEqual(new, self.remaining())
+
+    def test_reservoir(self):
+        self.record(5)
+        self.record(5, plan=_other_plan)
+        sample = "SELECT template, sample_key FROM experience ORDER BY template, sample_key"
+        before = self.rows(sample)
+        self.assertEqual(6, storage.evict_experience("reservoir", 2))
+
+        # each template keeps the rewards with the smallest sample keys
+        self.assertEqual(before[:2] + before[5:7], self.rows(sample))
+
+    def test_reservoir_fills_templates(self):
+        # rows recorded before retention was added have no template
+        ids = self.record(5)
+        with sqlite3.connect("bao.db") as conn:
+            conn.execute("UPDATE experience SET template = NULL, sample_key = NULL")
+        self.assertEqual(3, storage.evict_experience("reservoir", 2))
+        self.assertEqual(2, len(self.remaining()))
+        self.assertEqual([], self.rows(
+            "SELECT id FROM experience WHERE template IS NULL"))
+
+    def test_recent_experience_kept(self):
+        old = self.record(4)
+        self.record(4, age=0)
+        for policy, limit in (("window", 1), ("ttl", 0), ("reservoir", 1)):
+            storage.evict_experience(policy, limit)
+        # only old rewards are evicted, however little a policy keeps
+        self.assertEqual(4, storage.experience_size())
+        self.assertFalse(set(old) & set(self.remaining()))
+
+    def test_experiment_experience_kept(self):
+        ids = self.record(6)
+        storage.record_experimental_query("SELECT 1")
+        storage.record_experiment(1, ids[0], 0)
+        storage.record_experiment(1, ids[1], 1)
+
+        for policy, limit in (("window", 1), ("ttl", 0), ("reservoir", 1)):
+            storage.evict_experience(policy, limit)
+        self.assertEqual(ids[:2], self.remaining())
+        self.assertEqual(2, len(storage.experiment_experience()))
+
+    def test_batch_size(self):
+        self.record(10)
+        self.assertEqual(3, storage.evict_experience("ttl", 0, batch_size=3))
+        self.assertEqual(7, storage.experience_size())
+
+if __name__ == '__main__':
+    unittest.main()
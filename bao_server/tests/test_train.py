@@ -0,0 +1,66 @@
+import json
+import unittest
+
+try:
+    import train
+except ImportError:
+    raise unittest.SkipTest("training needs torch")
+
+def _plan(relation, buffers):
+    return {"Plan": {"Node Type": "Seq Scan", "Relation Name": relation,
+                     "Total Cost": 10.0, "Plan Rows": 100},
+            "Buffers": {relation: buffers}}
+
+class TestAggregateExperience(unittest.TestCase):
+
+    def aggregate(self, experience, aggregate="median"):
+        return sorted(train.aggregate_experience(experience, aggregate),
+                      key=lambda x: (x[0]["Plan"]["Relation Name"], x[3]))
+
+    def test_repeated_plan(self):
+        # buffer counts in the same power of two bucket are the same plan
+        experience = [(_plan("title", 40), 10.0, 1, False),
+                      (_plan("title", 50), 30.0, 2, False),
+                      (_plan("title", 60), 20.0, 1, False)]
+        [(plan, reward, weight, censored)] = self.aggregate(experience)
+        self.assertEqual(plan, _plan("title", 40))
+        self.assertEqual(reward, 20.0)
+        self.assertEqual(weight, 4)
+        self.assertFalse(censored)
+
+    def test_distinct_plans(self):
+        experience = [(_plan("title", 40), 10.0, 1, False),
+                      (_plan("title", 4000), 30.0, 1, False),
+                      (_plan("name", 40), 20.0, 1, False)]
+        self.assertEqual(len(self.aggregate(experience)), 3)
+
+    def test_censored(self):
+        # censored rewards are lower bounds, and kept apart
+        experience = [(_plan("title", 40), 10.0, 1, False),
+                      (_plan("title", 40), 12.0, 1, False),
+                      (_plan("title", 40), 500.0, 1, True)]
+        self.assertEqual([(r, w, c) for _p, r, w, c in self.aggregate(experience)],
+                         [(11.0, 2, False), (500.0, 1, True)])
+
+    def test_stored_plans(self):
+        # plans as the Bao DB returns them
+        experience = [(json.dumps(_plan("title", 40)), 10.0, 1, False),
+                      (json.dumps(_plan("title", 41)), 20.0, 1, False)]
+        [(plan, reward, _, _)] = self.aggregate(experience)
+        self.assertEqual(plan["Plan"]["Relation Name"], "title")
+        self.assertEqual(reward, 15.0)
+
+    def test_trimmed_mean(self):
+        rewards = [1.0] + [10.0] * 8 + [1000.0]
+        experience = [(_plan("title", 40), r, 1, False) for r in rewards]
+        [(_, reward, weight, _)] = self.aggregate(experience,
+                                                   "trimmed_mean")
+        self.assertEqual(reward, 10.0)
+        self.assertEqual(weight, 10)
+
+    def test_unknown_aggregate(self):
+        with self.assertRaises(train.BaoTrainingException):
+            train.aggregate_experience([], "mean")
+
+if __name__ == '__main__':
+    unittest.main()
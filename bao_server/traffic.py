@@ -0,0 +1,84 @@
+import json
+import os
+import random
+
+from common import BaoException
+
+# Records the messages the Bao server receives, so that they can be replayed
+# against a server later (see `replay.py`) without PostgreSQL. Each server
+# worker appends to its own file in the traffic directory, one JSON object
+# per line:
+#
+#   {"time": arrival time, "duration_ms": time to handle the messages,
+#    "type": message type, "messages": [the messages after the type]}
+#
+# Buffer states sent as a version or a delta are recorded as the full
+# snapshot, so a recording can be replayed on its own. When a file grows
+# past its size limit it is renamed with a ".1" suffix (and older files to
+# ".2" and so on), keeping a fixed number of old files.
+
+class TrafficRecorder:
+    def __init__(self, directory, sample_rate=1.0, max_bytes=100 * 1024 * 1024,
+                 backups=5):
+        os.makedirs(directory, exist_ok=True)
+        self.__path = os.path.join(directory, f"worker-{os.getpid()}.jsonl")
+        self.__sample_rate = sample_rate
+        self.__max_bytes = max_bytes
+        self.__backups = backups
+        self.__file = open(self.__path, "a")
+
+    def capture(self, message_type, messages, buffer_cache):
+        """
+        Returns the messages of a sampled request in their recorded form, or
+        None if the request is not sampled. Capture before handling the
+        messages, since handling them can modify them.
+        """
+        if random.random() >= self.__sample_rate:
+            return None
+
+        captured = []
+        for message in messages:
+            if "Buffer Version" in message or "Buffer Delta" in message:
+                try:
+                    message = buffer_cache.resolve(message)
+                except BaoException:
+                    pass # recorded as sent
+            captured.append(message)
+        return json.dumps(message_type), json.dumps(captured)
+
+    def write(self, captured, start, duration):
+        message_type, messages = captured
+        self.__file.write(f'{{"time": {start}, "duration_ms": {duration * 1000.0}, '
+                          + f'"type": {message_type}, "messages": {messages}}}\n')
+        self.__file.flush()
+
+        if self.__file.tell() >= self.__max_bytes:
+            self.__rotate()
+
+    def __rotate(self):
+        self.__file.close()
+        for idx in range(self.__backups, 0, -1):
+            older = f"{self.__path}.{idx - 1}" if idx > 1 else self.__path
+            if os.path.exists(older):
+                os.replace(older, f"{self.__path}.{idx}")
+        if os.path.exists(self.__path):
+            # no backups are kept
+            os.remove(self.__path)
+        self.__file = open(self.__path, "a")
+
+def read_traffic(paths):
+    # the recorded requests in the files (or directories of files) at
+    # `paths`, in the order they arrived
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, x) for x in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+
+    records = []
+    for path in files:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda x: x["time"])
+    return records
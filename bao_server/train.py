@@ -1,47 +1,184 @@
+import multiprocessing
+import random
+import numpy as np
+import torch
 import storage
 import model
 import os
-import shutil
+import model_file
 import reg_blocker
+from featurize import parse_plan, plan_key
+from config import read_config
 
 class BaoTrainingException(Exception):
     pass
 
-def train_and_swap(fn, old, tmp, verbose=False):
+def training_params(overrides=None):
+    """
+    The BaoRegression training parameters from bao.cfg, with any non-None
+    values in `overrides` taking precedence.
+    """
+    config = read_config()
+    time_budget = float(config.get("TrainingTimeBudgetSeconds", "0"))
+    params = {
+        "featurize_workers": int(config.get("FeaturizeWorkers", "1")),
+        "max_epochs": int(config.get("MaxEpochs", "100")),
+        "time_budget": time_budget if time_budget > 0 else None,
+        "batch_size": int(config.get("BatchSize", "16")),
+        "learning_rate": float(config.get("LearningRate", "0.001")),
+        "validation_fraction": float(config.get("ValidationFraction", "0")),
+        "patience": int(config.get("EarlyStoppingPatience", "10"))
+    }
+
+    for k, v in (overrides or {}).items():
+        if v is not None:
+            params[k] = v
+    return params
+
+# When a retrained model is rejected by the regression check, models
+# trained with more emphasis on the experience from experimental queries
+# (and different random seeds) often pass it. These candidates can be
+# trained at the same time by a pool of processes, each limited to an equal
+# share of the configured CPUs, after which the candidate with the best
+# regression profile that passes the check is used.
+
+def _candidate_path(tmp, idx):
+    return f"{tmp}.candidate{idx}"
+
+def _train_candidate(fn, emphasis, seed, params, threads, verbose):
+    torch.set_num_threads(threads)
+    train_and_save_model(fn, verbose=verbose, emphasize_experiments=emphasis,
+                         params=params, seed=seed)
+    return fn
+
+def _train_candidates_in_pool(tmp, candidates, params, processes, cpus, verbose):
+    # spawn rather than fork, since torch is already initialized here.
+    # Pool processes cannot start their own featurization pools.
+    params = dict(params, featurize_workers=1)
+    threads = max(1, cpus // processes)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes) as pool:
+        paths = pool.starmap(_train_candidate, [
+            (_candidate_path(tmp, idx), emphasis, seed, params, threads, verbose)
+            for idx, (emphasis, seed) in enumerate(candidates)])
+
+    models = []
+    for path in paths:
+        reg = model.BaoRegression(have_cache_data=True)
+        reg.load(path)
+        models.append(reg)
+    return paths, models
+
+def train_and_swap(fn, old, tmp, verbose=False, params=None):
+    # returns whether a new model was published at `fn`
     if os.path.exists(fn):
         old_model = model.BaoRegression(have_cache_data=True)
         old_model.load(fn)
     else:
         old_model = None
 
-    new_model = train_and_save_model(tmp, verbose=verbose)
-    max_retries = 5
-    current_retry = 1
-    while not reg_blocker.should_replace_model(old_model, new_model):
-        if current_retry >= max_retries == 0:
+    if params is None:
+        params = training_params()
+
+    config = read_config()
+    num_candidates = int(config.get("CandidateModels", "5"))
+    cpus = int(config.get("TrainingCPUs", "1"))
+
+    # candidate i emphasizes experimental queries i times over
+    candidates = [(idx, idx) for idx in range(num_candidates)]
+    paths = [_candidate_path(tmp, idx) for idx in range(num_candidates)]
+
+    # a leftover model in the old directory format would block the save
+    for path in paths:
+        model_file.remove(path)
+
+    try:
+        processes = min(cpus, num_candidates)
+        if processes <= 1:
+            # train one candidate at a time, stopping at the first that
+            # is accepted.
+            for path, (emphasis, seed) in zip(paths, candidates):
+                print("Training candidate model with emphasis", emphasis)
+                new_model = train_and_save_model(path, verbose=verbose,
+                                                 emphasize_experiments=emphasis,
+                                                 params=params, seed=seed)
+                if reg_blocker.should_replace_model(old_model, new_model):
+                    model_file.publish(path, fn, old)
+                    return True
+                print("New model rejected when compared with old model.")
+
             print("Could not train model with better regression profile.")
-            return
-        
-        print("New model rejected when compared with old model. "
-              + "Trying to retrain with emphasis on regressions.")
-        print("Retry #", current_retry)
-        new_model = train_and_save_model(tmp, verbose=verbose,
-                                         emphasize_experiments=current_retry)
-        current_retry += 1
+            return False
 
-    if os.path.exists(fn):
-        shutil.rmtree(old, ignore_errors=True)
-        os.rename(fn, old)
-    os.rename(tmp, fn)
+        print("Training", num_candidates, "candidate models with",
+              processes, "processes")
+        paths, models = _train_candidates_in_pool(tmp, candidates, params,
+                                                  processes, cpus, verbose)
 
-def train_and_save_model(fn, verbose=True, emphasize_experiments=0):
-    all_experience = storage.experience()
+        accepted = [(reg_blocker.compute_regressions(m), idx)
+                    for idx, m in enumerate(models)
+                    if reg_blocker.should_replace_model(old_model, m)]
+        if not accepted:
+            print("Could not train model with better regression profile.")
+            return False
+
+        # fewest regressions, then smallest total regression, then least
+        # emphasis
+        _regressions, best = min(accepted)
+        print("Using the candidate model with emphasis", candidates[best][0])
+        model_file.publish(paths[best], fn, old)
+        return True
+    finally:
+        for path in paths:
+            model_file.remove(path)
+
+def _trimmed_mean(values, fraction=0.1):
+    values = np.sort(values)
+    trim = int(len(values) * fraction)
+    return float(np.mean(values[trim:len(values) - trim]))
+
+AGGREGATES = {"median": lambda x: float(np.median(x)),
+              "trimmed_mean": _trimmed_mean}
+
+def aggregate_experience(experience, aggregate="median"):
+    """
+    Combine (plan, reward, weight, censored) experience for the same plan
+    (see `featurize.plan_key`) into one (plan, aggregate reward, total
+    weight, censored) row per plan. Censored and uncensored rewards are
+    combined separately.
+    """
+    if aggregate not in AGGREGATES:
+        raise BaoTrainingException(f"Unknown experience aggregate: {aggregate}")
+
+    groups = {}
+    for plan, reward, weight, censored in experience:
+        if isinstance(plan, str):
+            plan = parse_plan(plan)
+
+        key = (plan_key(plan), censored)
+        if key not in groups:
+            groups[key] = (plan, [], [])
+        groups[key][1].append(reward)
+        groups[key][2].append(weight)
+
+    return [(plan, AGGREGATES[aggregate](rewards), sum(weights), censored)
+            for (_key, censored), (plan, rewards, weights) in groups.items()]
+
+def train_and_save_model(fn, verbose=True, emphasize_experiments=0, params=None,
+                         seed=None):
+    all_experience = storage.weighted_experience(emphasize_experiments)
+
+    aggregate = read_config().get("AggregateExperience", "off")
+    if aggregate != "off" and all_experience:
+        num_rows = len(all_experience)
+        all_experience = aggregate_experience(all_experience, aggregate)
+        print("Aggregated", num_rows, "experience rows into",
+              len(all_experience), "distinct plans")
 
-    for _ in range(emphasize_experiments):
-        all_experience.extend(storage.experiment_experience())
-    
     x = [i[0] for i in all_experience]
-    y = [i[1] for i in all_experience]        
+    y = [i[1] for i in all_experience]
+    weights = [i[2] for i in all_experience]
+    censored = [i[3] for i in all_experience]
     
     if not all_experience:
         raise BaoTrainingException("Cannot train a Bao model with no experience")
@@ -49,8 +186,15 @@ def train_and_save_model(fn, verbose=True, emphasize_experiments=0):
     if len(all_experience) < 20:
         print("Warning: trying to train a Bao model with fewer than 20 datapoints.")
 
-    reg = model.BaoRegression(have_cache_data=True, verbose=verbose)
-    reg.fit(x, y)
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+    if params is None:
+        params = training_params()
+    reg = model.BaoRegression(have_cache_data=True, verbose=verbose, **params)
+    reg.fit(x, y, sample_weight=weights, censored=censored)
     reg.save(fn)
     return reg
 
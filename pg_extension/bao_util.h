@@ -2,6 +2,7 @@
 #define BAO_UTIL_H
 
 #include <arpa/inet.h>
+#include <sys/un.h>
 #include <unistd.h>
 
 #include "postgres.h"
@@ -130,11 +131,41 @@ static void write_all_to_socket(int conn_fd, const char* json) {
   }
 }
 
-// Connect to the Bao server.
+// Connect to a Bao server listening on the Unix domain socket at `path`.
+static int connect_to_bao_unix(const char* path) {
+  int ret, conn_fd;
+  struct sockaddr_un server_addr = { 0 };
+
+  if (strlen(path) >= sizeof(server_addr.sun_path)) {
+    return -1;
+  }
+
+  server_addr.sun_family = AF_UNIX;
+  strcpy(server_addr.sun_path, path);
+  conn_fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (conn_fd < 0) {
+    return conn_fd;
+  }
+
+  ret = connect(conn_fd, (struct sockaddr*)&server_addr, sizeof(server_addr));
+  if (ret == -1) {
+    close(conn_fd);
+    return ret;
+  }
+
+  return conn_fd;
+}
+
+// Connect to the Bao server. A host starting with a slash is the path of
+// the server's Unix domain socket (the port is then ignored).
 static int connect_to_bao(const char* host, int port) {
   int ret, conn_fd;
   struct sockaddr_in server_addr = { 0 };
 
+  if (host[0] == '/') {
+    return connect_to_bao_unix(host);
+  }
+
   server_addr.sin_family = AF_INET;
   server_addr.sin_port = htons(port);
   inet_pton(AF_INET, host, &server_addr.sin_addr);
@@ -100,7 +100,9 @@ void _PG_init(void) {
 
   DefineCustomStringVariable(
     "bao_host",
-    "Bao server host", NULL,
+    "Bao server host",
+    "The host name or IP address of the Bao server. A value starting with"
+    " a slash is the path of the Unix domain socket the Bao server listens on.",
     &bao_host,
     "localhost",
     PGC_USERSET,
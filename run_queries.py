@@ -1,12 +1,25 @@
+import argparse
+import configparser
+import math
 import psycopg2
 import os
+import queue
 import sys
 import random
+import subprocess
+import threading
 from time import time, sleep
 
 USE_BAO = True
 PG_CONNECTION_STR = "dbname=imdb user=imdb host=localhost"
 
+# bao.cfg of the Bao server, for the number of arms (see --arms)
+BAO_CONFIG_PATH = "bao_server/bao.cfg"
+
+# times a client reconnects after losing its connection before giving up
+# on a query
+CONNECTION_RETRIES = 5
+
 # https://stackoverflow.com/questions/312443/
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
@@ -14,51 +27,388 @@ def chunks(lst, n):
         yield lst[i:i + n]
 
 
-def run_query(sql, bao_select=False, bao_reward=False):
-    start = time()
-    while True:
-        try:
-            conn = psycopg2.connect(PG_CONNECTION_STR)
-            cur = conn.cursor()
+def percentile(values, p):
+    # nearest-rank percentile of a non-empty list
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def configured_num_arms():
+    # Arms in the Bao server's bao.cfg, which bao_num_arms must match
+    config = configparser.ConfigParser()
+    config.read(BAO_CONFIG_PATH)
+    return int(config["bao"].get("Arms", "5")) if "bao" in config else 5
+
+
+def summary_time(explain_json, key):
+    # with enable_bao, Bao adds its own group before the plan
+    return next(x[key] for x in explain_json if key in x)
+
+
+class Client:
+    # A client of the workload, running one query at a time on its own
+    # connection, which it keeps between queries.
+    def __init__(self, client_id, num_arms, measure_planning):
+        self.client_id = client_id
+        self.__num_arms = num_arms
+        self.__measure_planning = measure_planning
+        self.__conn = None
+        self.__settings = None
+
+    def __cursor(self, bao_select, bao_reward):
+        if self.__conn is None:
+            self.__conn = psycopg2.connect(PG_CONNECTION_STR)
+            self.__conn.autocommit = True
+            self.__settings = None
+
+        cur = self.__conn.cursor()
+        if self.__settings != (bao_select, bao_reward):
             cur.execute(f"SET enable_bao TO {bao_select or bao_reward}")
             cur.execute(f"SET enable_bao_selection TO {bao_select}")
             cur.execute(f"SET enable_bao_rewards TO {bao_reward}")
-            cur.execute("SET bao_num_arms TO 5")
+            cur.execute(f"SET bao_num_arms TO {self.__num_arms}")
             cur.execute("SET statement_timeout TO 300000")
-            cur.execute(q)
-            cur.fetchall()
-            conn.close()
-            break
-        except:
-            sleep(1)
-            continue
-    stop = time()
-    return stop - start
-
-        
-query_paths = sys.argv[1:]
+            self.__settings = (bao_select, bao_reward)
+        return cur
+
+    def close(self):
+        if self.__conn is not None:
+            try:
+                self.__conn.close()
+            except psycopg2.Error:
+                pass
+            self.__conn = None
+
+    def run_query(self, sql, bao_select=False, bao_reward=False):
+        """
+        Run `sql`, returning its latency in seconds, and the time PostgreSQL
+        (and Bao) spent planning and executing it in milliseconds. These
+        are only measured (otherwise NaN) when measuring planning, which
+        runs the query as EXPLAIN ANALYZE, so both come from the same
+        execution of the query (with the overhead of its instrumentation).
+        """
+        for _ in range(CONNECTION_RETRIES):
+            try:
+                cur = self.__cursor(bao_select, bao_reward)
+
+                start = time()
+                if self.__measure_planning:
+                    cur.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + sql)
+                    explain_json = cur.fetchall()[0][0]
+                    return (time() - start,
+                            summary_time(explain_json, "Planning Time"),
+                            summary_time(explain_json, "Execution Time"))
+
+                cur.execute(sql)
+                cur.fetchall()
+                return time() - start, math.nan, math.nan
+            except psycopg2.errors.QueryCanceled:
+                raise
+            except psycopg2.OperationalError as e:
+                # e.g., PostgreSQL restarted. Reconnect and try again.
+                print(f"Client {self.client_id} lost its connection ({e}),",
+                      "reconnecting.", file=sys.stderr, flush=True)
+                self.close()
+                sleep(1)
+
+        raise psycopg2.OperationalError(
+            f"Client {self.client_id} could not reconnect to PostgreSQL.")
+
+
+def server_model_version():
+    # the version of the model the Bao server uses, see `baoctl.py
+    # --model-version`, or None if the server cannot be asked
+    try:
+        out = subprocess.run(["python3", "baoctl.py", "--model-version"],
+                             cwd="bao_server", capture_output=True, text=True,
+                             check=True).stdout
+        return int(out.split()[-1])
+    except (subprocess.CalledProcessError, ValueError, IndexError):
+        return None
+
+
+class Retrainer:
+    # Retrains the Bao model with `baoctl.py --retrain`, which sends the new
+    # model to the Bao server when it is accepted. The model version is the
+    # one the server reports after each retrain. In the background, queries
+    # keep running while the model trains, and only one retrain runs at a
+    # time.
+    def __init__(self, background=False):
+        self.__background = background
+        self.__version = server_model_version()
+        self.__proc = None
+        self.__started = None
+        self.__lock = threading.Lock()
+
+    def __finished(self, status):
+        if status != 0:
+            print(f"Retrain started at {self.__started} exited with status",
+                  status, "and did not load a new model", flush=True)
+            return
+
+        version = server_model_version()
+        if version is not None and version == self.__version:
+            print(f"Bao server kept model version {version} after the retrain",
+                  f"started at {self.__started}", flush=True)
+            return
+
+        self.__version = version
+        print(f"Model version {version} loaded at {time()},",
+              f"{time() - self.__started:.1f}s after its retrain started",
+              flush=True)
+
+    def start(self):
+        with self.__lock:
+            self.__poll()
+            if self.__proc is not None:
+                print("Previous retrain still running, not retraining.", flush=True)
+                return
+
+            self.__started = time()
+            if not self.__background:
+                status = subprocess.run(["python3", "baoctl.py", "--retrain"],
+                                        cwd="bao_server").returncode
+                os.system("sync")
+                self.__finished(status)
+                return
+
+            print(f"Retraining in the background from {time()}", flush=True)
+            self.__proc = subprocess.Popen(["python3", "baoctl.py", "--retrain"],
+                                           cwd="bao_server")
+
+    def __poll(self):
+        if self.__proc is not None and (status := self.__proc.poll()) is not None:
+            self.__proc = None
+            self.__finished(status)
+
+    def state(self):
+        # (model version, whether a retrain is running)
+        with self.__lock:
+            self.__poll()
+            return self.__version, self.__proc is not None
+
+    def wait(self):
+        with self.__lock:
+            if self.__proc is not None:
+                self.__proc.wait()
+                self.__poll()
+
+
+class Workload:
+    # Runs queries from a pool of clients. In a closed loop (rate=None), each
+    # client runs its next query `think_time` seconds after the last one
+    # finished. In an open loop, queries arrive at `rate` queries per second
+    # (as a Poisson process) whether or not clients are free, and wait in a
+    # queue until one is.
+    def __init__(self, num_clients, num_arms, rate=None, think_time=0.0,
+                 measure_planning=False, seed=42):
+        self.__clients = [Client(i, num_arms, measure_planning)
+                          for i in range(num_clients)]
+        self.__rate = rate
+        self.__think_time = think_time
+        self.__arrivals = random.Random(seed)
+        self.__print_lock = threading.Lock()
+
+    def close(self):
+        for client in self.__clients:
+            client.close()
+
+    def __client_loop(self, client, work, results, label, bao_select, bao_reward,
+                      retrainer, on_result):
+        while (item := work.get()) is not None:
+            c_idx, q_idx, fp, sql, arrival = item
+            start = time()
+            # queries are planned as they start, with the model loaded then
+            version, retraining = retrainer.state()
+            try:
+                q_time, plan_ms, exec_ms = client.run_query(
+                    sql, bao_select=bao_select, bao_reward=bao_reward)
+                error = None
+            except psycopg2.Error as e:
+                q_time, plan_ms, exec_ms = math.nan, math.nan, math.nan
+                error = str(e).strip().splitlines()[0]
+            finish = time()
+
+            result = {"latency": q_time * 1000.0,
+                      "planning": plan_ms,
+                      "execution": exec_ms,
+                      # only open loop queries arrive before they can run
+                      "queueing": (start - arrival) * 1000.0 if arrival else math.nan,
+                      "version": version,
+                      "retraining": retraining,
+                      "error": error}
+
+            with self.__print_lock:
+                # counted under the lock, so each client sees a different
+                # number of finished queries
+                results.append(result)
+                finished = len(results)
+
+                if error:
+                    print("Failed", c_idx, q_idx, fp, label, client.client_id,
+                          error, flush=True)
+                else:
+                    # the first five columns are read by analyze_bao.ipynb
+                    print(c_idx, q_idx, finish, fp, q_time, label,
+                          client.client_id, round(plan_ms, 3),
+                          round(result["execution"], 3),
+                          round(result["queueing"], 3),
+                          version, int(retraining), flush=True)
+
+            if on_result:
+                on_result(finished)
+
+            if self.__rate is None and self.__think_time:
+                sleep(self.__think_time)
+
+    def run(self, items, label, retrainer, bao_select=False, bao_reward=False,
+            on_result=None):
+        """
+        Run `items`, a list of (chunk index, query index, path, SQL), and
+        return a result for each query. `on_result` is called with the
+        number of queries finished so far after each one.
+        """
+        work = queue.Queue()
+        results = []
+        threads = [threading.Thread(target=self.__client_loop,
+                                    args=(client, work, results, label,
+                                          bao_select, bao_reward, retrainer,
+                                          on_result))
+                   for client in self.__clients]
+        for thread in threads:
+            thread.start()
+
+        if self.__rate is None:
+            for item in items:
+                work.put((*item, None))
+        else:
+            next_arrival = time()
+            for item in items:
+                next_arrival += self.__arrivals.expovariate(self.__rate)
+                sleep(max(next_arrival - time(), 0))
+                work.put((*item, next_arrival))
+
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def print_summary(label, results, elapsed):
+    ok = [x for x in results if not x["error"]]
+    print(f"Summary {label}: {len(results)} queries ({len(results) - len(ok)}",
+          f"failed) in {elapsed:.1f}s,",
+          f"{len(ok) / elapsed if elapsed else 0:.2f} queries/s", flush=True)
+    if not ok:
+        return
+
+    for key in ["latency", "planning", "execution", "queueing"]:
+        values = [x[key] for x in ok if not math.isnan(x[key])]
+        if values:
+            print(f"  {key} ms:",
+                  " ".join(f"p{p}={percentile(values, p):.1f}" for p in (50, 95, 99)),
+                  f"max={max(values):.1f}", flush=True)
+
+    # the latency under each model, and while retraining
+    groups = {}
+    for x in ok:
+        groups.setdefault(f"model version {x['version']}", []).append(x["latency"])
+    retraining = [x["latency"] for x in ok if x["retraining"]]
+    if retraining:
+        groups["while retraining"] = retraining
+    if len(groups) > 1:
+        for group, values in groups.items():
+            print(f"  latency ms, {group} ({len(values)} queries):",
+                  " ".join(f"p{p}={percentile(values, p):.1f}" for p in (50, 95, 99)),
+                  flush=True)
+
+
+parser = argparse.ArgumentParser("Run a workload of sample queries")
+parser.add_argument("queries", nargs="+", metavar="PATH",
+                    help="SQL files to draw the workload from")
+parser.add_argument("--clients", type=int, default=1,
+                    help="Number of concurrent clients (default 1)")
+parser.add_argument("--rate", type=float,
+                    help="Open loop: queries arrive at this many per second. "
+                    + "Without it, every client runs queries back to back.")
+parser.add_argument("--think-time", type=float, default=0.0, metavar="SECONDS",
+                    help="Closed loop: pause between a client's queries")
+parser.add_argument("--num-queries", type=int, default=500,
+                    help="Length of the workload (default 500)")
+parser.add_argument("--chunk-size", type=int, default=25,
+                    help="Queries between retrains (default 25)")
+parser.add_argument("--planning-time", action="store_true",
+                    help="Run queries as EXPLAIN ANALYZE to report their planning "
+                    + "and execution time (adds instrumentation overhead)")
+parser.add_argument("--arms", type=int,
+                    help="bao_num_arms for the queries (default: Arms in "
+                    + f"{BAO_CONFIG_PATH}, or 5)")
+parser.add_argument("--background-retrain", action="store_true",
+                    help="Retrain while queries keep running, instead of "
+                    + "pausing the workload for every retrain")
+args = parser.parse_args()
+
 queries = []
-for fp in query_paths:
+for fp in args.queries:
     with open(fp) as f:
         query = f.read()
     queries.append((fp, query))
 print("Read", len(queries), "queries.")
 print("Using Bao:", USE_BAO)
+print("Clients:", args.clients,
+      "Arrivals:", f"{args.rate}/s (open loop)" if args.rate else "closed loop")
 
 random.seed(42)
-query_sequence = random.choices(queries, k=500)
-pg_chunks, *bao_chunks = list(chunks(query_sequence, 25))
+query_sequence = random.choices(queries, k=args.num_queries)
+pg_chunks, *bao_chunks = list(chunks(query_sequence, args.chunk_size))
+
+num_arms = args.arms or configured_num_arms()
+print("Arms:", num_arms)
+workload = Workload(args.clients, num_arms, rate=args.rate,
+                    think_time=args.think_time, measure_planning=args.planning_time)
+retrainer = Retrainer(background=args.background_retrain)
 
 print("Executing queries using PG optimizer for initial training")
 
-for fp, q in pg_chunks:
-    pg_time = run_query(q, bao_reward=True)
-    print("x", "x", time(), fp, pg_time, "PG", flush=True)
-
-for c_idx, chunk in enumerate(bao_chunks):
-    if USE_BAO:
-        os.system("cd bao_server && python3 baoctl.py --retrain")
-        os.system("sync")
-    for q_idx, (fp, q) in enumerate(chunk):
-        q_time = run_query(q, bao_reward=USE_BAO, bao_select=USE_BAO)
-        print(c_idx, q_idx, time(), fp, q_time, flush=True)
+start = time()
+pg_results = workload.run([("x", "x", fp, q) for fp, q in pg_chunks],
+                          "PG", retrainer, bao_reward=True)
+pg_elapsed = time() - start
+
+bao_results = []
+bao_elapsed = 0.0
+if USE_BAO and args.background_retrain:
+    # one continuous run, starting a retrain after every chunk of queries
+    # (and at the start), while the last model keeps planning queries
+    num_bao_queries = sum(len(chunk) for chunk in bao_chunks)
+
+    def retrain_after_chunk(finished):
+        if finished % args.chunk_size == 0 and finished < num_bao_queries:
+            retrainer.start()
+
+    retrainer.start()
+    start = time()
+    bao_results = workload.run(
+        [(c_idx, q_idx, fp, q) for c_idx, chunk in enumerate(bao_chunks)
+         for q_idx, (fp, q) in enumerate(chunk)],
+        "Bao", retrainer, bao_reward=True, bao_select=True,
+        on_result=retrain_after_chunk)
+    bao_elapsed = time() - start
+    retrainer.wait()
+else:
+    for c_idx, chunk in enumerate(bao_chunks):
+        if USE_BAO:
+            retrainer.start()
+
+        start = time()
+        bao_results.extend(workload.run(
+            [(c_idx, q_idx, fp, q) for q_idx, (fp, q) in enumerate(chunk)],
+            "Bao" if USE_BAO else "PG", retrainer,
+            bao_reward=USE_BAO, bao_select=USE_BAO))
+        bao_elapsed += time() - start
+
+workload.close()
+print_summary("initial PG", pg_results, pg_elapsed)
+print_summary("Bao" if USE_BAO else "PG", bao_results, bao_elapsed)